@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from ad_service.ad_integration.records import MEMBER_FIELDS
+from ad_service.utils import config
+
+# timestamps change on every sync without the profile changing
+FINGERPRINT_FIELDS = tuple(key for key in MEMBER_FIELDS if not key.endswith('update_time'))
+
+# sqlite limits the number of bound parameters per statement
+_LOOKUP_BATCH_SIZE = 500
+
+
+def get_fingerprint(group_id, record):
+    """
+    :param record: MemberRecord or member data dict
+    """
+    values = [str(group_id)] + [record[key] for key in FINGERPRINT_FIELDS]
+    return hashlib.sha1(json.dumps(values, default=str).encode('utf-8')).hexdigest()
+
+
+class FingerprintStore:
+    """
+    Hashes of the profiles last published by one AD instance to one queue, kept in a local SQLite file.
+    Profiles whose hash did not change since then need not be sent again.
+    Hashes are staged while their events are in flight and only committed once the queue acknowledged them.
+    The reporting depth and span of control last published for every person are kept the same way.
+    The time of the last full re-send is kept too, a lost or reset store makes the next sync a full re-send.
+    """
+    def __init__(self, ad_url, queue_url, group_id, path=None):
+        self.ad_url = ad_url
+        self.queue_url = queue_url
+        self.group_id = group_id
+        path = path or config.FINGERPRINT_DB_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=config.FINGERPRINT_DB_TIMEOUT, check_same_thread=False)
+        self._conn.execute('create table if not exists profile_fingerprint ('
+                           'instance_url text not null, queue_url text not null, email text not null, '
+                           'fingerprint text not null, primary key (instance_url, queue_url, email)) without rowid')
+        self._conn.execute('create table if not exists hierarchy_position ('
+                           'instance_url text not null, queue_url text not null, email text not null, '
+                           'depth integer not null, span integer not null, '
+                           'primary key (instance_url, queue_url, email)) without rowid')
+        self._conn.execute('create table if not exists full_resend ('
+                           'instance_url text not null, queue_url text not null, resent_at real not null, '
+                           'primary key (instance_url, queue_url)) without rowid')
+        self._conn.commit()
+        self._staged = {}
+        self._staged_positions = {}
+
+    def fingerprint(self, record):
+        return get_fingerprint(self.group_id, record)
+
+    def _get_fingerprints(self, emails):
+        fingerprints = {}
+        for i in range(0, len(emails), _LOOKUP_BATCH_SIZE):
+            batch = emails[i:i + _LOOKUP_BATCH_SIZE]
+            query = ('select email, fingerprint from profile_fingerprint '
+                     'where instance_url = ? and queue_url = ? and email in ({0})'.format(','.join('?' * len(batch))))
+            fingerprints.update(self._conn.execute(query, [self.ad_url, self.queue_url] + batch))
+        return fingerprints
+
+    def changed(self, records, known=None):
+        """
+        :param records: MemberRecords
+        :param known: {email: fingerprint} already computed for some of the records, e.g. by transform workers
+        :return: {email: fingerprint} of the records that are new or changed since they were last committed
+        """
+        known = known or {}
+        fingerprints = {}
+        for record in records:
+            email = record[config.AD_PROFILE_PRIMARY_KEY]
+            fingerprints[email] = known.get(email) or self.fingerprint(record)
+        previous = self._get_fingerprints(list(fingerprints))
+        return {email: fingerprint for email, fingerprint in fingerprints.items()
+                if previous.get(email) != fingerprint}
+
+    def changed_positions(self, positions):
+        """
+        :param positions: {email: (reporting depth, span of control)} of the people of a full sync
+        :return: the positions that are new or changed since they were last committed
+        """
+        previous = {email: (depth, span) for email, depth, span in self._conn.execute(
+            'select email, depth, span from hierarchy_position where instance_url = ? and queue_url = ?',
+            (self.ad_url, self.queue_url))}
+        return {email: position for email, position in positions.items() if previous.get(email) != tuple(position)}
+
+    def stage(self, fingerprints):
+        self._staged.update(fingerprints)
+
+    def stage_positions(self, positions):
+        self._staged_positions.update(positions)
+
+    def commit(self):
+        """
+        Persist the staged fingerprints and positions, call once the queue acknowledged their events
+        """
+        if not self._staged and not self._staged_positions:
+            return
+        with self._conn:
+            self._conn.executemany('insert or replace into profile_fingerprint '
+                                   '(instance_url, queue_url, email, fingerprint) values (?, ?, ?, ?)',
+                                   [(self.ad_url, self.queue_url, email, fingerprint)
+                                    for email, fingerprint in self._staged.items()])
+            self._conn.executemany('insert or replace into hierarchy_position '
+                                   '(instance_url, queue_url, email, depth, span) values (?, ?, ?, ?, ?)',
+                                   [(self.ad_url, self.queue_url, email, depth, span)
+                                    for email, (depth, span) in self._staged_positions.items()])
+        self._staged = {}
+        self._staged_positions = {}
+
+    def full_resend_due(self):
+        """
+        :return: True when every profile should be published again: config.FINGERPRINT_FULL_RESEND_INTERVAL
+            seconds passed since the last full re-send, or there was none
+        """
+        row = self._conn.execute('select resent_at from full_resend where instance_url = ? and queue_url = ?',
+                                 (self.ad_url, self.queue_url)).fetchone()
+        if row is None:
+            return True
+        interval = config.FINGERPRINT_FULL_RESEND_INTERVAL
+        return interval is not None and time.time() - row[0] >= interval
+
+    def record_full_resend(self):
+        """
+        Call once a sync published every profile
+        """
+        with self._conn:
+            self._conn.execute('insert or replace into full_resend (instance_url, queue_url, resent_at) '
+                               'values (?, ?, ?)', (self.ad_url, self.queue_url, time.time()))
+
+    def close(self):
+        self._conn.close()
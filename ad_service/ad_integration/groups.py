@@ -0,0 +1,121 @@
+"""
+Groups of the group sync: their ADGroup node data, the ranged retrieval of their members and the resolution of
+member DNs to the people and groups they are.
+"""
+from ad_service.ad_integration.hierarchy import normalize_dn
+from ad_service.utils import config
+from ad_service.utils.time import timestamp_to_integer
+
+PERSON = 'person'
+GROUP = 'group'
+
+
+def _get_value(attributes, key):
+    value = attributes.get(key)
+    if type(value) is list:
+        value = value[0] if value else None
+    return '' if value is None else value
+
+
+def get_guid(attributes):
+    """
+    :return: objectGUID of the entry as a string, '' when it has none
+    """
+    return str(_get_value(attributes, config.AD_GUID))
+
+
+def get_group(attributes, now):
+    """
+    :param attributes: attributes of a group entry of a raw search response
+    :param now: milliseconds since epoch
+    :return: ADGroup node data, None when the entry has no objectGUID
+    """
+    guid = get_guid(attributes)
+    if not guid:
+        return None
+    when_created = _get_value(attributes, config.AD_WHEN_CREATED)
+    return {
+        config.GROUP_PRIMARY_KEY: guid,
+        'name': _get_value(attributes, config.AD_GROUP_NAME),
+        'email': _get_value(attributes, config.AD_EMAIL).lower(),
+        'description': _get_value(attributes, config.AD_GROUP_DESCRIPTION),
+        'ad_distinguished_name': _get_value(attributes, config.AD_DISTINGUISHED_NAME),
+        'created_at': timestamp_to_integer(when_created) if when_created else '',
+        'last_update_time': now,
+        'data_source': config.DATA_SOURCE,
+    }
+
+
+def get_range_attribute(attribute, low, size):
+    """
+    :return: name requesting `size` values of the attribute from index `low` on, e.g. member;range=0-1499
+    """
+    return '{0};range={1}-{2}'.format(attribute, low, low + size - 1)
+
+
+def get_member_range(attributes, attribute):
+    """
+    Values of a ranged attribute in the attributes of an entry. AD answers a range request with the range it
+    returned, `member;range=0-1499` while there are more values and `member;range=1500-*` with the last ones;
+    an attribute with few values may come back without a range.
+    :return: (values, index of the first value of the next range, None once all values were read)
+    """
+    prefix = attribute.lower() + ';range='
+    for key, values in attributes.items():
+        name = key.lower()
+        if name != attribute.lower() and not name.startswith(prefix):
+            continue
+        values = values if isinstance(values, list) else [values] if values else []
+        if name == attribute.lower():
+            return values, None
+        _, _, high = name[len(prefix):].partition('-')
+        return values, None if high == '*' else int(high) + 1
+    return [], None
+
+
+class MemberResolver:
+    """
+    Resolves the member DNs of groups to the Person (email) or ADGroup (guid) they are, in memory from the people
+    (OrgHierarchy) and the groups of the sync. DNs that are not known in memory are looked up in the graph in
+    batches, and the answer, found or not, is cached for the rest of the sync: a DN that is a member of many groups
+    is looked up once.
+    """
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+        self._groups = {}
+        self._looked_up = {}
+
+    def add_group(self, dn, guid):
+        if dn:
+            self._groups[normalize_dn(dn)] = guid
+
+    def resolve_all(self, dns, lookup_people=None, lookup_groups=None):
+        """
+        :param lookup_people: called with the DNs not known in memory, returns {dn: email} of the ones found
+        :param lookup_groups: called with the DNs that are no person either, returns {dn: guid}
+        :return: {dn: (PERSON or GROUP, email or guid)} of the DNs resolved
+        """
+        resolved = {}
+        unknown = []
+        for dn in dns:
+            key = normalize_dn(dn)
+            email = self.hierarchy.resolve(dn)
+            if email is not None:
+                resolved[dn] = PERSON, email
+            elif key in self._groups:
+                resolved[dn] = GROUP, self._groups[key]
+            elif key in self._looked_up:
+                if self._looked_up[key] is not None:
+                    resolved[dn] = self._looked_up[key]
+            else:
+                unknown.append(dn)
+
+        if unknown and lookup_people is not None:
+            people = lookup_people(unknown)
+            groups = lookup_groups([dn for dn in unknown if dn not in people]) if lookup_groups is not None else {}
+            for dn in unknown:
+                found = (PERSON, people[dn]) if dn in people else (GROUP, groups[dn]) if dn in groups else None
+                self._looked_up[normalize_dn(dn)] = found
+                if found is not None:
+                    resolved[dn] = found
+        return resolved
@@ -0,0 +1,94 @@
+import re
+
+# AD compares distinguished names case-insensitively and ignores the spaces around the RDN separators
+_DN_SEPARATOR_SPACES = re.compile(r'\s*,\s*')
+
+
+def normalize_dn(dn):
+    return _DN_SEPARATOR_SPACES.sub(',', dn.strip().lower())
+
+
+class OrgHierarchy:
+    """
+    Managers of the people of a sync, with their distinguished names indexed so that manager and directReports DNs
+    resolve to emails in memory instead of with graph queries.
+    Only the email, DN and manager DN of a person are kept, a few hundred bytes per person.
+    """
+    def __init__(self):
+        self._emails = {}
+        self._manager_dns = {}
+
+    def add(self, email, dn, manager_dn):
+        """
+        Index a person, the last call for an email wins
+        :param manager_dn: DN of the manager, '' when the person has none
+        """
+        if dn:
+            self._emails[normalize_dn(dn)] = email
+        self._manager_dns[email] = manager_dn or ''
+
+    def add_known_dns(self, emails_by_dn):
+        """
+        Index the DNs of people outside this sync, e.g. unchanged managers of an incremental sync
+        :param emails_by_dn: {dn: email}
+        """
+        for dn, email in emails_by_dn.items():
+            self._emails.setdefault(normalize_dn(dn), email)
+
+    def resolve(self, dn):
+        """
+        :return: email of the DN, None when nobody known has it
+        """
+        return self._emails.get(normalize_dn(dn)) if dn else None
+
+    def manager_of(self, email):
+        return self.resolve(self._manager_dns.get(email))
+
+    def get_unresolved_manager_dns(self, emails=None):
+        """
+        :param emails: people whose managers are needed, defaults to everybody indexed
+        :return: manager DNs that do not resolve to an email
+        """
+        emails = self._manager_dns if emails is None else emails
+        return {self._manager_dns[email] for email in emails
+                if self._manager_dns.get(email) and self.resolve(self._manager_dns[email]) is None}
+
+    def get_depths_and_spans(self):
+        """
+        Reporting depth (managers above a person, 0 for the top of the directory) and span of control (direct
+        reports) of every indexed person, in one pass: every person is walked up to the first one whose depth is
+        known, so each reporting line is walked once. A manager loop is cut where the walk came back into it.
+        :return: {email: (depth, span)}
+        """
+        managers = {}
+        spans = dict.fromkeys(self._manager_dns, 0)
+        for email in self._manager_dns:
+            manager = self.manager_of(email)
+            # managers outside the sync are not part of the hierarchy
+            if manager in spans and manager != email:
+                managers[email] = manager
+                spans[manager] += 1
+
+        depths = {}
+        for email in self._manager_dns:
+            path = []
+            on_path = set()
+            current = email
+            while current is not None and current not in depths and current not in on_path:
+                path.append(current)
+                on_path.add(current)
+                current = managers.get(current)
+            depth = depths[current] + 1 if current in depths else 0
+            for person in reversed(path):
+                depths[person] = depth
+                depth += 1
+        return {email: (depths[email], spans[email]) for email in self._manager_dns}
+
+    def __contains__(self, email):
+        return email in self._manager_dns
+
+    def __iter__(self):
+        return iter(self._manager_dns)
+
+    def __len__(self):
+        return len(self._manager_dns)
@@ -0,0 +1,285 @@
+import datetime
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from ad_service.models import SyncJob
+from ad_service.utils import config, metrics
+
+logger = config.LOGGER
+
+_executor = None
+_executor_lock = threading.Lock()
+# running + waiting jobs of this process, a job that does not get a slot is rejected
+_job_slots = threading.BoundedSemaphore(config.SYNC_WORKERS + config.SYNC_MAX_QUEUED_JOBS)
+# onboard_and_update pulls in py2neo and ldap3, it is imported by the first job instead of with the views
+ADIntegration = None
+# stages before the sync is done fetching, a request for the same AD instance joins the sync until it leaves them
+_JOINABLE_STAGES = (None, 'indexing labels', 'populating company node', 'fetching ldap data', 'streaming ldap pages')
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def send_to_queue(data_to_send, queue_url):
+    # the queue client pulls in requests and retrying, it is imported by the first job instead of with the views
+    from ad_service.utils import queue
+    return queue.send_to_queue(data_to_send, queue_url)
+
+
+def send_confirmation(queue_url, state, is_success, reason=None):
+    from ad_service.utils.queue import get_confirmation_dict
+    confirmation_dict = get_confirmation_dict(state, is_success, reason)
+    send_to_queue(confirmation_dict, queue_url)
+    logger.info('Checkpoint: Sent confirmation. state: {0} is_success: {1} reason: {2}'.format(state, is_success, reason))
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.SYNC_WORKERS, thread_name_prefix='ad-sync')
+        return _executor
+
+
+def get_flight_key(ad_url, group_id, queue_url, ad_search_base, ad_username):
+    """
+    Key of the syncs that publish the same search base of an AD instance, read as the same user, to the same group
+    and queue. Only requests with the same key share a sync, a request of another scope gets a sync of its own.
+    """
+    user = hashlib.sha1(ad_username.encode('utf-8')).hexdigest()
+    key = [ad_url, str(group_id), queue_url, ad_search_base, user]
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def _get_stale_before():
+    # jobs of a process that died never finish, they stop holding their flight after a while
+    return timezone.now() - datetime.timedelta(seconds=config.SYNC_STALE_JOB_AGE)
+
+
+def submit_sync_job(ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id, state):
+    """
+    Create a SyncJob and hand it to the worker pool.
+    While a sync of the same AD instance, search base, user, group and queue has not finished fetching, in any
+    process, the job is attached to it instead and finishes with it. Once it has, one follow-up job is queued behind
+    it and the requests coming in meanwhile attach to the follow-up.
+    :raises JobQueueFull: when this process already has as many jobs as it can run and queue
+    :return: created SyncJob, with attached_to set when it joined another job's sync
+    """
+    flight = get_flight_key(ad_url, group_id, queue_url, ad_search_base, ad_username)
+    while True:
+        job = _attach(flight, state)
+        if job is not None:
+            metrics.SYNC_JOBS_ATTACHED.inc()
+            logger.info('Checkpoint: Attached job {0} to job {1} for AD_URL: {2}'.format(job.pk, job.attached_to_id,
+                                                                                         ad_url))
+            return job
+
+        if not _job_slots.acquire(blocking=False):
+            raise JobQueueFull('Too many ad integration jobs in progress')
+        try:
+            with transaction.atomic():
+                job = SyncJob.objects.create(ad_url=ad_url, group_id=str(group_id), queue_url=queue_url,
+                                             state=state, flight=flight)
+        except IntegrityError:
+            # another request started a sync of the instance meanwhile, join it
+            _job_slots.release()
+            continue
+        except Exception:
+            _job_slots.release()
+            raise
+        break
+
+    try:
+        metrics.SYNC_JOBS_WAITING.inc()
+        _get_executor().submit(_run_job, job.pk, ad_url, ad_username, ad_password, ad_search_base, graph_url,
+                               queue_url, group_id, state)
+    except Exception:
+        metrics.SYNC_JOBS_WAITING.dec()
+        _job_slots.release()
+        _update_job(job.pk, flight=None)
+        raise
+    logger.info('Checkpoint: Queued job {0} for AD_URL: {1}'.format(job.pk, ad_url))
+    return job
+
+
+def _attach(flight, state):
+    """
+    :return: job attached to the sync holding the flight, None when no sync can be joined
+    """
+    leader = SyncJob.objects.filter(flight=flight).first()
+    if leader is None:
+        return None
+    if leader.created_at < _get_stale_before():
+        SyncJob.objects.filter(pk=leader.pk, flight=flight).update(flight=None)
+        return None
+
+    job = SyncJob.objects.create(ad_url=leader.ad_url, group_id=leader.group_id, queue_url=leader.queue_url,
+                                 state=state, attached_to=leader)
+    if SyncJob.objects.filter(pk=leader.pk, flight=flight).exists():
+        return job
+    # the sync finished fetching before the job was attached, the job is dropped unless the sync already finished it
+    if SyncJob.objects.filter(pk=job.pk, status=SyncJob.STATUS_QUEUED).delete()[0]:
+        return None
+    return job
+
+
+def _get_integration_class():
+    global ADIntegration
+    if ADIntegration is None:
+        from ad_service.ad_integration.onboard_and_update import ADIntegration as integration_class
+        ADIntegration = integration_class
+    return ADIntegration
+
+
+def _update_job(job_id, **fields):
+    SyncJob.objects.filter(pk=job_id).update(**fields)
+
+
+def _run_job(job_id, *args):
+    """
+    Run the sync of a job on a worker. A follow-up job whose earlier sync is still running gives the worker back and
+    is queued again after config.SYNC_FOLLOW_UP_POLL_INTERVAL, keeping its job slot.
+    :param args: ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id, state
+    """
+    metrics.SYNC_JOBS_WAITING.dec()
+    metrics.SYNC_JOBS_RUNNING.inc()
+    requeued = False
+    try:
+        if _is_waiting_for_earlier_syncs(job_id):
+            _requeue_job(job_id, args)
+            requeued = True
+            return
+        _update_job(job_id, status=SyncJob.STATUS_RUNNING, stage='indexing labels', started_at=timezone.now())
+        _run_integration(job_id, *args)
+    except Exception as e:
+        logger.exception('Job {0} failed unexpectedly: {1}'.format(job_id, repr(e)))
+        _fail_job(job_id, repr(e), args)
+    finally:
+        metrics.SYNC_JOBS_RUNNING.dec()
+        if not requeued:
+            _update_job(job_id, flight=None)
+            _job_slots.release()
+        close_old_connections()
+
+
+def _fail_job(job_id, reason, args):
+    """
+    Fail a job that broke outside of its sync, with the jobs attached to it
+    """
+    _update_job(job_id, status=SyncJob.STATUS_FAILED, reason=reason, finished_at=timezone.now())
+    metrics.SYNC_JOBS.labels(SyncJob.STATUS_FAILED).inc()
+    queue_url, state = args[5], args[7]
+    try:
+        send_confirmation(queue_url=queue_url, state=state, is_success=False,
+                          reason='Internal Server Error! Please try again!')
+    except Exception as e:
+        logger.exception('Confirmation of job {0} failed: {1}'.format(job_id, repr(e)))
+    _finish_attached_jobs(job_id, SyncJob.STATUS_FAILED, reason, 'Internal Server Error! Please try again!')
+
+
+def _is_waiting_for_earlier_syncs(job_id):
+    """
+    :return: True while a sync of the AD instance the follow-up job was queued behind runs, in any process
+    """
+    job = SyncJob.objects.get(pk=job_id)
+    earlier = SyncJob.objects.filter(ad_url=job.ad_url, group_id=job.group_id, queue_url=job.queue_url,
+                                     attached_to=None, status__in=[SyncJob.STATUS_QUEUED, SyncJob.STATUS_RUNNING],
+                                     created_at__lt=job.created_at, created_at__gte=_get_stale_before())
+    if not earlier.exclude(pk=job_id).exists():
+        return False
+    if job.stage != 'waiting for the running sync':
+        _update_job(job_id, stage='waiting for the running sync')
+        logger.info('Checkpoint: Job {0} waits for the running sync of AD_URL: {1}'.format(job_id, job.ad_url))
+    return True
+
+
+def _requeue_job(job_id, args):
+    def submit():
+        try:
+            _get_executor().submit(_run_job, job_id, *args)
+        except Exception as e:
+            logger.exception('Job {0} could not be queued again: {1}'.format(job_id, repr(e)))
+            metrics.SYNC_JOBS_WAITING.dec()
+            try:
+                _fail_job(job_id, repr(e), args)
+                _update_job(job_id, flight=None)
+            finally:
+                _job_slots.release()
+                close_old_connections()
+
+    metrics.SYNC_JOBS_WAITING.inc()
+    timer = threading.Timer(config.SYNC_FOLLOW_UP_POLL_INTERVAL, submit)
+    timer.daemon = True
+    timer.start()
+
+
+def _finish_attached_jobs(job_id, status, reason='', confirmation_reason=None):
+    """
+    Finish the jobs attached to this one with its outcome, each gets the confirmation of its own request
+    """
+    # no job attaches once the flight is released, the ones that did before are all found below
+    _update_job(job_id, flight=None)
+    job = SyncJob.objects.get(pk=job_id)
+    fields = dict(status=status, reason=reason, done=job.done, not_done=job.not_done, started_at=job.started_at,
+                  finished_at=timezone.now())
+    if status == SyncJob.STATUS_SUCCEEDED:
+        fields['stage'] = 'done'
+    for attached in SyncJob.objects.filter(attached_to=job_id, status=SyncJob.STATUS_QUEUED):
+        if not SyncJob.objects.filter(pk=attached.pk, status=SyncJob.STATUS_QUEUED).update(**fields):
+            continue
+        metrics.SYNC_JOBS.labels(status).inc()
+        try:
+            send_confirmation(queue_url=attached.queue_url, state=attached.state,
+                              is_success=status == SyncJob.STATUS_SUCCEEDED, reason=confirmation_reason)
+        except Exception as e:
+            logger.exception('Confirmation of attached job {0} failed: {1}'.format(attached.pk, repr(e)))
+
+
+def _run_integration(job_id, ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id, state):
+    from ldap3.core.exceptions import LDAPBindError, LDAPSocketOpenError
+    from ad_service.utils.queue import get_index_dict
+
+    def on_progress(stage, done, not_done):
+        fields = dict(stage=stage or '', done=done, not_done=not_done)
+        if stage not in _JOINABLE_STAGES:
+            # requests from now on could miss changes the fetch did not see, they queue a follow-up sync instead
+            fields['flight'] = None
+        _update_job(job_id, **fields)
+
+    try:
+        logger.info('Checkpoint: Indexing labels ...')
+        for label in config.INDEX_LABEL_PROPERTY_MAP:
+            index_dict = get_index_dict(label=label, property=config.INDEX_LABEL_PROPERTY_MAP[label])
+            send_to_queue(index_dict, queue_url)
+        logger.info('Checkpoint: Indexed labels! Starting integration ...')
+        integration_class = _get_integration_class()
+        integration_class(ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id,
+                          progress_callback=on_progress).run()
+    except (LDAPBindError, LDAPSocketOpenError):
+        logger.exception('Invalid LDAP credentials ' + ad_url)
+        _update_job(job_id, status=SyncJob.STATUS_FAILED, reason='Invalid LDAP credentials!',
+                    finished_at=timezone.now())
+        metrics.SYNC_JOBS.labels(SyncJob.STATUS_FAILED).inc()
+        send_confirmation(queue_url=queue_url, state=state, is_success=False, reason='Invalid LDAP credentials!')
+        _finish_attached_jobs(job_id, SyncJob.STATUS_FAILED, 'Invalid LDAP credentials!', 'Invalid LDAP credentials!')
+        return
+    except Exception as e:
+        logger.exception('sent confirmation to queue success=False ' + repr(e))
+        _update_job(job_id, status=SyncJob.STATUS_FAILED, reason=repr(e), finished_at=timezone.now())
+        metrics.SYNC_JOBS.labels(SyncJob.STATUS_FAILED).inc()
+        send_confirmation(queue_url=queue_url, state=state, is_success=False,
+                          reason='Internal Server Error! Please try again!')
+        _finish_attached_jobs(job_id, SyncJob.STATUS_FAILED, repr(e), 'Internal Server Error! Please try again!')
+        return
+
+    _update_job(job_id, status=SyncJob.STATUS_SUCCEEDED, stage='done', finished_at=timezone.now())
+    metrics.SYNC_JOBS.labels(SyncJob.STATUS_SUCCEEDED).inc()
+    send_confirmation(queue_url=queue_url, state=state, is_success=True)
+    logger.info('sent confirmation to queue success=True')
+    _finish_attached_jobs(job_id, SyncJob.STATUS_SUCCEEDED)
@@ -0,0 +1,150 @@
+"""
+Normalization of ldap search results into ADProfile payloads.
+Works on the attribute dicts of the raw search response (conn.response) so that no ldap3 Entry objects are built,
+the attributes read are looked up once per entry from a precompiled tuple.
+Pages can also be normalized by the worker processes of a transform pool, see normalize_page.
+"""
+from ad_service.ad_integration.fingerprints import get_fingerprint
+from ad_service.ad_integration.records import MemberRecord
+from ad_service.utils import config
+from ad_service.utils.time import timestamp_to_integer
+
+# attributes read from every entry, looked up with dict.get in this order
+NORMALIZED_ATTRIBUTES = tuple(config.AD_SYNC_ATTRIBUTES)
+_LOWERCASE_ATTRIBUTES = tuple(key.lower() for key in NORMALIZED_ATTRIBUTES)
+
+
+def get_attribute_values(attributes):
+    """
+    :param attributes: attributes of one entry, as in the `attributes` of a raw search response item
+    :return: {attribute: value} of NORMALIZED_ATTRIBUTES, '' for the ones not set.
+        Like ldap3's Attribute.value a single value is unwrapped from its list.
+    """
+    return _get_values(attributes.get, NORMALIZED_ATTRIBUTES)
+
+
+def get_plain_attribute_values(attributes):
+    """
+    get_attribute_values of a plain dict whose keys are in the case AD returned them, as handed to transform workers
+    """
+    return _get_values({key.lower(): value for key, value in attributes.items()}.get, _LOWERCASE_ATTRIBUTES)
+
+
+def _get_values(get, lookup_keys):
+    values = {}
+    for key, lookup_key in zip(NORMALIZED_ATTRIBUTES, lookup_keys):
+        value = get(lookup_key)
+        if type(value) is list:
+            # requested attributes that are not set on the entry come back as empty lists
+            value = value[0] if len(value) == 1 else value or None
+        values[key] = '' if value is None else value
+    return values
+
+
+def fill_name_if_blank(ad_first_name, ad_last_name, name):
+    if ad_first_name == '':
+        if name != '':
+            ad_first_name = name.split()[0]
+    if ad_last_name == '':
+        if name != '':
+            ad_last_name = ' '.join(name.split()[1:])
+    return ad_first_name, ad_last_name
+
+
+def get_location(city, country):
+    if country != '' and city != '':
+        location = city + ', ' + country
+    elif country != '':
+        location = country
+    else:
+        location = city
+    return location
+
+
+def get_direct_reports(value):
+    if value == '':
+        return ''
+    if type(value) == str:
+        return [value]
+    return list(value)
+
+
+def normalize(values, now, keys_to_track):
+    """
+    Member data of one user, None when the user is skipped (no email, or digits in the name)
+    :param values: attribute values as returned by get_attribute_values
+    :param now: milliseconds since epoch, read once for a whole page
+    :param keys_to_track: profile fields whose update time is set to now
+    """
+    ad_email = values[config.AD_EMAIL]
+    if ad_email == '':
+        return None
+    ad_email = ad_email.lower()
+
+    ad_first_name, ad_last_name = fill_name_if_blank(values[config.AD_FIRST_NAME], values[config.AD_LAST_NAME],
+                                                     values[config.AD_NAME])
+    if ad_last_name == '' or any(map(str.isdigit, ad_last_name)) or any(map(str.isdigit, ad_first_name)):
+        return None
+
+    member_data = {
+        'first_name': ad_first_name.strip(),
+        'last_name': ad_last_name.strip(),
+        config.AD_PROFILE_PRIMARY_KEY: ad_email.strip(),
+        'ad_principle_name': values[config.AD_PRINCIPAL_NAME],
+        'ad_username': values[config.AD_USERNAME],
+        'title': values[config.AD_TITLE],
+        'ad_distinguished_name': values[config.AD_DISTINGUISHED_NAME],
+        'ad_guid': values[config.AD_GUID],
+        'company': values[config.AD_COMPANY],
+        'phone': values[config.AD_PHONE_NUMBER],
+        'personal_website': values[config.AD_PERSONAL_WEBSITE],
+        'location': get_location(values[config.AD_CITY], values[config.AD_COUNTRY]),
+        'division': values[config.AD_DIVISION],
+        'department': values[config.AD_DEPARTMENT],
+        'direct_reports': get_direct_reports(values[config.AD_DIRECT_REPORTS]),
+        'manager': values[config.AD_MANAGER],
+        'last_update_time': now,
+        'data_source': config.DATA_SOURCE,
+        'created_at': timestamp_to_integer(values[config.AD_WHEN_CREATED]),
+    }
+    for key in keys_to_track:
+        member_data[key + '_update_time'] = now
+    return member_data
+
+
+def get_plain_entries(response):
+    """
+    Attributes of the entries of a raw search response page as plain dicts, cheap to send to a transform worker
+    """
+    entries = []
+    for item in response:
+        # search continuation references carry no attributes
+        if item.get('type') == 'searchResEntry':
+            attributes = item['attributes']
+            # ldap3's CaseInsensitiveDict keeps the attributes in a plain dict, pickling that one costs half
+            entries.append(getattr(attributes, '_store', attributes))
+    return entries
+
+
+def normalize_page(entries, now, keys_to_track, group_id=None):
+    """
+    Normalize the entries of one page, run by the worker processes of the transform pool
+    :param entries: plain attribute dicts of the entries, as returned by get_plain_entries
+    :param now: milliseconds since epoch, the update time of the page
+    :param keys_to_track: profile fields whose update time is set to now
+    :param group_id: when given, the fingerprint of every user is computed as well
+    :return: ([(when_created, MemberRecord, fingerprint)], number of users skipped), fingerprints are None without
+        group_id. Records unpickle at about half the cost of building them from member data dicts.
+    """
+    users = []
+    skipped = 0
+    for attributes in entries:
+        values = get_plain_attribute_values(attributes)
+        member_data = normalize(values, now, keys_to_track)
+        if member_data is None:
+            skipped += 1
+            continue
+        record = MemberRecord(**member_data)
+        fingerprint = None if group_id is None else get_fingerprint(group_id, record)
+        users.append((values[config.AD_WHEN_CREATED], record, fingerprint))
+    return users, skipped
@@ -1,16 +1,37 @@
 import time
-from py2neo import Graph
-from ldap3 import Server, Connection, ALL, SUBTREE
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from itertools import chain, islice
+from queue import Queue, Empty, Full
+from time import perf_counter
+from ldap3 import BASE, SUBTREE, LEVEL
 
-from ad_service.utils import config
+from ad_service.ad_integration.fingerprints import FingerprintStore
+from ad_service.ad_integration.groups import GROUP, PERSON, MemberResolver, get_group, get_guid, get_member_range, \
+    get_range_attribute
+from ad_service.ad_integration import normalize
+from ad_service.ad_integration.hierarchy import OrgHierarchy
+from ad_service.ad_integration.outbox import Outbox
+from ad_service.ad_integration.records import MemberRecord, MemberRecordStore, TRACKED_KEYS
+from ad_service.utils import config, metrics
+from ad_service.utils.ldap import AdaptivePageSize, get_connection_manager, get_response_size, manual_range
 from ad_service.utils.queue import *
 import ad_service.utils.graph as graph
 import ad_service.utils.time as time
 from ad_service.utils.time import get_milliseconds_since_epoch, time_now_in_ad_format
 
+PAGED_RESULTS_CONTROL = '1.2.840.113556.1.4.319'
+
+# marks the end of the ldap pages handed over by the fetch thread in streaming mode
+_END_OF_PAGES = object()
 
 class ADIntegration:
-    def __init__(self, ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id):
+    def __init__(self, ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id,
+                 streaming=None, extra_attributes=None, progress_callback=None, skip_unchanged=None,
+                 partitioned=None, batch_envelope=None, outbox=None, usn_incremental=None, transform_processes=None,
+                 sync_groups=None, full_resend=None):
         """
         :param ad_url: Active-Directory LDAP Url
         :param ad_username: Active-Directory admin username
@@ -18,305 +39,928 @@ class ADIntegration:
         :param ad_search_base: Active-Directory search base (eg.: DC=devfactory,DC=xyz)
         :param graph_url: Company workgraph url
         :param queue_url: Company queue url corresponding to workgraph
+        :param streaming: Publish every ldap page as soon as it is fetched (defaults to config.STREAMING_SYNC)
+        :param extra_attributes: AD attributes to fetch on top of config.AD_SYNC_ATTRIBUTES
+        :param progress_callback: Called with (stage, done, not_done) whenever the sync makes progress
+        :param skip_unchanged: Only publish profiles that changed since they were last published
+            (defaults to config.FINGERPRINT_SKIP_UNCHANGED). Fingerprints are refreshed either way.
+        :param partitioned: Split the search by child OUs or sAMAccountName ranges and fetch the partitions
+            concurrently (defaults to config.LDAP_PARTITIONED_FETCH)
+        :param batch_envelope: Send the node and relation events of a chunk in one BATCH event
+            (defaults to config.QUEUE_BATCH_ENVELOPE)
+        :param outbox: Persist the events before publishing them and resume the publishing of a failed sync
+            (defaults to config.SYNC_OUTBOX, not used by streaming syncs)
+        :param usn_incremental: Fetch the changes since the USN watermark of the last sync
+            (defaults to config.AD_USN_INCREMENTAL)
+        :param transform_processes: Normalize and fingerprint the fetched pages in a pool of this many processes,
+            0 does it on the sync thread (defaults to config.TRANSFORM_PROCESSES)
+        :param sync_groups: Also send the groups under the search base and the member_of relations of their
+            members (defaults to config.AD_SYNC_GROUPS)
+        :param full_resend: Fetch and publish every profile whether it changed or not, e.g. to repair a graph that
+            lost data. None does it when config.FINGERPRINT_FULL_RESEND_INTERVAL passed since the last full re-send
         """
         self.ad_url = ad_url
         self.ad_username = ad_username
         self.ad_password = ad_password
         self.ad_search_base = ad_search_base
-        self.pagination_size = config.PAGINATION_SIZE  # Number of records to fetch per ldap request
+        self.pagination_size = config.PAGINATION_SIZE  # Number of records to fetch by the first ldap request
+        # AdaptivePageSize shared by the searches of the sync, created once the DC's limit is known
+        self.page_size = None
+        self._page_size_lock = threading.Lock()
+        self.search_attributes = self._get_search_attributes(extra_attributes)
 
-        self.graph = Graph(graph_url)
+        self.graph = graph.get_graph(graph_url)
         self.queue_url = queue_url
+        self.chunk_size = AdaptiveChunkSize()
+        self.publisher = QueuePublisher(queue_url, chunk_size=self.chunk_size)
         self.logger = config.LOGGER
         self.group_id = group_id
 
         self.done = 0
         self.not_done = 0
-        self.data_to_send = []
-        self.unique_email_tracker = {}
-        self.keys_to_track = ['title', 'phone', 'location', 'department']
+        self.unchanged = 0
+        self.stage = None
+        self.stage_started_at = None
+        self.progress_callback = progress_callback
+        self.data_to_send = MemberRecordStore()
+        # managers of every person of the sync, kept when the records are dropped
+        self.hierarchy = OrgHierarchy()
+        # {email: DN of the previous manager} of the people whose manager changed since they were last published
+        self.previous_manager_dns = {}
+        self.keys_to_track = list(TRACKED_KEYS)
 
-    @staticmethod
-    def _fill_name_if_blank(ad_first_name, ad_last_name, name):
-        if ad_first_name == '':
-            if name != '':
-                ad_first_name = name.split()[0]
-        if ad_last_name == '':
-            if name != '':
-                ad_last_name = ' '.join(name.split()[1:])
-        return ad_first_name, ad_last_name
+        self.streaming = config.STREAMING_SYNC if streaming is None else streaming
+        self.max_buffered_pages = config.STREAMING_MAX_BUFFERED_PAGES
+        self.page_number = 0
+        self.partitioned = config.LDAP_PARTITIONED_FETCH if partitioned is None else partitioned
 
-    @staticmethod
-    def _get_location(city, country):
-        if country != '' and city != '':
-            location = city + ', ' + country
-        elif country != '':
-            location = country
-        else:
-            location = city
-        return location
+        self.batch_envelope = config.QUEUE_BATCH_ENVELOPE if batch_envelope is None else batch_envelope
+        self.skip_unchanged = config.FINGERPRINT_SKIP_UNCHANGED if skip_unchanged is None else skip_unchanged
+        self.fingerprints = None
+        self.full_resend = full_resend
+        # set once the search fetches everything for a full re-send, a sync resuming its outbox does not search
+        self.resent_everything = False
+        self.use_outbox = config.SYNC_OUTBOX if outbox is None else outbox
+        self.outbox = None
+        self.usn_incremental = config.AD_USN_INCREMENTAL if usn_incremental is None else usn_incremental
+        self.usn_state = None
+        # set when the search only fetches the changes since the last sync, with the filter of those changes and the
+        # whenChanged one used on connections bound to another DC than the one of the uSNChanged filter
+        self.incremental = False
+        self.changed_filter = None
+        self.when_changed_filter = None
+
+        self.sync_groups = config.AD_SYNC_GROUPS if sync_groups is None else sync_groups
+        # member DNs of the groups resolved to the people and groups of the sync
+        self.members = MemberResolver(self.hierarchy)
+        self.group_page_size = None
+
+        self.transform_processes = config.TRANSFORM_PROCESSES if transform_processes is None else transform_processes
+        self.max_transforming_pages = config.TRANSFORM_MAX_PENDING_PAGES or 2 * self.transform_processes
+        # fingerprints computed by the transform workers, of the records still to be checked for changes
+        self.transformed_fingerprints = {}
+
+    def _report_progress(self):
+        if self.progress_callback is not None:
+            self.progress_callback(self.stage, self.done, self.not_done)
+
+    def _set_stage(self, stage):
+        self._observe_stage_time()
+        self.stage = stage
+        self.stage_started_at = perf_counter()
+        self._report_progress()
+
+    def _observe_stage_time(self):
+        if self.stage is not None:
+            metrics.SYNC_STAGE_SECONDS.labels(self.stage).observe(perf_counter() - self.stage_started_at)
 
     @staticmethod
-    def _get_direct_reports(direct_reports_key, entry):
-        if direct_reports_key in entry.keys():
-            if type(entry[direct_reports_key].value) == str:
-                direct_reports = [entry[direct_reports_key].value]
-            else:
-                direct_reports = list(entry[direct_reports_key].value)
-        else:
-            direct_reports = ''
-        return direct_reports
+    def _get_search_attributes(extra_attributes=None):
+        """
+        Attributes requested from AD: the ones _populate reads plus any opted-in extras
+        """
+        search_attributes = list(config.AD_SYNC_ATTRIBUTES)
+        requested = set(attribute.lower() for attribute in search_attributes)
+        for attribute in list(config.AD_EXTRA_ATTRIBUTES) + list(extra_attributes or []):
+            # ldap attribute names are case insensitive
+            if attribute.lower() not in requested:
+                search_attributes.append(attribute)
+                requested.add(attribute.lower())
+        return search_attributes
+
+    _fill_name_if_blank = staticmethod(normalize.fill_name_if_blank)
+    _get_location = staticmethod(normalize.get_location)
 
     def _populate(self, entry):
         """
         Take AD user data, parse it and populate data_to_send keeping email unique
-        :param entry: AD user data
+        :param entry: AD user data, {attribute: object holding its value in .value} like the __dict__ of an ldap3 Entry
         """
-        def check(ad_key):
-            return '' if ad_key not in entry.keys() else entry[ad_key].value
+        attributes = {key: entry[key].value for key in normalize.NORMALIZED_ATTRIBUTES if key in entry}
+        self._populate_attributes(attributes, get_milliseconds_since_epoch())
 
-        ad_distinguished_name = check(config.AD_DISTINGUISHED_NAME)
+    def _populate_page(self, response):
+        """
+        Populate data_to_send with the users of one page of a raw search response, reading the clock once
+        :param response: conn.response of the page
+        """
+        now = get_milliseconds_since_epoch()
+        for item in response:
+            # search continuation references carry no attributes
+            if item.get('type') == 'searchResEntry':
+                self._populate_attributes(item['attributes'], now)
 
-        try:
-            ad_email = entry[config.AD_EMAIL].value.lower()
-        except KeyError:
+    def _populate_attributes(self, attributes, now):
+        values = normalize.get_attribute_values(attributes)
+        member_data = normalize.normalize(values, now, self.keys_to_track)
+        if member_data is None:
             self.not_done += 1
             return
+        self._populate_keeping_email_unique(member_data[config.AD_PROFILE_PRIMARY_KEY],
+                                            values[config.AD_WHEN_CREATED], member_data)
 
-        ad_first_name = check(config.AD_FIRST_NAME)
-        ad_last_name = check(config.AD_LAST_NAME)
-        name = check(config.AD_NAME)
+    def _populate_keeping_email_unique(self, ad_email, when_created, member_data):
+        self._add_record(ad_email, when_created, MemberRecord(**member_data))
 
-        ad_first_name, ad_last_name = self._fill_name_if_blank(ad_first_name, ad_last_name, name)
+    def _add_record(self, ad_email, when_created, record):
+        # a record of an already published page is overwritten by sending the earlier created one again
+        if self.data_to_send.add(ad_email, when_created, record):
+            self.hierarchy.add(ad_email, record.ad_distinguished_name, record.manager)
+            self.done += 1
+            return True
+        return False
 
-        if ad_last_name == '' or any(char.isdigit() for char in ad_last_name) or \
-                any(char.isdigit() for char in ad_first_name):
-            self.not_done += 1
-            return
+    def _merge_transformed_page(self, page):
+        """
+        Populate data_to_send with a page normalized by normalize.normalize_page. Pages are merged in the order
+        they were fetched, so emails are kept unique across pages like when they are normalized on the sync thread.
+        """
+        users, skipped = page
+        self.not_done += skipped
+        for when_created, record, fingerprint in users:
+            ad_email = record[config.AD_PROFILE_PRIMARY_KEY]
+            if self._add_record(ad_email, when_created, record) and fingerprint is not None:
+                self.transformed_fingerprints[ad_email] = fingerprint
 
-        ad_title = check(config.AD_TITLE)
-        ad_username = check(config.AD_USERNAME)
-        ad_principle_name = check(config.AD_PRINCIPAL_NAME)
-        ad_guid = check(config.AD_GUID)
-        ad_company = check(config.AD_COMPANY)
-        ad_phone_number = check(config.AD_PHONE_NUMBER)
-        ad_personal_website = check(config.AD_PERSONAL_WEBSITE)
-        division = check(config.AD_DIVISION)
-        department = check(config.AD_DEPARTMENT)
-        manager = check(config.AD_MANAGER)
-        data_source = config.DATA_SOURCE
-
-        country = check(config.AD_COUNTRY)
-        city = check(config.AD_CITY)
-        location = self._get_location(city, country)
-        created_at = time.timestamp_to_integer(check(config.AD_WHEN_CREATED))
-
-        direct_reports = self._get_direct_reports(config.AD_DIRECT_REPORTS, entry)
-        member_type = "Individual Contributor"
-        if len(direct_reports) > 0:
-            member_type = "People Managers"
-
-        member_data = {
-            'first_name': ad_first_name.strip(),
-            'last_name': ad_last_name.strip(),
-            'primary_email': ad_email.strip(),
-            'ad_principle_name': ad_principle_name,
-            'ad_username': ad_username,
-            'title': ad_title,
-            'ad_distinguished_name': ad_distinguished_name,
-            'ad_guid': ad_guid,
-            'company': ad_company,
-            'phone': ad_phone_number,
-            'personal_website': ad_personal_website,
-            'location': location,
-            'division': division,
-            'department': department,
-            'direct_reports': direct_reports,
-            'manager': manager,
-            'last_update_time': get_milliseconds_since_epoch(),
-            'data_source': data_source,
-            'created_at': created_at
-        }
+    @staticmethod
+    def _get_transform_context():
+        """
+        multiprocessing context of the transform pool, the workers only take plain data so they need not be forked
+        """
+        start_method = config.TRANSFORM_START_METHOD or 'forkserver'
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = 'spawn'
+        context = multiprocessing.get_context(start_method)
+        if config.TRANSFORM_PYTHON_EXECUTABLE and start_method != 'fork':
+            context.set_executable(config.TRANSFORM_PYTHON_EXECUTABLE)
+        return context
 
-        for key in self.keys_to_track:
-            member_data[key +'_update_time'] = get_milliseconds_since_epoch()
+    def _populate_pages(self, pages):
+        """
+        Populate data_to_send page by page, yielding after each page.
+        With transform_processes the pages are normalized and fingerprinted by a process pool, up to
+        max_transforming_pages of them while the sync thread fetches and merges the next ones.
+        """
+        if not self.transform_processes:
+            for page in pages:
+                self._populate_page(page)
+                yield
+            return
 
-        self._populate_keeping_email_unique(ad_email, entry, member_data)
+        pending = deque()
+        context = self._get_transform_context()
+        with ProcessPoolExecutor(self.transform_processes, mp_context=context) as executor:
+            try:
+                for page in pages:
+                    pending.append(executor.submit(normalize.normalize_page, normalize.get_plain_entries(page),
+                                                   get_milliseconds_since_epoch(), self.keys_to_track,
+                                                   self.group_id if self.skip_unchanged else None))
+                    while len(pending) >= self.max_transforming_pages or pending and pending[0].done():
+                        self._merge_transformed_page(pending.popleft().result())
+                        yield
+                while pending:
+                    self._merge_transformed_page(pending.popleft().result())
+                    yield
+            finally:
+                for future in pending:
+                    future.cancel()
 
-    def _populate_keeping_email_unique(self, ad_email, entry, member_data):
-        if ad_email in self.unique_email_tracker:
-            # if multiple entries found for same email keep the earliest created record
-            # (to ignore groups that get created with same email)
-            if entry[config.AD_WHEN_CREATED].value < self.unique_email_tracker[ad_email]['created_at']:
-                idx = self.unique_email_tracker[ad_email]['entry_idx']
-                del self.data_to_send[idx]
-                self.data_to_send.append(member_data)
-                self.done += 1
-        else:
-            self.data_to_send.append(member_data)
-            self.done += 1
-            self.unique_email_tracker[ad_email] = {
-                'created_at': entry[config.AD_WHEN_CREATED].value,
-                'entry_idx': len(self.data_to_send) - 1
-            }
+    @staticmethod
+    def _get_usn_state(conn):
+        """
+        :return: highestCommittedUSN of the DC the connection is bound to and the identity of that DC, its NTDS
+            settings DN and invocationId (which changes when the DC database is restored).
+            None when the server does not expose USNs.
+        """
+        # a pooled connection may have been bound a while ago, the root DSE holds the current USN
+        conn.refresh_server_info()
+        root_dse = conn.server.info.other if conn.server.info is not None else {}
+        if not root_dse.get('highestCommittedUSN') or not root_dse.get('dsServiceName'):
+            return None
+        ds_service_name = root_dse['dsServiceName'][0]
+        conn.search(ds_service_name, '(objectClass=*)', BASE, attributes=['invocationId'])
+        invocation_id = str(conn.entries[0].invocationId.value) if conn.entries and 'invocationId' in conn.entries[0] \
+            else ''
+        return {
+            config.AD_INSTANCE_USN_WATERMARK: int(root_dse['highestCommittedUSN'][0]),
+            config.AD_INSTANCE_DC_SERVICE_NAME: ds_service_name,
+            config.AD_INSTANCE_DC_INVOCATION_ID: invocation_id,
+        }
 
-    def _get_ldap_data(self):
-        server = Server(self.ad_url, get_info=ALL)
-        conn = Connection(server, self.ad_username, self.ad_password, auto_bind=True)
-        logger.info("Starting ldap data fetch for AD_URL : " + self.ad_url)
+    def _get_changed_filter(self, conn):
+        """
+        Filter of the changes since the last sync for a search on the given connection. An ad_url that resolves to
+        several DCs may have bound the connection to another DC than the one whose USN watermark the uSNChanged
+        filter compares to, USNs mean nothing there: such a connection gets the whenChanged filter.
+        :return: None when everything has to be fetched
+        """
+        if self.when_changed_filter == self.changed_filter:
+            return self.changed_filter
+        usn_state = self._get_usn_state(conn)
+        if usn_state is not None and all(usn_state[key] == self.usn_state[key] for key in
+                                         (config.AD_INSTANCE_DC_SERVICE_NAME, config.AD_INSTANCE_DC_INVOCATION_ID)):
+            return self.changed_filter
+        logger.info('Connection to AD_URL: {0} is bound to another DC than {1}, filtering on whenChanged'.format(
+            self.ad_url, self.usn_state[config.AD_INSTANCE_DC_SERVICE_NAME]))
+        return self.when_changed_filter
 
+    def _get_search_filter(self, conn):
+        """
+        Filter of the objects changed since the last sync: the ones whose uSNChanged is past the USN watermark of
+        the last sync, read from the DC the connection is bound to, so that no clock is involved.
+        A sync against another DC (or a restored one) fetches everything, USNs are local to a DC.
+        Servers without USNs and instances last synced without a watermark use whenChanged >= lastFetchTime.
+        """
         default_search_filter = config.AD_SEARCH_FILTER
-        last_fetch_time = graph.get_ldap_last_fetch_time(self.graph, self.ad_url)
-        logger.info("LDAP last_fetch_time: {0}".format(last_fetch_time))
+        ad_instance = graph.get_ad_instance(self.graph, self.ad_url)
+        if self.usn_incremental:
+            self.usn_state = self._get_usn_state(conn)
+        if self.full_resend:
+            logger.info('Full re-send of AD_URL: {0}, fetching everything'.format(self.ad_url))
+            self.resent_everything = True
+            return default_search_filter
+        last_fetch_time = ad_instance.get(config.AD_INSTANCE_LAST_FETCH_TIME)
+        if last_fetch_time is not None:
+            self.when_changed_filter = '(whenChanged>=' + last_fetch_time + ')'
+
+        if self.usn_state is not None and ad_instance.get(config.AD_INSTANCE_USN_WATERMARK) is not None:
+            same_dc = all(ad_instance.get(key) == self.usn_state[key] for key in
+                          (config.AD_INSTANCE_DC_SERVICE_NAME, config.AD_INSTANCE_DC_INVOCATION_ID))
+            if not same_dc:
+                logger.info('DC of AD_URL: {0} changed to {1}, fetching everything'.format(
+                    self.ad_url, self.usn_state[config.AD_INSTANCE_DC_SERVICE_NAME]))
+                return default_search_filter
+            watermark = ad_instance[config.AD_INSTANCE_USN_WATERMARK]
+            logger.info("LDAP usn watermark: {0}".format(watermark))
+            self.incremental = True
+            self.changed_filter = '(uSNChanged>={0})'.format(watermark + 1)
+            return '(&' + self.changed_filter + default_search_filter + ')'
 
+        logger.info("LDAP last_fetch_time: {0}".format(last_fetch_time))
         if last_fetch_time is not None:
-            search_filter = '(&(whenChanged>=' + last_fetch_time + ')' + default_search_filter + ')'
-        else:
-            search_filter = default_search_filter
+            self.incremental = True
+            self.changed_filter = self.when_changed_filter
+            return '(&' + self.changed_filter + default_search_filter + ')'
+        return default_search_filter
 
-        conn.search(search_base=self.ad_search_base,
-                    search_filter=search_filter,
-                    search_scope=SUBTREE,
-                    attributes=['*'],
-                    paged_size=self.pagination_size)
+    def _connection(self):
+        """
+        Pooled connection bound as the integration's admin, shared with the other syncs and credential checks
+        of the process (context manager)
+        """
+        return get_connection_manager().connection(self.ad_url, self.ad_username, self.ad_password)
+
+    def _get_page_size(self, conn):
+        with self._page_size_lock:
+            if self.page_size is None:
+                max_page_size = get_connection_manager().get_max_page_size(self.ad_url, conn)
+                logger.info('MaxPageSize of AD_URL: {0} is {1}'.format(self.ad_url, max_page_size))
+                self.page_size = AdaptivePageSize(self.pagination_size,
+                                                  maximum=min(max_page_size or self.pagination_size,
+                                                              config.LDAP_MAX_PAGE_SIZE))
+            return self.page_size
+
+    def _get_group_page_size(self, conn):
+        with self._page_size_lock:
+            if self.group_page_size is None:
+                max_page_size = get_connection_manager().get_max_page_size(self.ad_url, conn)
+                self.group_page_size = AdaptivePageSize(config.AD_GROUP_PAGE_SIZE,
+                                                        maximum=min(max_page_size or config.AD_GROUP_PAGE_SIZE,
+                                                                    config.LDAP_MAX_PAGE_SIZE))
+            return self.group_page_size
 
-        entries = conn.entries
-        for entry in entries:
-            self._populate(entry.__dict__)
+    def _get_group_search_filter(self, conn):
+        """
+        Groups under the search base, only the ones changed since the last sync when the people search is
+        incremental: adding or removing a member changes the group, not the member
+        """
+        changed_filter = self._get_changed_filter(conn) if self.incremental else None
+        if changed_filter is not None:
+            return '(&' + changed_filter + config.AD_GROUP_SEARCH_FILTER + ')'
+        return config.AD_GROUP_SEARCH_FILTER
 
-        logger.info(
-            'Done : ' + str(self.done) + " || Not Done : " + str(self.not_done) + " for AD_URL: " + self.ad_url)
+    def _throttle(self):
+        rate_limit = get_connection_manager().get_rate_limit(self.ad_url)
+        if rate_limit is not None:
+            metrics.LDAP_THROTTLED_SECONDS.inc(rate_limit.acquire())
 
-        cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-        while cookie:
-            conn.search(search_base=self.ad_search_base,
+    def _iter_ldap_pages(self, conn=None, search_base=None, search_scope=SUBTREE, search_filter=None,
+                         attributes=None, page_size=None):
+        """
+        Run the paged ldap search and yield the raw response (conn.response) of one page at a time,
+        no ldap3 Entry objects are built.
+        Every page is requested with the current size of the sync's AdaptivePageSize, and waits for the request
+        rate limit of the url when there is one.
+        :param attributes: attributes to fetch, defaults to the ones of the people
+        :param page_size: AdaptivePageSize of the search, defaults to the one of the people searches
+        """
+        if conn is None:
+            with self._connection() as conn:
+                yield from self._iter_ldap_pages(conn, search_base, search_scope, search_filter, attributes,
+                                                 page_size)
+            return
+        logger.info("Starting ldap data fetch for AD_URL : " + self.ad_url)
+
+        search_base = search_base or self.ad_search_base
+        search_filter = search_filter or self._get_search_filter(conn)
+        page_size = page_size or self._get_page_size(conn)
+        cookie = None
+        while True:
+            self._throttle()
+            size = page_size()
+            start = perf_counter()
+            conn.search(search_base=search_base,
                         search_filter=search_filter,
-                        search_scope=SUBTREE,
-                        attributes=['*'],
-                        paged_size=self.pagination_size,
+                        search_scope=search_scope,
+                        attributes=attributes or self.search_attributes,
+                        paged_size=size,
                         paged_cookie=cookie)
-            cookie = conn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
+            latency = perf_counter() - start
+            response = conn.response
+            entries = sum(1 for item in response if item.get('type') == 'searchResEntry')
+            page_size.record(latency, entries, get_response_size(response))
+            metrics.LDAP_PAGE_SECONDS.observe(latency)
+            metrics.LDAP_PAGE_SIZE.observe(size)
+            metrics.LDAP_PAGE_ENTRIES.observe(entries)
+            cookie = conn.result['controls'][PAGED_RESULTS_CONTROL]['value']['cookie']
 
-            entries = conn.entries
-            for entry in entries:
-                self._populate(entry.__dict__)
+            # every search sets a new response list, the page stays as it is while the next one is fetched
+            yield response
+
+            if not cookie:
+                break
+
+        logger.info("Finished ldap data fetch for AD_URL : " + self.ad_url + " search base: " + search_base)
+
+    def _get_ldap_data(self):
+        pages = self._stream_ldap_pages() if self.partitioned else self._iter_ldap_pages()
+        for _ in self._populate_pages(pages):
+            self._report_progress()
 
             logger.info(
                 'Done : ' + str(self.done) + " || Not Done : " + str(self.not_done) + " for AD_URL: " + self.ad_url)
 
-        logger.info("Finished ldap data fetch for AD_URL : " + self.ad_url)
-
-    def _populate_user_ad_profile_relations(self):
-        user_ad_profile_relation_data = []
-        for data in self.data_to_send:
-            user_ad_profile_relation_data.append(
-                get_relation_data_dict(to_key_value=data[config.AD_PROFILE_PRIMARY_KEY],
-                                       from_key_value=data[config.PERSON_PRIMARY_KEY],
-                                       properties={
-                                        'performed_at': data['created_at']
-                                       }))
-        chunks = [user_ad_profile_relation_data[i:i + config.QUEUE_CHUNK_SIZE] for i in
-                  range(0, len(user_ad_profile_relation_data), config.QUEUE_CHUNK_SIZE)]
-        for chunk in chunks:
-            user_ad_profile_relation_dict = get_relation_dict(to_primary_key_name=config.AD_PROFILE_PRIMARY_KEY,
-                                                              to_labels=config.AD_PROFILE_LABELS,
-                                                              from_labels=config.PERSON_LABELS,
-                                                              from_primary_key_name=config.PERSON_PRIMARY_KEY,
-                                                              relationship_type=config.PERSON_AD_PROFILE_RELATION,
-                                                              data=chunk)
-            send_to_queue(user_ad_profile_relation_dict, self.queue_url)
+    def _get_prefix_partitions(self, search_filter):
+        boundaries = config.LDAP_PARTITION_PREFIX_BOUNDARIES
+        partitions = []
+        for i in range(len(boundaries) + 1):
+            conditions = []
+            if i > 0:
+                conditions.append('({0}>={1})'.format(config.AD_USERNAME, boundaries[i - 1]))
+            if i < len(boundaries):
+                conditions.append('(!({0}>={1}))'.format(config.AD_USERNAME, boundaries[i]))
+            partitions.append((self.ad_search_base, SUBTREE, '(&' + ''.join(conditions) + search_filter + ')'))
+        return partitions
 
-    @staticmethod
-    def _get_milliseconds_since_epoch():
-        return time.get_milliseconds_since_epoch()
+    def _get_partitions(self, conn, search_filter):
+        """
+        Split the search into (search_base, search_scope, search_filter) partitions covering the whole search base:
+        the entries right under the search base plus one subtree per child that is not a person (OUs, containers
+        and the like), or sAMAccountName ranges if there are fewer than two such children or
+        config.LDAP_PARTITION_BY is 'prefix'
+        """
+        if config.LDAP_PARTITION_BY == 'ou':
+            # paged like the user searches, a search base with more children than MaxPageSize would lose some
+            pages = self._iter_ldap_pages(conn, self.ad_search_base, LEVEL, config.AD_PARTITION_OU_FILTER,
+                                          attributes=[config.AD_DISTINGUISHED_NAME])
+            child_dns = [item['dn'] for response in pages for item in response
+                         if item.get('type') == 'searchResEntry']
+            if len(child_dns) >= 2:
+                return [(self.ad_search_base, LEVEL, search_filter)] + \
+                       [(child_dn, SUBTREE, search_filter) for child_dn in child_dns]
+            logger.info('Less than 2 child containers under {0}, partitioning by {1} instead'.format(
+                self.ad_search_base, config.AD_USERNAME))
+        return self._get_prefix_partitions(search_filter)
 
-    def _populate_user_nodes(self):
-        user_data = []
-        for data in self.data_to_send:
-            user_data.append(
-                {
-                    config.PERSON_PRIMARY_KEY: data[config.PERSON_PRIMARY_KEY],
-                    "first_name": data["first_name"],
-                    "last_name": data["last_name"],
-                    'created_at': data['created_at'],
-                    'data_source': config.DATA_SOURCE
-                })
-        chunks = [user_data[i:i + config.QUEUE_CHUNK_SIZE] for i in range(0, len(user_data), config.QUEUE_CHUNK_SIZE)]
-        for chunk in chunks:
-            user_node_dict = get_node_dict(labels=config.PERSON_LABELS,
-                                           primary_key_name=config.PERSON_PRIMARY_KEY,
-                                           data=chunk)
-            send_to_queue(user_node_dict, self.queue_url)
+    def _fetch_partition(self, partition, hand_over, cancelled):
+        search_base, search_scope, partition_filter = partition
+        with self._connection() as conn:
+            if self.incremental:
+                # the partition filters wrap the search filter, which holds the changed filter once
+                partition_filter = partition_filter.replace(self.changed_filter, self._get_changed_filter(conn) or '')
+            for response in self._iter_ldap_pages(conn, search_base, search_scope, partition_filter):
+                hand_over(response)
+                if cancelled.is_set():
+                    return
 
-    def _populate_ad_profile_nodes(self):
-        chunks = [self.data_to_send[i:i + config.QUEUE_CHUNK_SIZE] for i in range(0, len(self.data_to_send), config.QUEUE_CHUNK_SIZE)]
-        for chunk in chunks:
-            ad_node_dict = get_node_dict(labels=config.AD_PROFILE_LABELS,
-                                         primary_key_name=config.AD_PROFILE_PRIMARY_KEY,
-                                         data=chunk)
+    def _fetch_partitions(self, hand_over, stop):
+        """
+        Fetch all partitions concurrently, over at most config.LDAP_MAX_CONNECTIONS_PER_SERVER pooled connections
+        to the AD server per process, handing their pages over as they come
+        """
+        with self._connection() as conn:
+            search_filter = self._get_search_filter(conn)
+            partitions = self._get_partitions(conn, search_filter)
+        logger.info('Fetching {0} partitions for AD_URL : {1}'.format(len(partitions), self.ad_url))
 
-            send_to_queue(ad_node_dict, self.queue_url)
+        # set when the consumer stopped or a partition failed
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(max_workers=min(len(partitions), config.LDAP_MAX_CONNECTIONS_PER_SERVER),
+                                thread_name_prefix='ldap-partition') as executor:
+            futures = [executor.submit(self._fetch_partition, partition, hand_over, cancelled)
+                       for partition in partitions]
+            while futures:
+                finished, futures = wait(futures, timeout=1, return_when=FIRST_EXCEPTION)
+                if stop.is_set() or any(future.exception() is not None for future in finished):
+                    cancelled.set()
+                    for future in futures:
+                        future.cancel()
+                    break
+        for future in finished:
+            if future.exception() is not None:
+                raise future.exception()
 
-    def _update_company_ad_last_fetch_time(self):
+    def _stream_ldap_pages(self):
+        """
+        Fetch ldap pages on a background thread while the caller processes the previous ones.
+        At most `max_buffered_pages` fetched pages wait in memory at any time, plus one page per
+        partition fetch when partitioned.
+        """
+        buffer = Queue(maxsize=self.max_buffered_pages)
+        stop = threading.Event()
+        errors = []
+
+        def hand_over(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=1)
+                    return
+                except Full:
+                    continue
+
+        def fetch():
+            try:
+                if self.partitioned:
+                    self._fetch_partitions(hand_over, stop)
+                    return
+                for response in self._iter_ldap_pages():
+                    hand_over(response)
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                hand_over(_END_OF_PAGES)
+
+        fetcher = threading.Thread(target=fetch, name='ldap-fetch-' + self.ad_url, daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                page = buffer.get()
+                if page is _END_OF_PAGES:
+                    break
+                yield page
+        finally:
+            stop.set()
+            # unblock the fetch thread if it is waiting on a full buffer
+            try:
+                while True:
+                    buffer.get_nowait()
+            except Empty:
+                pass
+            fetcher.join()
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _get_milliseconds_since_epoch():
+        return time.get_milliseconds_since_epoch()
+
+    def _get_ad_last_fetch_time_event(self):
         time_now = time_now_in_ad_format()
         data = [{config.AD_INSTANCE_PRIMARY_KEY: self.ad_url,
                  config.AD_INSTANCE_LAST_FETCH_TIME: time_now,
                  'dataSource': 'AD'}]
-        channels_node_dict = get_node_dict(labels=config.AD_INSTANCE_LABELS,
-                                           primary_key_name=config.AD_INSTANCE_PRIMARY_KEY,
-                                           data=data)
-        send_to_queue(channels_node_dict, self.queue_url)
+        if self.usn_state is not None:
+            # read before the search, changes made while it ran are fetched again by the next sync
+            data[0].update(self.usn_state)
+        return get_node_dict(labels=config.AD_INSTANCE_LABELS,
+                             primary_key_name=config.AD_INSTANCE_PRIMARY_KEY,
+                             data=data)
+
+    def _update_company_ad_last_fetch_time(self):
+        self.publisher.publish(self._get_ad_last_fetch_time_event())
+
+    def _skip_unchanged_records(self):
+        """
+        Drop the records whose fingerprint did not change since they were last published
+        :return: fingerprints of the remaining records, to be staged once they are published
+        """
+        fingerprints = {}
+        if self.fingerprints is None:
+            return fingerprints
+        for batch in self.data_to_send.chunks(config.GRAPH_LOOKUP_BATCH_SIZE):
+            fingerprints.update(self.fingerprints.changed(batch, self.transformed_fingerprints))
+        self.transformed_fingerprints = {}
+        if self.skip_unchanged and not self.full_resend:
+            self.unchanged += len(self.data_to_send) - len(fingerprints)
+            self.data_to_send.retain(fingerprints)
+        return fingerprints
+
+    def _stage_fingerprints(self, fingerprints):
+        if self.fingerprints is not None:
+            self.fingerprints.stage(fingerprints)
+
+    def _commit_fingerprints(self):
+        # once the profiles and their reporting lines are acknowledged, an unchanged profile does not send them again
+        if self.fingerprints is not None:
+            self.fingerprints.commit()
+
+    def _get_emails_to_send(self):
+        return [record[config.AD_PROFILE_PRIMARY_KEY] for record in self.data_to_send]
 
     def _set_last_update_time_of_changed_fields(self):
-        prev_ad_profiles = graph.get_ad_profiles(self.graph)
+        # only the profiles of this sync are looked up, batch by batch, so the cost follows the size of the delta
+        with metrics.CHANGED_FIELDS_SECONDS.time():
+            for batch in self.data_to_send.chunks(config.GRAPH_LOOKUP_BATCH_SIZE):
+                self._set_last_update_time_of_changed_fields_in_batch(batch)
+
+    def _set_last_update_time_of_changed_fields_in_batch(self, batch):
+        emails = [data[config.AD_PROFILE_PRIMARY_KEY] for data in batch]
+        prev_ad_profiles = graph.get_ad_profiles_by_emails(self.graph, emails)
 
         # to search quickly if ad profile already exists
         prev_ad_profiles_email_map = {}
         for obj in prev_ad_profiles:
             prev_ad_profiles_email_map[obj[config.AD_PROFILE_PRIMARY_KEY]] = obj
-        for data in self.data_to_send:
+        for data in batch:
             if data[config.AD_PROFILE_PRIMARY_KEY] not in prev_ad_profiles_email_map:
                 continue
             change_flag = False
             prev_ad_profile = prev_ad_profiles_email_map[data[config.AD_PROFILE_PRIMARY_KEY]]
+            if prev_ad_profile['manager'] and data['manager'] != prev_ad_profile['manager']:
+                self.previous_manager_dns[data[config.AD_PROFILE_PRIMARY_KEY]] = prev_ad_profile['manager']
             for key in self.keys_to_track:
                 if data[key] != prev_ad_profile[key]:
                     change_flag = True
                 else:
-                    data[key + 'UpdateTime'] = prev_ad_profile[key + 'UpdateTime']
+                    data[key + '_update_time'] = prev_ad_profile[key + 'UpdateTime']
             if not change_flag:
-                data['lastUpdateTime'] = prev_ad_profile['lastUpdateTime']
+                data['last_update_time'] = prev_ad_profile['lastUpdateTime']
+
+    def _get_company_node_event(self):
+        return get_node_dict(labels=config.COMPANY_LABELS,
+                             primary_key_name=config.COMPANY_PRIMARY_KEY,
+                             data=[{
+                                 config.COMPANY_PRIMARY_KEY: self.group_id,
+                                 'data_source': config.DATA_SOURCE
+                             }])
 
     def _populate_company_node(self):
         logger.info("Populating company node")
-        company_node_dict = get_node_dict(labels=config.COMPANY_LABELS,
-                                          primary_key_name=config.COMPANY_PRIMARY_KEY,
-                                          data=[{
-                                              config.COMPANY_PRIMARY_KEY: self.group_id,
-                                              'data_source': config.DATA_SOURCE
-                                          }])
-        send_to_queue(company_node_dict, self.queue_url)
-
-    def _populate_user_company_relations(self):
-        user_company_relation_data = []
-        for data in self.data_to_send:
-            user_company_relation_data.append(
-                get_relation_data_dict(to_key_value=self.group_id,
-                                       from_key_value=data[config.PERSON_PRIMARY_KEY],
-                                       properties={
-                                        'performed_at': data['created_at'],
-                                        'data_source': config.DATA_SOURCE
-                                       }))
-        chunks = [user_company_relation_data[i:i + config.QUEUE_CHUNK_SIZE] for i in
-                  range(0, len(user_company_relation_data), config.QUEUE_CHUNK_SIZE)]
-        for chunk in chunks:
-            user_company_relation_dict = get_relation_dict(to_primary_key_name=config.COMPANY_PRIMARY_KEY,
-                                                           to_labels=config.COMPANY_LABELS,
-                                                           from_labels=config.PERSON_LABELS,
-                                                           from_primary_key_name=config.PERSON_PRIMARY_KEY,
-                                                           relationship_type=config.PERSON_COMPANY_RELATION,
-                                                           data=chunk)
-            send_to_queue(user_company_relation_dict, self.queue_url)
+        self.publisher.publish(self._get_company_node_event())
+
+    def _get_chunk_events(self, chunk, nodes=True, relations=True):
+        """
+        Build the events of a chunk of records in one pass over it, nodes before the relations that need them
+        :param chunk: MemberRecords
+        :param nodes: include the ADProfile and Person node events
+        :param relations: include the Person->Company and Person->ADProfile relation events
+        """
+        ad_profiles, people, company_relations, ad_profile_relations = [], [], [], []
+        for record in chunk:
+            person = record[config.PERSON_PRIMARY_KEY]
+            created_at = record['created_at']
+            if nodes:
+                ad_profiles.append(record.to_dict())
+                people.append({
+                    config.PERSON_PRIMARY_KEY: person,
+                    'first_name': record['first_name'],
+                    'last_name': record['last_name'],
+                    'created_at': created_at,
+                    'data_source': config.DATA_SOURCE
+                })
+            if relations:
+                company_relations.append(
+                    get_relation_data_dict(to_key_value=self.group_id,
+                                           from_key_value=person,
+                                           properties={
+                                            'performed_at': created_at,
+                                            'data_source': config.DATA_SOURCE
+                                           }))
+                ad_profile_relations.append(
+                    get_relation_data_dict(to_key_value=record[config.AD_PROFILE_PRIMARY_KEY],
+                                           from_key_value=person,
+                                           properties={
+                                            'performed_at': created_at
+                                           }))
+
+        events = []
+        if nodes:
+            events.append(get_node_dict(labels=config.AD_PROFILE_LABELS,
+                                        primary_key_name=config.AD_PROFILE_PRIMARY_KEY,
+                                        data=ad_profiles))
+            events.append(get_node_dict(labels=config.PERSON_LABELS,
+                                        primary_key_name=config.PERSON_PRIMARY_KEY,
+                                        data=people))
+        if relations:
+            events.append(get_relation_dict(to_primary_key_name=config.COMPANY_PRIMARY_KEY,
+                                            to_labels=config.COMPANY_LABELS,
+                                            from_labels=config.PERSON_LABELS,
+                                            from_primary_key_name=config.PERSON_PRIMARY_KEY,
+                                            relationship_type=config.PERSON_COMPANY_RELATION,
+                                            data=company_relations))
+            events.append(get_relation_dict(to_primary_key_name=config.AD_PROFILE_PRIMARY_KEY,
+                                            to_labels=config.AD_PROFILE_LABELS,
+                                            from_labels=config.PERSON_LABELS,
+                                            from_primary_key_name=config.PERSON_PRIMARY_KEY,
+                                            relationship_type=config.PERSON_AD_PROFILE_RELATION,
+                                            data=ad_profile_relations))
+        return events
+
+    def _iter_reporting_line_events(self, emails=None):
+        """
+        reports_to relations of the given people to their managers, resolved through the DN index of the sync.
+        The relation of a person whose manager changed to the previous manager is removed first.
+        An incremental sync looks the managers it did not fetch up in the graph, in one batched query.
+        A full sync also sets the reporting depth and span of control of every Person, computed over the
+        whole directory. When unchanged profiles are skipped, only the ones that changed are sent.
+        :param emails: people whose reports_to relations are sent, defaults to everybody fetched
+        """
+        emails = list(self.hierarchy) if emails is None else emails
+        previous_manager_dns = {email: self.previous_manager_dns[email] for email in emails
+                                if email in self.previous_manager_dns}
+        unresolved = {dn for dn in previous_manager_dns.values() if self.hierarchy.resolve(dn) is None}
+        if self.incremental:
+            unresolved.update(self.hierarchy.get_unresolved_manager_dns(emails))
+        if unresolved:
+            self.hierarchy.add_known_dns(graph.get_emails_by_distinguished_names(self.graph, list(unresolved)))
+
+        stale_reporting_lines = (get_relation_data_dict(to_key_value=previous_manager,
+                                                        from_key_value=email,
+                                                        properties={})
+                                 for email, previous_manager in ((email, self.hierarchy.resolve(dn))
+                                                                 for email, dn in previous_manager_dns.items())
+                                 if previous_manager is not None
+                                 and previous_manager != self.hierarchy.manager_of(email))
+        chunk = list(islice(stale_reporting_lines, self.chunk_size()))
+        while chunk:
+            yield get_relation_delete_dict(to_primary_key_name=config.PERSON_PRIMARY_KEY,
+                                           to_labels=config.PERSON_LABELS,
+                                           from_labels=config.PERSON_LABELS,
+                                           from_primary_key_name=config.PERSON_PRIMARY_KEY,
+                                           relationship_type=config.PERSON_MANAGER_RELATION,
+                                           data=chunk)
+            chunk = list(islice(stale_reporting_lines, self.chunk_size()))
+
+        if not self.incremental:
+            positions = self.hierarchy.get_depths_and_spans()
+            if self.fingerprints is not None:
+                if not self.full_resend:
+                    positions = self.fingerprints.changed_positions(positions)
+                # committed with the fingerprints, once the reporting lines are acknowledged
+                self.fingerprints.stage_positions(positions)
+            depths_and_spans = ({config.PERSON_PRIMARY_KEY: email,
+                                 config.PERSON_REPORTING_DEPTH: depth,
+                                 config.PERSON_SPAN_OF_CONTROL: span}
+                                for email, (depth, span) in positions.items())
+            chunk = list(islice(depths_and_spans, self.chunk_size()))
+            while chunk:
+                yield get_node_dict(labels=config.PERSON_LABELS,
+                                    primary_key_name=config.PERSON_PRIMARY_KEY,
+                                    data=chunk)
+                chunk = list(islice(depths_and_spans, self.chunk_size()))
+
+        reporting_lines = (get_relation_data_dict(to_key_value=manager,
+                                                  from_key_value=email,
+                                                  properties={'data_source': config.DATA_SOURCE})
+                           for email, manager in ((email, self.hierarchy.manager_of(email)) for email in emails)
+                           if manager is not None and manager != email)
+        chunk = list(islice(reporting_lines, self.chunk_size()))
+        while chunk:
+            yield get_relation_dict(to_primary_key_name=config.PERSON_PRIMARY_KEY,
+                                    to_labels=config.PERSON_LABELS,
+                                    from_labels=config.PERSON_LABELS,
+                                    from_primary_key_name=config.PERSON_PRIMARY_KEY,
+                                    relationship_type=config.PERSON_MANAGER_RELATION,
+                                    data=chunk)
+            chunk = list(islice(reporting_lines, self.chunk_size()))
+
+    def _populate_reporting_lines(self, emails=None):
+        for event in self._iter_reporting_line_events(emails):
+            self.publisher.publish(event)
+
+    def _iter_group_node_events(self):
+        """
+        ADGroup nodes of the groups under the search base, in chunks. Every group is indexed by its DN so that
+        nested groups resolve in memory when the memberships are sent.
+        """
+        groups = []
+        with self._connection() as conn:
+            pages = self._iter_ldap_pages(conn, search_filter=self._get_group_search_filter(conn),
+                                          attributes=config.AD_GROUP_ATTRIBUTES,
+                                          page_size=self._get_group_page_size(conn))
+            for response in pages:
+                now = self._get_milliseconds_since_epoch()
+                for item in response:
+                    group = get_group(item['attributes'], now) if item.get('type') == 'searchResEntry' else None
+                    if group is None:
+                        continue
+                    self.members.add_group(group['ad_distinguished_name'], group[config.GROUP_PRIMARY_KEY])
+                    groups.append(group)
+                    if len(groups) >= self.chunk_size():
+                        yield get_node_dict(labels=config.GROUP_LABELS,
+                                            primary_key_name=config.GROUP_PRIMARY_KEY,
+                                            data=groups)
+                        groups = []
+        if groups:
+            yield get_node_dict(labels=config.GROUP_LABELS, primary_key_name=config.GROUP_PRIMARY_KEY, data=groups)
+
+    def _iter_member_dns(self, conn, dn, attributes):
+        """
+        Member DNs of a group, from its first range in the search page and then one base search per remaining
+        range. Groups with more members than the DC's MaxValRange only return that many per request.
+        """
+        values, low = get_member_range(attributes, config.AD_GROUP_MEMBER)
+        yield from values
+        while low is not None:
+            self._throttle()
+            conn.search(search_base=dn,
+                        search_filter='(objectClass=*)',
+                        search_scope=BASE,
+                        attributes=[get_range_attribute(config.AD_GROUP_MEMBER, low,
+                                                        config.AD_GROUP_MEMBER_RANGE_SIZE)])
+            metrics.LDAP_MEMBER_RANGES.inc()
+            entries = [item['attributes'] for item in conn.response if item.get('type') == 'searchResEntry']
+            values, low = get_member_range(entries[0], config.AD_GROUP_MEMBER) if entries else ([], None)
+            yield from values
+
+    def _iter_group_membership_events(self):
+        """
+        belongs_to relations of the groups to the company and member_of relations of their members, people and
+        nested groups, in chunks. The group nodes must already be in the queue.
+        Memberships are resolved GRAPH_LOOKUP_BATCH_SIZE at a time, an incremental sync looks the members it did not
+        fetch up in the graph.
+        """
+        attributes = [config.AD_GUID, config.AD_DISTINGUISHED_NAME,
+                      get_range_attribute(config.AD_GROUP_MEMBER, 0, config.AD_GROUP_MEMBER_RANGE_SIZE)]
+        memberships = []
+        with self._connection() as conn, manual_range(conn):
+            pages = self._iter_ldap_pages(conn, search_filter=self._get_group_search_filter(conn),
+                                          attributes=attributes, page_size=self._get_group_page_size(conn))
+            for response in pages:
+                company_relations = []
+                for item in response:
+                    guid = get_guid(item['attributes']) if item.get('type') == 'searchResEntry' else None
+                    if not guid:
+                        continue
+                    company_relations.append(get_relation_data_dict(to_key_value=self.group_id,
+                                                                    from_key_value=guid,
+                                                                    properties={'data_source': config.DATA_SOURCE}))
+                    for member_dn in self._iter_member_dns(conn, item['dn'], item['attributes']):
+                        memberships.append((guid, member_dn))
+                        if len(memberships) >= config.GRAPH_LOOKUP_BATCH_SIZE:
+                            yield from self._iter_member_relation_events(memberships)
+                            memberships = []
+                if company_relations:
+                    yield get_relation_dict(to_primary_key_name=config.COMPANY_PRIMARY_KEY,
+                                            to_labels=config.COMPANY_LABELS,
+                                            from_labels=config.GROUP_LABELS,
+                                            from_primary_key_name=config.GROUP_PRIMARY_KEY,
+                                            relationship_type=config.GROUP_COMPANY_RELATION,
+                                            data=company_relations)
+        yield from self._iter_member_relation_events(memberships)
+
+    def _iter_member_relation_events(self, memberships):
+        """
+        :param memberships: [(group guid, member DN)], members that resolve to nobody are left out
+        """
+        lookup_people = lookup_groups = None
+        if self.incremental:
+            def lookup_people(dns):
+                return graph.get_emails_by_distinguished_names(self.graph, dns)
+
+            def lookup_groups(dns):
+                return graph.get_group_guids_by_distinguished_names(self.graph, dns)
+        resolved = self.members.resolve_all(list({dn for _, dn in memberships}), lookup_people, lookup_groups)
+
+        relations = {PERSON: [], GROUP: []}
+        for guid, member_dn in memberships:
+            if member_dn in resolved:
+                kind, key = resolved[member_dn]
+                relations[kind].append(get_relation_data_dict(to_key_value=guid,
+                                                              from_key_value=key,
+                                                              properties={'data_source': config.DATA_SOURCE}))
+        for kind, labels, primary_key_name in ((PERSON, config.PERSON_LABELS, config.PERSON_PRIMARY_KEY),
+                                               (GROUP, config.GROUP_LABELS, config.GROUP_PRIMARY_KEY)):
+            data = iter(relations[kind])
+            chunk = list(islice(data, self.chunk_size()))
+            while chunk:
+                yield get_relation_dict(to_primary_key_name=config.GROUP_PRIMARY_KEY,
+                                        to_labels=config.GROUP_LABELS,
+                                        from_labels=labels,
+                                        from_primary_key_name=primary_key_name,
+                                        relationship_type=config.GROUP_MEMBER_RELATION,
+                                        data=chunk)
+                chunk = list(islice(data, self.chunk_size()))
+
+    def _populate_groups(self):
+        self._set_stage('populating groups')
+        for event in self._iter_group_node_events():
+            self.publisher.publish(event)
+        self.publisher.flush()
+        logger.info('Checkpoint: Done populating groups')
+
+        # member_of relations of nested groups need every group node in the queue
+        self._set_stage('populating group memberships')
+        for event in self._iter_group_membership_events():
+            self.publisher.publish(event)
+        self.publisher.flush()
+        logger.info('Checkpoint: Done populating group memberships')
+
+    def _iter_chunk_events(self, nodes=True, relations=True):
+        for chunk in self.data_to_send.chunks(self.chunk_size, config.QUEUE_CHUNK_BYTES):
+            events = self._get_chunk_events(chunk, nodes=nodes, relations=relations)
+            if self.batch_envelope:
+                yield get_batch_dict(events)
+            else:
+                yield from events
+
+    def _publish_chunk_events(self, nodes=True, relations=True):
+        for event in self._iter_chunk_events(nodes=nodes, relations=relations):
+            self.publisher.publish(event)
+
+    def _populate_nodes(self):
+        self._publish_chunk_events(relations=False)
+
+    def _populate_relations(self):
+        self._publish_chunk_events(nodes=False)
+
+    def _populate_data_to_send(self):
+        """
+        Publish the nodes and relations of the records, the company node must already be in the queue
+        """
+        if self.batch_envelope:
+            # the envelope keeps the relations of a chunk behind its nodes, one pass and one post per chunk
+            self._publish_chunk_events()
+            return
+        self._populate_nodes()
+        # relationships are only sent once their nodes are in the queue
+        self.publisher.flush()
+        self._populate_relations()
+
+    def _run_streaming(self):
+        """
+        Normalize, diff and publish every ldap page while the next one is being fetched
+        """
+        # company node goes first so that the per-page belongs_to relations can be created
+        self._set_stage('populating company node')
+        self._populate_company_node()
+        self.publisher.flush()
+        logger.info('Checkpoint: Done populating company node')
+
+        self._set_stage('streaming ldap pages')
+        # people published by the pages, the unchanged ones keep their reporting lines
+        emails_sent = []
+        for _ in self._populate_pages(self._stream_ldap_pages()):
+            self.page_number += 1
+            fingerprints = self._skip_unchanged_records()
+            self._set_last_update_time_of_changed_fields()
+            self._populate_data_to_send()
+            # the batch envelope does not flush, a failed post of the page stops the sync before the next page
+            self.publisher.flush()
+            self._stage_fingerprints(fingerprints)
+            self._report_progress()
+            logger.info('Checkpoint: Done populating page {0}. Done : {1} || Not Done : {2} || Unchanged : {3} '
+                        'for AD_URL: {4}'.format(self.page_number, self.done, self.not_done, self.unchanged,
+                                                 self.ad_url))
+            emails_sent.extend(self._get_emails_to_send())
+            self.data_to_send.clear_records()
+
+        # managers may come in any page, the reporting lines go once all people are in
+        self._set_stage('populating reporting lines')
+        self._populate_reporting_lines(emails_sent)
+        self.publisher.flush()
+        self._commit_fingerprints()
+        logger.info('Checkpoint: Done populating reporting lines')
+
+        if self.sync_groups:
+            self._populate_groups()
+
+        self._set_stage('updating ad last-fetch-time')
+        self._update_company_ad_last_fetch_time()
+        self.publisher.flush()
+        logger.info('Checkpoint: Done updating ad last-fetch-time')
 
     def run(self):
         """
@@ -324,24 +968,129 @@ class ADIntegration:
             If email already exists - update entry and add group that fetched the entry if not added
             If email does not exist - add entry and add group that fetched the entry
         """
+        if self.skip_unchanged:
+            self.fingerprints = FingerprintStore(self.ad_url, self.queue_url, self.group_id)
+            if self.full_resend is None:
+                self.full_resend = self.fingerprints.full_resend_due()
+        if self.use_outbox and not self.streaming:
+            self.outbox = Outbox(self.ad_url, self.queue_url, self.group_id)
+        try:
+            with self.publisher:
+                if self.streaming:
+                    self._run_streaming()
+                elif self.outbox is not None:
+                    self._run_with_outbox()
+                else:
+                    self._run()
+            if self.resent_everything and self.fingerprints is not None:
+                self.fingerprints.record_full_resend()
+        finally:
+            self._observe_stage_time()
+            if self.fingerprints is not None:
+                self.fingerprints.close()
+            if self.outbox is not None:
+                self.outbox.close()
+
+    def _run(self):
+        self._set_stage('fetching ldap data')
         self._get_ldap_data()
 
+        self._set_stage('detecting changed fields')
+        fingerprints = self._skip_unchanged_records()
+        logger.info('Unchanged : {0} for AD_URL: {1}'.format(self.unchanged, self.ad_url))
         self._set_last_update_time_of_changed_fields()
 
-        self._populate_ad_profile_nodes()
-        logger.info('Checkpoint: Done populating ad profile nodes')
-
-        self._populate_user_nodes()
-        logger.info('Checkpoint: Done populating user nodes')
-
+        self._set_stage('populating nodes')
         self._populate_company_node()
-        logger.info('Checkpoint: Done populating company node')
+        if self.batch_envelope:
+            self.publisher.flush()
+            self._set_stage('populating nodes and relations')
+            self._populate_data_to_send()
+        else:
+            self._populate_nodes()
+            self.publisher.flush()
+            logger.info('Checkpoint: Done populating ad profile, user and company nodes')
+
+            self._set_stage('populating relations')
+            self._populate_relations()
+        self.publisher.flush()
+        logger.info('Checkpoint: Done populating user company and user-adProfile relations')
 
-        self._populate_user_company_relations()
-        logger.info('Checkpoint: Done populating user company relations')
+        # after all chunks, a manager may be in any of them
+        self._set_stage('populating reporting lines')
+        self._populate_reporting_lines(self._get_emails_to_send())
+        self.publisher.flush()
+        self._stage_fingerprints(fingerprints)
+        self._commit_fingerprints()
+        logger.info('Checkpoint: Done populating reporting lines')
 
-        self._populate_user_ad_profile_relations()
-        logger.info('Checkpoint: Done populating user-adProfile relations')
+        if self.sync_groups:
+            self._populate_groups()
 
+        self._set_stage('updating ad last-fetch-time')
         self._update_company_ad_last_fetch_time()
+        self.publisher.flush()
         logger.info('Checkpoint: Done updating ad last-fetch-time')
+
+    def _run_with_outbox(self):
+        """
+        _run with every event persisted in the outbox before it is published. When the last sync failed to publish,
+        its remaining events are published instead of fetching LDAP again.
+        """
+        if self.outbox.pending():
+            logger.info('Checkpoint: Resuming the unpublished events of the last sync of AD_URL: ' + self.ad_url)
+        else:
+            self._set_stage('fetching ldap data')
+            self._get_ldap_data()
+
+            self._set_stage('detecting changed fields')
+            fingerprints = self._skip_unchanged_records()
+            logger.info('Unchanged : {0} for AD_URL: {1}'.format(self.unchanged, self.ad_url))
+            self._set_last_update_time_of_changed_fields()
+
+            self._set_stage('persisting events')
+            self._fill_outbox(fingerprints)
+        self._publish_outbox()
+
+    def _fill_outbox(self, fingerprints):
+        if self.batch_envelope:
+            phases = [('populating nodes', [self._get_company_node_event()]),
+                      ('populating nodes and relations', self._iter_chunk_events())]
+        else:
+            phases = [('populating nodes', chain(self._iter_chunk_events(relations=False),
+                                                 [self._get_company_node_event()])),
+                      ('populating relations', self._iter_chunk_events(nodes=False))]
+        phases.append(('populating reporting lines', self._iter_reporting_line_events(self._get_emails_to_send())))
+        if self.sync_groups:
+            # the phases are filled in order, every group is indexed before the memberships are resolved
+            phases.append(('populating groups', self._iter_group_node_events()))
+            phases.append(('populating group memberships', self._iter_group_membership_events()))
+        phases.append(('updating ad last-fetch-time', [self._get_ad_last_fetch_time_event()]))
+
+        self.outbox.start()
+        for phase, (stage, events) in enumerate(phases):
+            for event in events:
+                self.outbox.add(phase, stage, event)
+        self.outbox.commit(fingerprints)
+        # everything to publish is in the outbox now
+        self.data_to_send.clear_records()
+        logger.info('Checkpoint: Persisted the events of AD_URL: ' + self.ad_url)
+
+    def _publish_outbox(self):
+        def ack_when_published(seq):
+            return lambda future: future.exception() is None and self.outbox.ack(seq)
+
+        try:
+            for stage, events in self.outbox.phases():
+                self._set_stage(stage)
+                for seq, event in events:
+                    self.publisher.publish(event).add_done_callback(ack_when_published(seq))
+                self.publisher.flush()
+                self.outbox.save_acks()
+                logger.info('Checkpoint: Done ' + stage)
+        finally:
+            self.outbox.save_acks()
+
+        self._stage_fingerprints(self.outbox.fingerprints())
+        self._commit_fingerprints()
+        self.outbox.discard()
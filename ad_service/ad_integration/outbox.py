@@ -0,0 +1,124 @@
+import json
+import sqlite3
+import threading
+import time
+
+from ad_service.utils import config
+
+_INSERT_BATCH_SIZE = 100
+
+
+class Outbox:
+    """
+    Queue events of one sync of an AD instance to a queue, kept in a local SQLite file from before they are published
+    until the queue acknowledged them, together with the fingerprints to commit once all of them are.
+    Events are published phase by phase (eg. relations after the nodes), a sync that failed on the way is resumed
+    from its unacknowledged events.
+    """
+    def __init__(self, ad_url, queue_url, group_id, path=None):
+        self._key = (ad_url, queue_url, str(group_id))
+        self._conn = sqlite3.connect(path or config.OUTBOX_DB_PATH, timeout=config.OUTBOX_DB_TIMEOUT,
+                                     check_same_thread=False)
+        with self._conn:
+            self._conn.execute('create table if not exists outbox_sync ('
+                               'instance_url text not null, queue_url text not null, group_id text not null, '
+                               'created_at real not null, fingerprints text not null, '
+                               'primary key (instance_url, queue_url, group_id)) without rowid')
+            self._conn.execute('create table if not exists outbox_event ('
+                               'instance_url text not null, queue_url text not null, group_id text not null, '
+                               'seq integer not null, phase integer not null, stage text not null, '
+                               'event text not null, acked integer not null default 0, '
+                               'primary key (instance_url, queue_url, group_id, seq)) without rowid')
+        self._seq = 0
+        self._rows = []
+        self._acked = []
+        self._acked_lock = threading.Lock()
+
+    def pending(self):
+        """
+        :return: True if an earlier sync left a complete outbox to publish. Outboxes older than config.OUTBOX_MAX_AGE are
+            discarded, their changes are fetched again
+        """
+        row = self._conn.execute('select created_at from outbox_sync '
+                                 'where instance_url = ? and queue_url = ? and group_id = ?', self._key).fetchone()
+        if row is None:
+            return False
+        if time.time() - row[0] > config.OUTBOX_MAX_AGE:
+            self.discard()
+            return False
+        return True
+
+    def start(self):
+        """
+        Start the outbox of a new sync, replacing whatever was left
+        """
+        self.discard()
+        self._seq = 0
+        self._rows = []
+
+    def add(self, phase, stage, event):
+        self._rows.append(self._key + (self._seq, phase, stage, json.dumps(event)))
+        self._seq += 1
+        if len(self._rows) >= _INSERT_BATCH_SIZE:
+            self._save_rows()
+
+    def _save_rows(self):
+        with self._conn:
+            self._conn.executemany('insert into outbox_event '
+                                   '(instance_url, queue_url, group_id, seq, phase, stage, event) '
+                                   'values (?, ?, ?, ?, ?, ?, ?)', self._rows)
+        self._rows = []
+
+    def commit(self, fingerprints):
+        """
+        Mark the outbox complete, only a complete outbox is resumed
+        :param fingerprints: {email: fingerprint} of the profiles of the sync
+        """
+        self._save_rows()
+        with self._conn:
+            self._conn.execute('insert into outbox_sync (instance_url, queue_url, group_id, created_at, fingerprints) '
+                               'values (?, ?, ?, ?, ?)', self._key + (time.time(), json.dumps(fingerprints)))
+
+    def fingerprints(self):
+        row = self._conn.execute('select fingerprints from outbox_sync '
+                                 'where instance_url = ? and queue_url = ? and group_id = ?', self._key).fetchone()
+        return json.loads(row[0]) if row is not None else {}
+
+    def phases(self):
+        """
+        :return: (stage, events) of every phase with unacknowledged events, in order. events yields (seq, event),
+            call ack(seq) once the queue acknowledged an event and save_acks() before moving to the next phase
+        """
+        phases = self._conn.execute('select distinct phase, stage from outbox_event '
+                                    'where instance_url = ? and queue_url = ? and group_id = ? and acked = 0 '
+                                    'order by phase', self._key).fetchall()
+        return [(stage, self._events(phase)) for phase, stage in phases]
+
+    def _events(self, phase):
+        rows = self._conn.execute('select seq, event from outbox_event '
+                                  'where instance_url = ? and queue_url = ? and group_id = ? and phase = ? '
+                                  'and acked = 0 order by seq', self._key + (phase,))
+        for seq, event in rows:
+            yield seq, json.loads(event)
+
+    def ack(self, seq):
+        # called from the publisher threads
+        with self._acked_lock:
+            self._acked.append(seq)
+
+    def save_acks(self):
+        with self._acked_lock:
+            acked, self._acked = self._acked, []
+        with self._conn:
+            self._conn.executemany('update outbox_event set acked = 1 '
+                                   'where instance_url = ? and queue_url = ? and group_id = ? and seq = ?',
+                                   [self._key + (seq,) for seq in acked])
+
+    def discard(self):
+        with self._conn:
+            for table in ('outbox_sync', 'outbox_event'):
+                self._conn.execute('delete from {0} where instance_url = ? and queue_url = ? and group_id = ?'
+                                   .format(table), self._key)
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,158 @@
+from itertools import islice
+
+from ad_service.utils import config
+
+# profile fields whose change time is tracked separately
+TRACKED_KEYS = ('title', 'phone', 'location', 'department')
+
+MEMBER_FIELDS = (
+    'first_name',
+    'last_name',
+    config.AD_PROFILE_PRIMARY_KEY,
+    'ad_principle_name',
+    'ad_username',
+    'title',
+    'ad_distinguished_name',
+    'ad_guid',
+    'company',
+    'phone',
+    'personal_website',
+    'location',
+    'division',
+    'department',
+    'direct_reports',
+    'manager',
+    'last_update_time',
+    'data_source',
+    'created_at',
+) + tuple(key + '_update_time' for key in TRACKED_KEYS)
+
+
+class MemberRecord:
+    """
+    One ADProfile payload. Slots instead of a per-record dict keep a user at a fraction of the memory,
+    item access keeps it usable wherever the payload dicts were.
+    """
+    __slots__ = MEMBER_FIELDS
+
+    def __init__(self, **fields):
+        for key in MEMBER_FIELDS:
+            setattr(self, key, fields.get(key, ''))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def keys(self):
+        return MEMBER_FIELDS
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in MEMBER_FIELDS}
+
+    def payload_size(self):
+        """
+        Rough size of the serialized record, cheap enough to be computed for every record of a sync
+        """
+        size = 0
+        for key in MEMBER_FIELDS:
+            value = getattr(self, key)
+            if isinstance(value, (list, tuple)):
+                size += sum(len(str(item)) + 4 for item in value)
+            else:
+                size += len(str(value))
+            size += len(key) + 6
+        return size
+
+    def __repr__(self):
+        return 'MemberRecord({0!r})'.format(self.to_dict())
+
+
+def _created_before(when_created, other):
+    # entries without whenCreated ('' once normalized) count as the latest created
+    if when_created in ('', None):
+        return False
+    if other in ('', None):
+        return True
+    return when_created < other
+
+
+class MemberRecordStore:
+    """
+    Member records keyed by email, in the order emails were first seen.
+    When an email shows up again the earliest created record is kept (to ignore groups that get created with
+    the same email); replacing it is O(1) and keeps its position.
+    clear_records() drops the records but remembers the emails seen, so that a streaming sync can keep
+    emails unique across pages it already published.
+    """
+    def __init__(self):
+        self._records = {}
+        self._when_created = {}
+
+    def add(self, email, when_created, record):
+        """
+        :return: True if the record was stored, False if an earlier created record of the email is kept
+        """
+        if email in self._when_created and not _created_before(when_created, self._when_created[email]):
+            return False
+        self._when_created[email] = when_created
+        self._records[email] = record
+        return True
+
+    def clear_records(self):
+        self._records = {}
+
+    def retain(self, emails):
+        """
+        Drop the records of every email not in `emails`, they are still remembered as seen
+        """
+        self._records = {email: record for email, record in self._records.items() if email in emails}
+
+    def chunks(self, size, max_bytes=None):
+        """
+        Records in chunks of at most `size` records and, when `max_bytes` is given, about `max_bytes`
+        serialized bytes. A chunk holds at least one record however large it is.
+        :param size: records per chunk, or a callable returning it, asked again for every chunk
+        """
+        get_size = size if callable(size) else lambda: size
+        records = iter(self._records.values())
+        if max_bytes is None:
+            chunk = list(islice(records, get_size()))
+            while chunk:
+                yield chunk
+                chunk = list(islice(records, get_size()))
+            return
+
+        chunk = []
+        chunk_bytes = 0
+        chunk_size = get_size()
+        for record in records:
+            record_bytes = record.payload_size()
+            if chunk and (len(chunk) >= chunk_size or chunk_bytes + record_bytes > max_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+                chunk_size = get_size()
+            chunk.append(record)
+            chunk_bytes += record_bytes
+        if chunk:
+            yield chunk
+
+    def __contains__(self, email):
+        return email in self._records
+
+    def __getitem__(self, email):
+        return self._records[email]
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def __len__(self):
+        return len(self._records)
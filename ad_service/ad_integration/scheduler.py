@@ -0,0 +1,141 @@
+import datetime
+import random
+import threading
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from ad_service.ad_integration.jobs import JobQueueFull, submit_sync_job
+from ad_service.models import ScheduledIntegration, SyncJob
+from ad_service.utils import config
+from ad_service.utils.security import decrypt, encrypt
+
+logger = config.LOGGER
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def _group_id(value):
+    # group ids are stored as text, numeric ones go back to the queue as numbers like the onboarding request sent them
+    return int(value) if value.isdigit() else value
+
+
+def get_next_run_at(sync_interval, now=None):
+    """
+    Next run of an integration, `sync_interval` seconds from now plus up to
+    config.SCHEDULER_JITTER_RATIO of it, so that integrations registered together drift apart
+    """
+    now = now or timezone.now()
+    jitter = random.uniform(0, sync_interval * config.SCHEDULER_JITTER_RATIO)
+    return now + datetime.timedelta(seconds=sync_interval + jitter)
+
+
+def register_integration(ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id, state,
+                         sync_interval):
+    """
+    Create or update the schedule of an integration, a sync_interval of 0 disables it.
+    The first run lands anywhere within one interval to spread the integrations registered at the same time.
+    The password is stored encrypted, the scheduler decrypts it when it starts a sync.
+    """
+    sync_interval = int(sync_interval)
+    defaults = {
+        'ad_username': ad_username,
+        'ad_password': encrypt(ad_password).decode('utf-8'),
+        'ad_search_base': ad_search_base,
+        'graph_url': graph_url,
+        'queue_url': queue_url,
+        'state': state,
+        'sync_interval': sync_interval,
+        'enabled': sync_interval > 0,
+        'next_run_at': timezone.now() + datetime.timedelta(seconds=random.uniform(0, sync_interval)),
+    }
+    integration, _ = ScheduledIntegration.objects.update_or_create(ad_url=ad_url, group_id=str(group_id),
+                                                                   defaults=defaults)
+    logger.info('Scheduled AD_URL: {0} group_id: {1} every {2} sec'.format(ad_url, group_id, sync_interval))
+    return integration
+
+
+class SyncScheduler:
+    """
+    Starts the due incremental syncs of the registered integrations on the job worker pool.
+    Every mod_wsgi process runs one; a due integration is claimed by moving its next_run_at with a conditional
+    update, so only one process starts it.
+    Due integrations are started most overdue first, at most one sync per integration and
+    config.SCHEDULER_MAX_ACTIVE_SYNCS syncs in all processes at any time.
+    """
+    def __init__(self, poll_interval=None):
+        self.poll_interval = poll_interval or config.SCHEDULER_POLL_INTERVAL
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='ad-sync-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        # spread the polls of the processes started together
+        self._stop.wait(random.uniform(0, self.poll_interval))
+        while not self._stop.is_set():
+            try:
+                self.run_pending()
+            except Exception as e:
+                logger.exception('Scheduler run failed ' + repr(e))
+            finally:
+                close_old_connections()
+            self._stop.wait(self.poll_interval)
+
+    @staticmethod
+    def _active_jobs(now):
+        # jobs of a process that died never finish, they stop counting after a while
+        return SyncJob.objects.filter(status__in=[SyncJob.STATUS_QUEUED, SyncJob.STATUS_RUNNING],
+                                      created_at__gte=now - datetime.timedelta(seconds=config.SCHEDULER_STALE_JOB_AGE))
+
+    def run_pending(self):
+        """
+        :return: number of syncs started
+        """
+        now = timezone.now()
+        active_jobs = self._active_jobs(now)
+        capacity = config.SCHEDULER_MAX_ACTIVE_SYNCS - active_jobs.count()
+        if capacity <= 0:
+            return 0
+
+        started = 0
+        due = ScheduledIntegration.objects.filter(enabled=True, next_run_at__lte=now).order_by('next_run_at')
+        for integration in due[:capacity * 2]:
+            if started >= capacity:
+                break
+            if active_jobs.filter(ad_url=integration.ad_url, group_id=integration.group_id).exists():
+                continue
+            claimed = ScheduledIntegration.objects.filter(pk=integration.pk, next_run_at=integration.next_run_at) \
+                .update(next_run_at=get_next_run_at(integration.sync_interval, now), last_run_at=now)
+            if not claimed:
+                continue
+            try:
+                submit_sync_job(integration.ad_url, integration.ad_username,
+                                decrypt(integration.ad_password).decode('utf-8'),
+                                integration.ad_search_base, integration.graph_url, integration.queue_url,
+                                _group_id(integration.group_id), integration.state)
+            except JobQueueFull:
+                # give it back, it stays the most overdue one for the next poll
+                ScheduledIntegration.objects.filter(pk=integration.pk).update(next_run_at=integration.next_run_at)
+                break
+            started += 1
+        if started:
+            logger.info('Scheduler started {0} syncs'.format(started))
+        return started
+
+
+def start_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = SyncScheduler()
+            _scheduler.start()
+        return _scheduler
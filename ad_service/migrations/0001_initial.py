@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-18 19:23
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('job_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('ad_url', models.CharField(max_length=255)),
+                ('group_id', models.CharField(max_length=255)),
+                ('state', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('stage', models.CharField(blank=True, default='', max_length=64)),
+                ('done', models.IntegerField(default=0)),
+                ('not_done', models.IntegerField(default=0)),
+                ('reason', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2 on 2026-10-18 19:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ad_service', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledIntegration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ad_url', models.CharField(max_length=255)),
+                ('ad_username', models.CharField(max_length=255)),
+                ('ad_password', models.CharField(max_length=255)),
+                ('ad_search_base', models.CharField(max_length=255)),
+                ('graph_url', models.CharField(max_length=255)),
+                ('queue_url', models.CharField(max_length=255)),
+                ('group_id', models.CharField(max_length=255)),
+                ('state', models.CharField(max_length=255)),
+                ('sync_interval', models.PositiveIntegerField()),
+                ('next_run_at', models.DateTimeField(db_index=True)),
+                ('last_run_at', models.DateTimeField(blank=True, null=True)),
+                ('enabled', models.BooleanField(default=True)),
+            ],
+            options={
+                'unique_together': {('ad_url', 'group_id')},
+            },
+        ),
+    ]
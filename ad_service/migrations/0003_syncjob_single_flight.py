@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-18 20:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ad_service', '0002_scheduledintegration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncjob',
+            name='attached_to',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='attached_jobs', to='ad_service.syncjob'),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='flight',
+            field=models.CharField(blank=True, max_length=40, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='queue_url',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
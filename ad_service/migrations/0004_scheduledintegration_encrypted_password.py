@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+
+def encrypt_passwords(apps, schema_editor):
+    from ad_service.utils.security import encrypt
+    ScheduledIntegration = apps.get_model('ad_service', 'ScheduledIntegration')
+    for integration in ScheduledIntegration.objects.all():
+        integration.ad_password = encrypt(integration.ad_password).decode('utf-8')
+        integration.save(update_fields=['ad_password'])
+
+
+def decrypt_passwords(apps, schema_editor):
+    from ad_service.utils.security import decrypt
+    ScheduledIntegration = apps.get_model('ad_service', 'ScheduledIntegration')
+    for integration in ScheduledIntegration.objects.all():
+        integration.ad_password = decrypt(integration.ad_password).decode('utf-8')
+        integration.save(update_fields=['ad_password'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ad_service', '0003_syncjob_single_flight'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scheduledintegration',
+            name='ad_password',
+            field=models.CharField(max_length=1024),
+        ),
+        migrations.RunPython(encrypt_passwords, decrypt_passwords),
+    ]
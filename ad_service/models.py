@@ -1,3 +1,89 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+class SyncJob(models.Model):
+    """
+    One /api/ad_integration run, executed by the worker pool in ad_service.ad_integration.jobs.
+    Kept in the database so that every mod_wsgi process can report its status.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    job_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    ad_url = models.CharField(max_length=255)
+    group_id = models.CharField(max_length=255)
+    queue_url = models.CharField(max_length=255, blank=True, default='')
+    state = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    stage = models.CharField(max_length=64, blank=True, default='')
+    done = models.IntegerField(default=0)
+    not_done = models.IntegerField(default=0)
+    reason = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # key of the AD instance, search base, user, group and queue, held while requests for them can still join this
+    # job's sync
+    flight = models.CharField(max_length=40, null=True, blank=True, unique=True)
+    # set on the jobs of requests that joined another job's sync, they finish with it
+    attached_to = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name='attached_jobs')
+
+    def duration(self):
+        """
+        Seconds the job has been running for, or ran for once finished
+        """
+        if self.started_at is None:
+            return None
+        end = self.finished_at or timezone.now()
+        return (end - self.started_at).total_seconds()
+
+    def to_dict(self):
+        return {
+            'job_id': str(self.job_id),
+            'ad_url': self.ad_url,
+            'group_id': self.group_id,
+            'status': self.status,
+            'stage': self.stage,
+            'done': self.done,
+            'not_done': self.not_done,
+            'reason': self.reason,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration': self.duration(),
+            'attached_to': str(self.attached_to_id) if self.attached_to_id else None,
+        }
+
+
+class ScheduledIntegration(models.Model):
+    """
+    An integration whose incremental sync is run every `sync_interval` seconds by
+    ad_service.ad_integration.scheduler. The password is kept encrypted with ad_service.utils.security.encrypt.
+    """
+    ad_url = models.CharField(max_length=255)
+    ad_username = models.CharField(max_length=255)
+    ad_password = models.CharField(max_length=1024)
+    ad_search_base = models.CharField(max_length=255)
+    graph_url = models.CharField(max_length=255)
+    queue_url = models.CharField(max_length=255)
+    group_id = models.CharField(max_length=255)
+    state = models.CharField(max_length=255)
+    sync_interval = models.PositiveIntegerField()
+    next_run_at = models.DateTimeField(db_index=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    enabled = models.BooleanField(default=True)
 
-# Create your models here.
+    class Meta:
+        unique_together = [('ad_url', 'group_id')]
@@ -1,13 +1,36 @@
-from django.test import Client
-from rest_framework.test import APITestCase
+from django.test import Client, TestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 import os
+import tempfile
 import yaml
-from py2neo import Graph
+from ad_service.utils.graph import get_graph
 from ad_service.utils.security import encrypt
-from ad_service.ad_integration.onboard_and_update import ADIntegration
+from ad_service.ad_integration.onboard_and_update import ADIntegration, PAGED_RESULTS_CONTROL
+from ad_service.ad_integration.groups import GROUP, PERSON, MemberResolver, get_member_range, get_range_attribute
+from ad_service.ad_integration.records import MemberRecord, MemberRecordStore
+from ad_service.ad_integration.fingerprints import FingerprintStore
+from ad_service.ad_integration.outbox import Outbox
+from ad_service.ad_integration.hierarchy import OrgHierarchy
 import ad_service.utils.config as constants
 from unittest.mock import Mock, patch
-from ad_service.utils.queue import get_node_dict, get_relation_data_dict, get_relation_dict
+from ad_service.utils.queue import get_batch_dict, get_node_dict, get_relation_data_dict, get_relation_dict, \
+    iter_body, send_to_queue, zstandard, AdaptiveChunkSize, QueueRejected, QueueSplitError
+from benchmarks.queue_stub import QueueStub
+import json
+import unittest
+from prometheus_client import REGISTRY
+from ad_service.ad_integration import jobs
+from ad_service.ad_integration.scheduler import SyncScheduler, get_next_run_at, register_integration
+from ad_service.models import ScheduledIntegration, SyncJob
+from ad_service.utils import security, warmup
+from ad_service.utils.ldap import AdaptivePageSize, LDAPConnectionManager, LDAPPoolTimeout, RequestRateLimit, \
+    read_max_page_size
+from django.utils import timezone
+import datetime
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from ldap3 import BASE, LEVEL, SUBTREE
 
 
 class ADValue:
@@ -35,7 +58,7 @@ class ADOnboardTest(APITestCase):
         self.ad_search_base = secrets['AD_SEARCH_BASE']
         self.url = "/api/ad_integration/"
         self.group_id = 1
-        self.graph = Graph(constants.TEST_GRAPH_URL, bolt=constants.GRAPH_BOLT)
+        self.graph = get_graph(constants.TEST_GRAPH_URL, bolt=constants.TEST_GRAPH_BOLT)
 
         self.test_ad_integration = ADIntegration('test', 'test', 'test', 'test', constants.TEST_GRAPH_URL,
                                                  constants.TEST_QUEUE_URL + 'v2/', self.group_id)
@@ -139,28 +162,32 @@ class ADOnboardTest(APITestCase):
             'directReports': ['1', '2'],
             'manager': 'manager',
         }
-        keys_to_del = [key for key in self.test_ad_integration.data_to_send[0] if 'Time' in key]
+        member_data = list(self.test_ad_integration.data_to_send)[0].to_dict()
+        keys_to_del = [key for key in member_data if 'Time' in key]
         for key in keys_to_del:
-            del self.test_ad_integration.data_to_send[0][key]
-        self.assertDictEqual(self.test_ad_integration.data_to_send[0], expected_result)
+            del member_data[key]
+        self.assertDictEqual(member_data, expected_result)
 
     def test_populate_ad_profile_nodes(self):
         self.test_ad_integration._populate(self.entry)
-        self.test_ad_integration._populate_ad_profile_nodes()
+        self.test_ad_integration._populate_nodes()
+        self.test_ad_integration.publisher.flush()
         ad_profiles = self._get_all_nodes(constants.AD_PROFILE_LABELS[0])
         self.assertEqual(len(ad_profiles), 1)
 
     def test_populate_user_nodes(self):
         self.test_ad_integration._populate(self.entry)
-        self.test_ad_integration._populate_user_nodes()
+        self.test_ad_integration._populate_nodes()
+        self.test_ad_integration.publisher.flush()
         people = self._get_all_nodes(constants.PERSON_LABELS[0])
         self.assertEqual(len(people), 1)
 
     def test_populate_user_ad_profile_relations(self):
         self.test_ad_integration._populate(self.entry)
-        self.test_ad_integration._populate_user_nodes()
-        self.test_ad_integration._populate_ad_profile_nodes()
-        self.test_ad_integration._populate_user_ad_profile_relations()
+        self.test_ad_integration._populate_nodes()
+        self.test_ad_integration.publisher.flush()
+        self.test_ad_integration._populate_relations()
+        self.test_ad_integration.publisher.flush()
         relation = self._get_all_relations(from_label=constants.PERSON_LABELS[0],
                                            to_label=constants.AD_PROFILE_LABELS[0],
                                            relation_name=constants.PERSON_AD_PROFILE_RELATION)
@@ -168,14 +195,17 @@ class ADOnboardTest(APITestCase):
 
     def test_populate_company_node(self):
         self.test_ad_integration._populate_company_node()
+        self.test_ad_integration.publisher.flush()
         company = self._get_all_nodes(constants.COMPANY_LABELS[0])
         self.assertEqual(len(company), 1)
 
     def test_populate_user_company_relations(self):
         self.test_ad_integration._populate(self.entry)
-        self.test_ad_integration._populate_user_nodes()
+        self.test_ad_integration._populate_nodes()
         self.test_ad_integration._populate_company_node()
-        self.test_ad_integration._populate_user_company_relations()
+        self.test_ad_integration.publisher.flush()
+        self.test_ad_integration._populate_relations()
+        self.test_ad_integration.publisher.flush()
         relation = self._get_all_relations(from_label=constants.PERSON_LABELS[0],
                                            to_label=constants.COMPANY_LABELS[0],
                                            relation_name=constants.PERSON_COMPANY_RELATION)
@@ -183,19 +213,20 @@ class ADOnboardTest(APITestCase):
 
     def test_ad_last_update_time(self):
         self.test_ad_integration._update_company_ad_last_fetch_time()
+        self.test_ad_integration.publisher.flush()
         ad_instance = self._get_all_nodes(constants.AD_INSTANCE_LABELS[0])
         self.assertEqual(len(ad_instance), 1)
 
     def test_ad_update(self):
         self.test_ad_integration._populate(self.entry)
-        self.test_ad_integration._populate_ad_profile_nodes()
+        self.test_ad_integration._populate_nodes()
+        self.test_ad_integration.publisher.flush()
         new_phone = 'new_phone'
         self.entry[constants.AD_PHONE_NUMBER] = ADValue(new_phone)
-        self.test_ad_integration.data_to_send = []
-        self.test_ad_integration.unique_email_tracker = {}
+        self.test_ad_integration.data_to_send = MemberRecordStore()
         self.test_ad_integration._populate(self.entry)
         self.test_ad_integration._set_last_update_time_of_changed_fields()
-        self.assertEqual(self.test_ad_integration.data_to_send[0]['phone'], new_phone)
+        self.assertEqual(list(self.test_ad_integration.data_to_send)[0]['phone'], new_phone)
 
     def test_populate_keeping_email_unique(self):
         self.test_ad_integration._populate(self.entry)
@@ -206,8 +237,7 @@ class ADOnboardTest(APITestCase):
         self.test_ad_integration._populate(self.entry)
         self.assertEqual(len(self.test_ad_integration.data_to_send), 2)
 
-        self.test_ad_integration.data_to_send = []
-        self.test_ad_integration.unique_email_tracker = {}
+        self.test_ad_integration.data_to_send = MemberRecordStore()
 
         new_phone = 'new_phone'
         self.entry[constants.AD_WHEN_CREATED] = ADValue(2)
@@ -215,25 +245,22 @@ class ADOnboardTest(APITestCase):
         self.entry[constants.AD_WHEN_CREATED] = ADValue(1)
         self.entry[constants.AD_PHONE_NUMBER] = ADValue(new_phone)
         self.test_ad_integration._populate(self.entry)
-        self.assertEqual(self.test_ad_integration.data_to_send[0]['phone'], new_phone)
+        self.assertEqual(list(self.test_ad_integration.data_to_send)[0]['phone'], new_phone)
 
-    @patch('ad_service.ad_integration.onboard_and_update.Connection')
+    @patch('ad_service.ad_integration.onboard_and_update.get_connection_manager', new=LDAPConnectionManager)
+    @patch('ad_service.utils.ldap.Connection')
     def test_get_ldap_data(self, mock_connection):
-        entry = self.entry
-
-        class Entry:
-            def __init__(self, entry):
-                self.entry = entry
-
-            @property
-            def __dict__(self):
-                return self.entry
+        response = [{'type': 'searchResEntry', 'dn': 'distinguishedName',
+                     'attributes': {key: value.value for key, value in self.entry.items()}}]
 
         class ADConnection:
             def __init__(self):
-                self.entries = [Entry(entry)]
+                self.response = response
                 self.search_calls = 0
                 self.result = {'controls': {'1.2.840.113556.1.4.319': {'value': {'cookie': ''}}}}
+                self.server = Mock(info=None)
+                self.bound = True
+                self.closed = False
 
             def search(self, *args, **kwargs):
                 if self.search_calls == 0:
@@ -242,7 +269,1385 @@ class ADOnboardTest(APITestCase):
                     self.result['controls']['1.2.840.113556.1.4.319']['value']['cookie'] = ''
                 self.search_calls += 1
 
+            def refresh_server_info(self):
+                pass
+
+            def unbind(self):
+                self.closed = True
+
         # mock_connection.return_value = Mock()
         mock_connection.return_value = ADConnection()
         self.test_ad_integration._get_ldap_data()
         self.assertEqual(len(self.test_ad_integration.data_to_send), 1)
+
+
+def matches_filter(search_filter, attributes):
+    """
+    Evaluate the (&..), (|..), (!..) and (attribute=value) terms of an ldap filter, case insensitively
+    """
+    def evaluate(i):
+        # search_filter[i] opens a term, returns whether it matched and the index after it
+        operator = search_filter[i + 1]
+        if operator in '&|!':
+            results = []
+            i += 2
+            while search_filter[i] == '(':
+                matched, i = evaluate(i)
+                results.append(matched)
+            if operator == '!':
+                return not results[0], i + 1
+            return (all if operator == '&' else any)(results), i + 1
+        end = search_filter.index(')', i)
+        attribute, value = search_filter[i + 1:end].split('=', 1)
+        values = [str(v).lower() for v in attributes.get(attribute, [])]
+        return (bool(values) if value == '*' else value.lower() in values), end + 1
+    return evaluate(0)[0]
+
+
+class DirectoryConnection:
+    """
+    Paged searches over {container DN: [entries right under it]}, `page_size` entries per page.
+    Containers are organizational units unless `classes` ({container DN: objectClass}) says otherwise.
+    """
+    def __init__(self, directory, page_size=2, classes=None):
+        self.directory = directory
+        self.page_size = page_size
+        self.classes = classes or {}
+        self.server = Mock(info=None)
+        self.response = []
+        self.result = {}
+        self.searches = []
+
+    def _children(self, search_base):
+        children = [(dn, {'objectClass': ['top', self.classes.get(dn, 'organizationalUnit')],
+                          'objectCategory': [self.classes.get(dn, 'organizationalUnit')]})
+                    for dn in self.directory if dn.partition(',')[2] == search_base]
+        children += [(entry['dn'], {'objectClass': ['top', 'person', 'user'], 'objectCategory': ['person']})
+                     for entry in self.directory.get(search_base, [])]
+        return children
+
+    def _entries(self, search_base, search_filter, search_scope):
+        if search_filter == constants.AD_PARTITION_OU_FILTER:
+            return [{'type': 'searchResEntry', 'dn': dn, 'raw_dn': dn.encode(), 'attributes': {},
+                     'raw_attributes': {}} for dn, attributes in self._children(search_base)
+                    if matches_filter(search_filter, attributes)]
+        if search_scope == LEVEL:
+            return list(self.directory.get(search_base, []))
+        return [entry for dn, entries in self.directory.items() if dn == search_base or dn.endswith(',' + search_base)
+                for entry in entries]
+
+    def search(self, search_base, search_filter, search_scope, attributes, paged_size=None, paged_cookie=None):
+        self.searches.append((search_base, search_filter, search_scope))
+        entries = self._entries(search_base, search_filter, search_scope)
+        # like the server's size limit, a search that is not paged stops after one page
+        low = int(paged_cookie or 0)
+        high = low + self.page_size
+        self.response = entries[low:high]
+        cookie = str(high).encode() if paged_size and high < len(entries) else b''
+        self.result = {'controls': {PAGED_RESULTS_CONTROL: {'value': {'cookie': cookie}}}}
+
+    def refresh_server_info(self):
+        pass
+
+
+class LDAPFetchTest(TestCase):
+    @staticmethod
+    def user(name, container, manager=''):
+        dn = 'CN={0},{1}'.format(name, container)
+        return {'type': 'searchResEntry', 'dn': dn, 'raw_dn': dn.encode(), 'raw_attributes': {}, 'attributes': {
+            constants.AD_EMAIL: [name + '@test.com'],
+            constants.AD_LAST_NAME: ['Last'],
+            constants.AD_NAME: ['First Last'],
+            constants.AD_DISTINGUISHED_NAME: dn,
+            constants.AD_MANAGER: manager,
+            constants.AD_WHEN_CREATED: datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        }}
+
+    def setUp(self):
+        user = self.user
+        self.directory = {
+            'DC=test': [user('ceo', 'DC=test')],
+            'OU=Eng,DC=test': [user('dev{0}'.format(i), 'OU=Eng,DC=test', 'CN=ceo,DC=test') for i in range(3)],
+            'OU=Ops,DC=test': [user('ops{0}'.format(i), 'OU=Ops,DC=test', 'CN=ceo,DC=test') for i in range(2)],
+        }
+        self.classes = {}
+        self.connections = []
+
+        def connection(*args, **kwargs):
+            self.connections.append(DirectoryConnection(self.directory, classes=self.classes))
+            return nullcontext(self.connections[-1])
+
+        manager = Mock(connection=Mock(side_effect=connection), get_max_page_size=Mock(return_value=None),
+                       get_rate_limit=Mock(return_value=None))
+        for patcher in (patch('ad_service.ad_integration.onboard_and_update.get_connection_manager',
+                              return_value=manager),
+                        patch('ad_service.utils.graph.get_ad_instance', return_value={}),
+                        patch('ad_service.utils.graph.get_ad_profiles_by_emails', return_value=[])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def new_integration(self, **kwargs):
+        with patch('ad_service.utils.graph.get_graph'):
+            return ADIntegration('ldap://test', 'test', 'test', 'DC=test', 'graph_url', 'queue_url', 1,
+                                 usn_incremental=False, **kwargs)
+
+    @staticmethod
+    def dns(pages):
+        return sorted(item['dn'] for page in pages for item in page)
+
+    def test_get_search_attributes(self):
+        search_attributes = ADIntegration._get_search_attributes(['thumbnailPhoto', 'MAIL'])
+
+        self.assertNotIn('*', search_attributes)
+        self.assertEqual(search_attributes[:len(constants.AD_SYNC_ATTRIBUTES)], constants.AD_SYNC_ATTRIBUTES)
+        self.assertEqual(search_attributes[len(constants.AD_SYNC_ATTRIBUTES):], ['thumbnailPhoto'])
+
+    def test_get_prefix_partitions(self):
+        with patch.object(constants, 'LDAP_PARTITION_PREFIX_BOUNDARIES', ['m']):
+            partitions = self.new_integration()._get_prefix_partitions('(objectClass=user)')
+
+        self.assertEqual([partition[2] for partition in partitions], [
+            '(&(!(sAMAccountName>=m))(objectClass=user))',
+            '(&(sAMAccountName>=m)(objectClass=user))',
+        ])
+
+    def test_stream_ldap_pages(self):
+        integration = self.new_integration()
+        integration.max_buffered_pages = 1
+        pages = list(integration._stream_ldap_pages())
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        self.assertEqual(self.dns(pages), self.dns(self.directory.values()))
+
+    def test_fetch_partitions(self):
+        integration = self.new_integration(partitioned=True)
+        pages = list(integration._stream_ldap_pages())
+        self.assertEqual(self.dns(pages), self.dns(self.directory.values()))
+        # the base entries and one subtree per child OU
+        searches = {(base, scope) for conn in self.connections for base, search_filter, scope in conn.searches
+                    if search_filter != constants.AD_PARTITION_OU_FILTER}
+        self.assertEqual(searches, {('DC=test', LEVEL), ('OU=Eng,DC=test', SUBTREE), ('OU=Ops,DC=test', SUBTREE)})
+
+        # the child OUs are read with a paged search
+        partitions = integration._get_partitions(DirectoryConnection(self.directory, page_size=1),
+                                                 constants.AD_SEARCH_FILTER)
+        self.assertEqual(len(partitions), 3)
+
+        with patch.object(constants, 'LDAP_PARTITION_BY', 'prefix'), \
+                patch.object(constants, 'LDAP_PARTITION_PREFIX_BOUNDARIES', ['m']):
+            partitions = integration._get_partitions(DirectoryConnection(self.directory), constants.AD_SEARCH_FILTER)
+        self.assertEqual(len(partitions), 2)
+
+    def test_fetch_partitions_covers_other_containers(self):
+        self.directory['CN=Users,DC=test'] = [self.user('admin', 'CN=Users,DC=test')]
+        self.directory['CN=LostAndFound,DC=test'] = [self.user('orphan', 'CN=LostAndFound,DC=test')]
+        self.classes.update({'CN=Users,DC=test': 'container', 'CN=LostAndFound,DC=test': 'lostAndFound'})
+
+        pages = list(self.new_integration(partitioned=True)._stream_ldap_pages())
+        self.assertEqual(self.dns(pages), self.dns(self.directory.values()))
+        self.assertIn('CN=admin,CN=Users,DC=test', self.dns(pages))
+        self.assertIn('CN=orphan,CN=LostAndFound,DC=test', self.dns(pages))
+
+    def test_run_streaming(self):
+        def run_streaming(path, full_resend=None):
+            integration = self.new_integration(streaming=True, skip_unchanged=True, full_resend=full_resend)
+            integration.publisher = Mock()
+            integration.fingerprints = FingerprintStore('ldap://test', 'queue_url', 1, path=path)
+            try:
+                integration._run_streaming()
+            finally:
+                integration.fingerprints.close()
+            return integration, [call[0][0] for call in integration.publisher.publish.call_args_list]
+
+        def relations(events, relationship_type):
+            return [data for event in events if event['type'] == 'RELATIONSHIP'
+                    and event['event_data']['type'] == relationship_type for data in event['event_data']['data']]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'fp.sqlite3')
+            integration, events = run_streaming(path)
+            self.assertEqual((integration.done, integration.page_number), (6, 3))
+            self.assertEqual(events[0]['event_data']['labels'], constants.COMPANY_LABELS)
+            self.assertEqual(events[-1]['event_data']['labels'], constants.AD_INSTANCE_LABELS)
+            self.assertEqual(len(relations(events, constants.PERSON_COMPANY_RELATION)), 6)
+            self.assertEqual(len(relations(events, constants.PERSON_MANAGER_RELATION)), 5)
+
+            # the fingerprints of every published page were committed, nothing changed since
+            integration, events = run_streaming(path)
+            self.assertEqual(integration.unchanged, 6)
+            self.assertEqual(relations(events, constants.PERSON_COMPANY_RELATION), [])
+            self.assertEqual(relations(events, constants.PERSON_MANAGER_RELATION), [])
+
+            # a full re-send publishes everybody again
+            integration, events = run_streaming(path, full_resend=True)
+            self.assertEqual(integration.unchanged, 0)
+            self.assertEqual(len(relations(events, constants.PERSON_COMPANY_RELATION)), 6)
+
+    @staticmethod
+    def people(data_to_send):
+        return [data[constants.PERSON_PRIMARY_KEY] for event in data_to_send['event_data'].get('events', [])
+                if event['type'] == 'NODE' and event['event_data']['labels'] == constants.PERSON_LABELS
+                for data in event['event_data']['data']]
+
+    def run_published(self, path):
+        integration = self.new_integration(streaming=True, skip_unchanged=True, full_resend=False, batch_envelope=True)
+        integration.fingerprints = FingerprintStore('ldap://test', 'queue_url', 1, path=path)
+        try:
+            with integration.publisher:
+                integration._run_streaming()
+        finally:
+            integration.fingerprints.close()
+
+    def test_failed_batch_page_is_sent_again(self):
+        failed, sent = [], []
+
+        def send(data_to_send, queue_url):
+            people = self.people(data_to_send)
+            if people and not failed and sent:
+                failed.extend(people)
+                # still in flight while the next page is processed
+                time.sleep(0.2)
+                raise RuntimeError('Unable to populate into queue')
+            sent.extend(people)
+            return 0
+
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('ad_service.utils.queue.send_to_queue', side_effect=send):
+            path = os.path.join(directory, 'fp.sqlite3')
+            with self.assertRaises(RuntimeError):
+                self.run_published(path)
+            self.assertEqual(len(failed), 2)
+
+            sent.clear()
+            self.run_published(path)
+            self.assertTrue(set(failed) <= set(sent))
+
+    def test_failed_reporting_lines_are_sent_again(self):
+        reporting_lines = []
+
+        def send(data_to_send, queue_url):
+            if data_to_send['event_data'].get('type') == constants.PERSON_MANAGER_RELATION:
+                if not reporting_lines:
+                    reporting_lines.append(None)
+                    raise RuntimeError('Unable to populate into queue')
+                reporting_lines.extend(data_to_send['event_data']['data'])
+            return 0
+
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('ad_service.utils.queue.send_to_queue', side_effect=send):
+            path = os.path.join(directory, 'fp.sqlite3')
+            with self.assertRaises(RuntimeError):
+                self.run_published(path)
+            # the published pages were not committed without their reporting lines
+            self.run_published(path)
+            self.assertEqual(len(reporting_lines), 1 + 5)
+
+    def test_run_without_fingerprints(self):
+        integration = self.new_integration(skip_unchanged=False)
+        with patch('ad_service.ad_integration.onboard_and_update.FingerprintStore') as mock_store, \
+                patch('ad_service.utils.queue.send_to_queue', return_value=0):
+            integration.run()
+        mock_store.assert_not_called()
+        self.assertEqual(integration.done, 6)
+
+
+class MemberRecordStoreTest(TestCase):
+    def test_keeps_earliest_created_record(self):
+        store = MemberRecordStore()
+        self.assertTrue(store.add('a@test.com', 2, MemberRecord(phone='first')))
+        self.assertTrue(store.add('b@test.com', 1, MemberRecord(phone='other')))
+        self.assertFalse(store.add('a@test.com', 3, MemberRecord(phone='later')))
+        self.assertTrue(store.add('a@test.com', 1, MemberRecord(phone='earlier')))
+
+        self.assertEqual([record['phone'] for record in store], ['earlier', 'other'])
+
+    def test_missing_when_created_counts_as_latest(self):
+        store = MemberRecordStore()
+        self.assertTrue(store.add('a@test.com', '', MemberRecord(phone='unknown')))
+        self.assertFalse(store.add('a@test.com', None, MemberRecord(phone='also unknown')))
+        self.assertTrue(store.add('a@test.com', 2, MemberRecord(phone='dated')))
+        self.assertFalse(store.add('a@test.com', '', MemberRecord(phone='unknown again')))
+        self.assertEqual([record['phone'] for record in store], ['dated'])
+
+    def test_clear_records_remembers_emails(self):
+        store = MemberRecordStore()
+        store.add('a@test.com', 2, MemberRecord(phone='first'))
+        store.clear_records()
+
+        self.assertEqual(len(store), 0)
+        self.assertFalse(store.add('a@test.com', 3, MemberRecord(phone='later')))
+        self.assertTrue(store.add('a@test.com', 1, MemberRecord(phone='earlier')))
+        self.assertEqual([chunk_record['phone'] for chunk in store.chunks(10) for chunk_record in chunk], ['earlier'])
+
+    def test_chunks_by_bytes(self):
+        store = MemberRecordStore()
+        store.add('manager@test.com', 1, MemberRecord(direct_reports=['CN=User {0}'.format(i) for i in range(100)]))
+        for i in range(4):
+            store.add('user{0}@test.com'.format(i), 1, MemberRecord())
+        max_bytes = MemberRecord().payload_size() * 2
+
+        chunks = list(store.chunks(10, max_bytes))
+        self.assertEqual([len(chunk) for chunk in chunks], [1, 2, 2])
+        self.assertEqual([len(chunk) for chunk in store.chunks(3, max_bytes * 10)], [3, 2])
+
+
+class FingerprintStoreTest(TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.db_dir.name, 'fingerprints.sqlite3')
+
+    def tearDown(self):
+        self.db_dir.cleanup()
+
+    def _record(self, email, title):
+        return MemberRecord(**{constants.AD_PROFILE_PRIMARY_KEY: email, 'title': title,
+                               'last_update_time': 1, 'title_update_time': 1})
+
+    def test_only_changed_records_after_commit(self):
+        store = FingerprintStore('ldap://test', 'queue_url', 1, path=self.path)
+        records = [self._record('a@test.com', 'title'), self._record('b@test.com', 'title')]
+        store.stage(store.changed(records))
+        store.commit()
+        store.close()
+
+        store = FingerprintStore('ldap://test', 'queue_url', 1, path=self.path)
+        records = [self._record('a@test.com', 'title'), self._record('b@test.com', 'new title')]
+        records[0]['last_update_time'] = 2
+        self.assertEqual(list(store.changed(records)), ['b@test.com'])
+        store.close()
+
+    def test_staged_fingerprints_are_not_committed(self):
+        store = FingerprintStore('ldap://test', 'queue_url', 1, path=self.path)
+        records = [self._record('a@test.com', 'title')]
+        store.stage(store.changed(records))
+        self.assertEqual(list(store.changed(records)), ['a@test.com'])
+
+        other_queue = FingerprintStore('ldap://test', 'other_queue_url', 1, path=self.path)
+        store.commit()
+        self.assertEqual(list(other_queue.changed(records)), ['a@test.com'])
+        store.close()
+        other_queue.close()
+
+    def test_only_changed_positions_after_commit(self):
+        store = FingerprintStore('ldap://test', 'queue_url', 1, path=self.path)
+        positions = {'a@test.com': (0, 1), 'b@test.com': (1, 0)}
+        self.assertEqual(store.changed_positions(positions), positions)
+        store.stage_positions(positions)
+        store.commit()
+
+        self.assertEqual(store.changed_positions({'a@test.com': (0, 2), 'b@test.com': (1, 0), 'c@test.com': (1, 0)}),
+                         {'a@test.com': (0, 2), 'c@test.com': (1, 0)})
+        store.close()
+
+    def test_full_resend_due(self):
+        store = FingerprintStore('ldap://test', 'queue_url', 1, path=self.path)
+        # a new or reset store has no record of a full re-send
+        self.assertTrue(store.full_resend_due())
+        store.record_full_resend()
+        self.assertFalse(store.full_resend_due())
+        with patch.object(constants, 'FINGERPRINT_FULL_RESEND_INTERVAL', 0):
+            self.assertTrue(store.full_resend_due())
+        with patch.object(constants, 'FINGERPRINT_FULL_RESEND_INTERVAL', None):
+            self.assertFalse(store.full_resend_due())
+        store.close()
+
+
+class SyncJobTest(APITransactionTestCase):
+    def _run_job(self, job, integration_run):
+        with patch('ad_service.ad_integration.jobs.send_to_queue') as mock_send_to_queue, \
+                patch('ad_service.ad_integration.jobs.ADIntegration') as mock_integration:
+            def run():
+                progress_callback = mock_integration.call_args[1]['progress_callback']
+                integration_run(progress_callback)
+            mock_integration.return_value.run.side_effect = run
+            jobs._job_slots.acquire()
+            jobs._run_job(job.pk, 'ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1, 'state')
+        self.confirmed_states = [call[0][0]['event_data']['state'] for call in mock_send_to_queue.call_args_list
+                                 if call[0][0]['type'] == 'CONFIRM']
+        return mock_send_to_queue.call_args_list[-1][0][0] if mock_send_to_queue.call_args_list else None
+
+    def _submit(self, state, ad_username='test', ad_search_base='test'):
+        with patch('ad_service.ad_integration.jobs._get_executor'):
+            return jobs.submit_sync_job('ldap://test', ad_username, 'test', ad_search_base, 'graph_url', 'queue_url', 1,
+                                        state)
+
+    def test_job_status(self):
+        job = SyncJob.objects.create(ad_url='ldap://test', group_id='1', state='state')
+        confirmation = self._run_job(job, lambda progress_callback: progress_callback('fetching ldap data', 5, 1))
+
+        self.assertTrue(confirmation['event_data']['is_success'])
+        response = self.client.get('/api/jobs/{0}/'.format(job.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], SyncJob.STATUS_SUCCEEDED)
+        self.assertEqual(response.json()['done'], 5)
+        self.assertEqual(response.json()['not_done'], 1)
+        self.assertIsNotNone(response.json()['duration'])
+
+    def test_failed_job_status(self):
+        def fail(progress_callback):
+            raise RuntimeError('Unable to populate into queue')
+
+        job = SyncJob.objects.create(ad_url='ldap://test', group_id='1', state='state')
+        confirmation = self._run_job(job, fail)
+
+        self.assertFalse(confirmation['event_data']['is_success'])
+        response = self.client.get('/api/jobs/{0}/'.format(job.pk))
+        self.assertEqual(response.json()['status'], SyncJob.STATUS_FAILED)
+
+    def test_concurrent_request_attaches_to_fetching_sync(self):
+        leader = self._submit('leader')
+        submitted = []
+
+        def run(progress_callback):
+            progress_callback('fetching ldap data', 5, 1)
+            submitted.append(self._submit('joined'))
+            progress_callback('detecting changed fields', 5, 1)
+
+        self._run_job(leader, run)
+        jobs._job_slots.release()
+
+        joined = SyncJob.objects.get(pk=submitted[0].pk)
+        self.assertEqual(joined.attached_to_id, leader.pk)
+        self.assertEqual((joined.status, joined.done), (SyncJob.STATUS_SUCCEEDED, 5))
+        self.assertEqual(self.confirmed_states, ['state', 'joined'])
+        self.assertIsNone(SyncJob.objects.get(pk=leader.pk).flight)
+
+    def test_request_of_other_scope_gets_its_own_sync(self):
+        leader = self._submit('leader')
+        submitted = []
+
+        def run(progress_callback):
+            progress_callback('fetching ldap data', 5, 1)
+            submitted.append(self._submit('other base', ad_search_base='OU=Other,DC=test'))
+            submitted.append(self._submit('other user', ad_username='other'))
+
+        self._run_job(leader, run)
+        for job in submitted:
+            self.assertIsNone(job.attached_to_id)
+            self.assertEqual(SyncJob.objects.get(pk=job.pk).status, SyncJob.STATUS_QUEUED)
+        self.assertEqual(self.confirmed_states, ['state'])
+        jobs._job_slots.release()
+        jobs._job_slots.release()
+
+    def test_request_after_fetch_queues_one_follow_up(self):
+        leader = self._submit('leader')
+        submitted = []
+
+        def run(progress_callback):
+            progress_callback('detecting changed fields', 5, 1)
+            submitted.append(self._submit('follow-up'))
+            submitted.append(self._submit('joined'))
+
+        self._run_job(leader, run)
+        follow_up, joined = submitted
+        self.assertIsNone(follow_up.attached_to_id)
+        self.assertEqual(joined.attached_to_id, follow_up.pk)
+        self.assertEqual(SyncJob.objects.get(pk=follow_up.pk).status, SyncJob.STATUS_QUEUED)
+        self.assertEqual(self.confirmed_states, ['state'])
+
+        self._run_job(follow_up, lambda progress_callback: None)
+        jobs._job_slots.release()
+        jobs._job_slots.release()
+        self.assertEqual(self.confirmed_states, ['state', 'joined'])
+        self.assertEqual(SyncJob.objects.get(pk=joined.pk).status, SyncJob.STATUS_SUCCEEDED)
+
+    def test_follow_up_is_queued_again_while_earlier_sync_runs(self):
+        running = SyncJob.objects.create(ad_url='ldap://test', group_id='1', queue_url='queue_url', state='state',
+                                         status=SyncJob.STATUS_RUNNING)
+        follow_up = SyncJob.objects.create(ad_url='ldap://test', group_id='1', queue_url='queue_url', state='state',
+                                           flight='flight')
+        with patch('ad_service.ad_integration.jobs.threading.Timer') as mock_timer:
+            self._run_job(follow_up, lambda progress_callback: self.fail('ran before the earlier sync finished'))
+        # the worker is given back, the job keeps its slot and flight until it runs
+        mock_timer.assert_called_once()
+        self.assertEqual(mock_timer.call_args[0][0], constants.SYNC_FOLLOW_UP_POLL_INTERVAL)
+        job = SyncJob.objects.get(pk=follow_up.pk)
+        self.assertEqual((job.status, job.stage, job.flight),
+                         (SyncJob.STATUS_QUEUED, 'waiting for the running sync', 'flight'))
+
+        SyncJob.objects.filter(pk=running.pk).update(status=SyncJob.STATUS_SUCCEEDED)
+        with patch('ad_service.ad_integration.jobs._get_executor') as mock_executor:
+            mock_timer.call_args[0][1]()
+        mock_executor.return_value.submit.assert_called_once()
+        self._run_job(follow_up, lambda progress_callback: None)
+        self.assertEqual(SyncJob.objects.get(pk=follow_up.pk).status, SyncJob.STATUS_SUCCEEDED)
+        jobs._job_slots.release()
+
+    def test_job_failing_outside_the_sync_is_failed(self):
+        job = SyncJob.objects.create(ad_url='ldap://test', group_id='1', state='state')
+        with patch('ad_service.ad_integration.jobs._is_waiting_for_earlier_syncs', side_effect=RuntimeError('db')):
+            confirmation = self._run_job(job, lambda progress_callback: None)
+        self.assertFalse(confirmation['event_data']['is_success'])
+        self.assertEqual(SyncJob.objects.get(pk=job.pk).status, SyncJob.STATUS_FAILED)
+
+    def test_unknown_job_status(self):
+        response = self.client.get('/api/jobs/00000000-0000-0000-0000-000000000000/')
+        self.assertEqual(response.status_code, 404)
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        patcher = patch('ad_service.utils.security.get_encryption_key', return_value='0123456789abcdef')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _register(self, ad_url, group_id=1, sync_interval=3600):
+        integration = register_integration(ad_url, 'test', 'test', 'test', 'graph_url', 'queue_url', group_id,
+                                           'state', sync_interval)
+        ScheduledIntegration.objects.filter(pk=integration.pk).update(
+            next_run_at=timezone.now() - datetime.timedelta(seconds=60))
+        return integration
+
+    def test_next_run_at_jitter(self):
+        now = timezone.now()
+        for _ in range(20):
+            delay = (get_next_run_at(100, now) - now).total_seconds()
+            self.assertGreaterEqual(delay, 100)
+            self.assertLessEqual(delay, 100 * (1 + constants.SCHEDULER_JITTER_RATIO))
+
+    def test_run_pending(self):
+        self._register('ldap://a')
+        self._register('ldap://b', group_id='abc')
+        with patch('ad_service.ad_integration.scheduler.submit_sync_job') as mock_submit:
+            self.assertEqual(SyncScheduler().run_pending(), 2)
+            # claimed integrations are not due again until their next interval
+            self.assertEqual(SyncScheduler().run_pending(), 0)
+        self.assertEqual({call[0][0]: call[0][6] for call in mock_submit.call_args_list},
+                         {'ldap://a': 1, 'ldap://b': 'abc'})
+        for integration in ScheduledIntegration.objects.all():
+            self.assertGreater(integration.next_run_at, timezone.now() + datetime.timedelta(seconds=3500))
+
+    def test_run_pending_fairness(self):
+        self._register('ldap://busy')
+        self._register('ldap://idle')
+        SyncJob.objects.create(ad_url='ldap://busy', group_id='1', state='state')
+        with patch('ad_service.ad_integration.scheduler.submit_sync_job') as mock_submit, \
+                patch.object(constants, 'SCHEDULER_MAX_ACTIVE_SYNCS', 2):
+            self.assertEqual(SyncScheduler().run_pending(), 1)
+        self.assertEqual(mock_submit.call_args[0][0], 'ldap://idle')
+
+    def test_password_is_stored_encrypted(self):
+        integration = register_integration('ldap://a', 'test', 'secret password', 'test', 'graph_url', 'queue_url', 1,
+                                           'state', 3600)
+        stored = ScheduledIntegration.objects.get(pk=integration.pk).ad_password
+        self.assertNotIn('secret password', stored)
+        ScheduledIntegration.objects.filter(pk=integration.pk).update(
+            next_run_at=timezone.now() - datetime.timedelta(seconds=60))
+        with patch('ad_service.ad_integration.scheduler.submit_sync_job') as mock_submit:
+            SyncScheduler().run_pending()
+        self.assertEqual(mock_submit.call_args[0][2], 'secret password')
+
+    def test_invalid_sync_interval_is_rejected(self):
+        payload = {'ldap_url': 'ldap://a', 'ldap_username': 'test', 'ldap_password': 'test',
+                   'ldap_search_base': 'test', 'graph_url': 'graph_url', 'queue_url': 'queue_url', 'group_id': 1,
+                   'state': 'state'}
+        with patch('ad_service.views.submit_sync_job') as mock_submit:
+            for sync_interval in ('abc', -5):
+                response = self.client.post('/api/ad_integration/', dict(payload, sync_interval=sync_interval))
+                self.assertEqual(response.status_code, 400)
+        mock_submit.assert_not_called()
+        self.assertFalse(ScheduledIntegration.objects.exists())
+
+    def test_disable_schedule(self):
+        self._register('ldap://a')
+        register_integration('ldap://a', 'test', 'test', 'test', 'graph_url', 'queue_url', 1, 'state', 0)
+        with patch('ad_service.ad_integration.scheduler.submit_sync_job') as mock_submit:
+            self.assertEqual(SyncScheduler().run_pending(), 0)
+        mock_submit.assert_not_called()
+
+
+class MetricsTest(TestCase):
+    def test_metrics_endpoint(self):
+        response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'ad_sync_stage_seconds', response.content)
+        self.assertIn(b'ad_sync_queue_post_seconds', response.content)
+
+    def test_queue_post_metrics(self):
+        def sample(name):
+            return REGISTRY.get_sample_value(name, {'type': 'NODE'}) or 0
+
+        node_dict = get_node_dict(labels=['Label'], primary_key_name='key', data=[{'key': 1}])
+        posts, post_bytes = sample('ad_sync_queue_post_seconds_count'), sample('ad_sync_queue_post_bytes_sum')
+        with patch('ad_service.utils.queue.get_session') as mock_get_session:
+            mock_get_session.return_value.post.return_value.status_code = 200
+            send_to_queue(node_dict, 'queue_url')
+        self.assertEqual(sample('ad_sync_queue_post_seconds_count'), posts + 1)
+        self.assertEqual(sample('ad_sync_queue_post_bytes_sum'),
+                         post_bytes + len(mock_get_session.return_value.post.call_args[1]['data']))
+
+
+class ChunkEventsTest(TestCase):
+    def _get_integration(self, batch_envelope):
+        with patch('ad_service.utils.graph.get_graph'), \
+                patch.object(constants, 'QUEUE_CHUNK_SIZE', 2):
+            integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1,
+                                        batch_envelope=batch_envelope)
+        for i in range(3):
+            email = 'user{0}@test.com'.format(i)
+            integration.data_to_send.add(email, i, MemberRecord(**{constants.AD_PROFILE_PRIMARY_KEY: email,
+                                                                   'created_at': i}))
+        integration.publisher = Mock()
+        return integration
+
+    def test_nodes_before_relations(self):
+        integration = self._get_integration(batch_envelope=False)
+        integration._populate_data_to_send()
+
+        events = [call[0][0] for call in integration.publisher.publish.call_args_list]
+        self.assertEqual([event['type'] for event in events], ['NODE'] * 4 + ['RELATIONSHIP'] * 4)
+        integration.publisher.flush.assert_called_once_with()
+        people = [data for event in events[:4] if event['event_data']['labels'] == constants.PERSON_LABELS
+                  for data in event['event_data']['data']]
+        self.assertEqual(len(people), 3)
+
+    def test_batch_envelope(self):
+        integration = self._get_integration(batch_envelope=True)
+        integration._populate_data_to_send()
+
+        events = [call[0][0] for call in integration.publisher.publish.call_args_list]
+        self.assertEqual([event['type'] for event in events], ['BATCH', 'BATCH'])
+        self.assertEqual([event['type'] for event in events[0]['event_data']['events']],
+                         ['NODE', 'NODE', 'RELATIONSHIP', 'RELATIONSHIP'])
+        self.assertEqual(len(events[1]['event_data']['events'][2]['event_data']['data']), 1)
+        integration.publisher.flush.assert_not_called()
+
+
+class QueueBodyTest(TestCase):
+    def _get_event(self):
+        node_dict = get_node_dict(labels=['Label'], primary_key_name='key',
+                                  data=[{'key': i, 'reports': ['a', 'b'], 'name': 'Ünïcode'} for i in range(50)])
+        return get_batch_dict([node_dict, get_node_dict(labels=['Label'], primary_key_name='key', data=[])])
+
+    def test_iter_body_matches_json(self):
+        event = self._get_event()
+        self.assertEqual(b''.join(iter_body(event, block_size=100)), json.dumps(event).encode('utf-8'))
+
+    def _send_to_stub(self, compression, stream_body):
+        event = self._get_event()
+        with QueueStub(keep_events=True) as queue, \
+                patch.object(constants, 'QUEUE_COMPRESSION', compression), \
+                patch.object(constants, 'QUEUE_STREAM_BODY', stream_body), \
+                patch.object(constants, 'QUEUE_BODY_BLOCK_SIZE', 100):
+            send_to_queue(event, queue.url)
+        self.assertEqual(queue.events, [event])
+        return queue
+
+    def test_streamed_body(self):
+        self._send_to_stub(None, True)
+
+    def test_gzip_body(self):
+        queue = self._send_to_stub('gzip', False)
+        self.assertLess(queue.body_bytes, queue.json_bytes)
+        self._send_to_stub('gzip', True)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_body(self):
+        queue = self._send_to_stub('zstd', True)
+        self.assertLess(queue.body_bytes, queue.json_bytes)
+
+
+class QueueRetryTest(TestCase):
+    def setUp(self):
+        self.posted = []
+        self.landed = []
+        patches = [patch.object(constants, 'QUEUE_RETRY_TIME', 1), patch.object(constants, 'QUEUE_RETRY_MAX_TIME', 2),
+                   patch.object(constants, 'QUEUE_RETRY_JITTER', 1),
+                   patch('ad_service.utils.queue.get_session', return_value=self)]
+        for queue_patch in patches:
+            queue_patch.start()
+            self.addCleanup(queue_patch.stop)
+
+    def post(self, url, data=None, **kwargs):
+        records = json.loads(data)['event_data']['data']
+        self.posted.append(len(records))
+        status_code = self.status_code(records)
+        if status_code == 200:
+            self.landed.extend(record['key'] for record in records)
+        return Mock(status_code=status_code)
+
+    def _send(self, records=8):
+        return send_to_queue(get_node_dict(labels=['Label'], primary_key_name='key',
+                                           data=[{'key': i} for i in range(records)]), 'queue_url')
+
+    def test_transient_failure_is_retried(self):
+        responses = iter([503, 503, 200])
+        self.status_code = lambda records: next(responses)
+        self.assertEqual(self._send(), 2)
+        self.assertEqual(self.posted, [8, 8, 8])
+
+    def test_too_large_is_split(self):
+        self.status_code = lambda records: 413 if len(records) > 2 else 200
+        self._send()
+        self.assertEqual(sorted(self.landed), list(range(8)))
+        self.assertEqual(self.posted[:3], [8, 4, 2])
+
+    def test_bad_record_does_not_hold_back_the_others(self):
+        self.status_code = lambda records: 400 if any(record['key'] == 5 for record in records) else 200
+        with self.assertRaises(QueueRejected):
+            self._send()
+        self.assertEqual(sorted(self.landed), [0, 1, 2, 3, 4, 6, 7])
+
+    def test_failing_queue_stops_splitting(self):
+        self.status_code = lambda records: 500
+        with self.assertRaises(QueueSplitError):
+            self._send(records=1000)
+        self.assertLess(len(self.posted), 50)
+
+    def test_adaptive_chunk_size(self):
+        chunk_size = AdaptiveChunkSize(initial=1000, minimum=100, maximum=1200, target_latency=1, adaptive=True)
+        chunk_size.record(0.5, 0)
+        self.assertEqual(chunk_size(), 1000 + constants.QUEUE_CHUNK_SIZE_STEP)
+        chunk_size.record(0.5, 0)
+        chunk_size.record(0.5, 0)
+        self.assertEqual(chunk_size(), 1200)
+        chunk_size.record(2, 0)
+        self.assertEqual(chunk_size(), 900)
+        chunk_size.record(0.5, 1)
+        self.assertEqual(chunk_size(), 450)
+        for _ in range(5):
+            chunk_size.record(0.5, 1)
+        self.assertEqual(chunk_size(), 100)
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        for name, path in (('FINGERPRINT_DB_PATH', 'fingerprints.sqlite3'), ('OUTBOX_DB_PATH', 'outbox.sqlite3')):
+            db_patch = patch.object(constants, name, os.path.join(self.db_dir.name, path))
+            db_patch.start()
+            self.addCleanup(db_patch.stop)
+        self.sent = []
+
+    def tearDown(self):
+        self.db_dir.cleanup()
+
+    def test_only_complete_outbox_is_pending(self):
+        outbox = Outbox('ldap://test', 'queue_url', 1)
+        outbox.start()
+        outbox.add(0, 'populating nodes', {'type': 'NODE'})
+        self.assertFalse(outbox.pending())
+        outbox.commit({'a@test.com': 'fingerprint'})
+        self.assertTrue(outbox.pending())
+
+        [(stage, events)] = outbox.phases()
+        self.assertEqual(stage, 'populating nodes')
+        self.assertEqual(list(events), [(0, {'type': 'NODE'})])
+        outbox.ack(0)
+        outbox.save_acks()
+        self.assertEqual(outbox.phases(), [])
+        self.assertEqual(outbox.fingerprints(), {'a@test.com': 'fingerprint'})
+        outbox.close()
+
+    def _get_integration(self):
+        with patch('ad_service.utils.graph.get_graph'):
+            integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1, outbox=True,
+                                        streaming=False, skip_unchanged=True, full_resend=False)
+
+        def get_ldap_data():
+            for i in range(3):
+                email = 'user{0}@test.com'.format(i)
+                integration.data_to_send.add(email, i, MemberRecord(**{constants.AD_PROFILE_PRIMARY_KEY: email}))
+        integration._get_ldap_data = Mock(side_effect=get_ldap_data)
+        integration._set_last_update_time_of_changed_fields = Mock()
+        return integration
+
+    def _send(self, data_to_send, queue_url):
+        if data_to_send['type'] == 'RELATIONSHIP' and self.fail_relations:
+            raise RuntimeError('Unable to populate into queue')
+        self.sent.append(data_to_send['type'])
+        return 0
+
+    def test_failed_sync_resumes_without_fetching(self):
+        with patch('ad_service.utils.queue.send_to_queue', side_effect=self._send):
+            self.fail_relations = True
+            integration = self._get_integration()
+            with self.assertRaises(RuntimeError):
+                integration.run()
+            self.assertEqual(self.sent, ['NODE'] * 3)
+
+            self.fail_relations = False
+            self.sent = []
+            integration = self._get_integration()
+            integration.run()
+            integration._get_ldap_data.assert_not_called()
+            self.assertEqual(self.sent, ['RELATIONSHIP', 'RELATIONSHIP', 'NODE'])
+
+            self.sent = []
+            integration = self._get_integration()
+            integration.run()
+            integration._get_ldap_data.assert_called_once_with()
+            # the profiles published by the resumed sync did not change, only company and ad instance are sent
+            self.assertEqual(self.sent, ['NODE', 'NODE'])
+
+
+class USNFilterTest(TestCase):
+    def setUp(self):
+        with patch('ad_service.utils.graph.get_graph'):
+            self.integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1,
+                                             usn_incremental=True)
+        self.conn = Mock()
+        self.conn.server.info.other = {'highestCommittedUSN': ['2000'],
+                                       'dsServiceName': ['CN=NTDS Settings,CN=DC1,DC=test']}
+        ntds_settings = Mock()
+        ntds_settings.__contains__ = Mock(return_value=True)
+        ntds_settings.invocationId.value = 'invocation-1'
+        self.conn.entries = [ntds_settings]
+
+    def _get_search_filter(self, ad_instance):
+        with patch('ad_service.utils.graph.get_ad_instance', return_value=ad_instance):
+            return self.integration._get_search_filter(self.conn)
+
+    def test_same_dc_fetches_past_watermark(self):
+        search_filter = self._get_search_filter({
+            constants.AD_INSTANCE_LAST_FETCH_TIME: '20200101000000.0Z',
+            constants.AD_INSTANCE_USN_WATERMARK: 1500,
+            constants.AD_INSTANCE_DC_SERVICE_NAME: 'CN=NTDS Settings,CN=DC1,DC=test',
+            constants.AD_INSTANCE_DC_INVOCATION_ID: 'invocation-1',
+        })
+        self.assertEqual(search_filter, '(&(uSNChanged>=1501)' + constants.AD_SEARCH_FILTER + ')')
+        event = self.integration._get_ad_last_fetch_time_event()
+        self.assertEqual(event['event_data']['data'][0][constants.AD_INSTANCE_USN_WATERMARK], 2000)
+
+    def test_connection_to_other_dc_filters_on_when_changed(self):
+        search_filter = self._get_search_filter({
+            constants.AD_INSTANCE_LAST_FETCH_TIME: '20200101000000.0Z',
+            constants.AD_INSTANCE_USN_WATERMARK: 1500,
+            constants.AD_INSTANCE_DC_SERVICE_NAME: 'CN=NTDS Settings,CN=DC1,DC=test',
+            constants.AD_INSTANCE_DC_INVOCATION_ID: 'invocation-1',
+        })
+        self.assertEqual(self.integration._get_changed_filter(self.conn), '(uSNChanged>=1501)')
+
+        # another pooled connection of the url, bound to the second DC
+        other_dc = Mock(entries=self.conn.entries)
+        other_dc.server.info.other = {'highestCommittedUSN': ['9000'],
+                                      'dsServiceName': ['CN=NTDS Settings,CN=DC2,DC=test']}
+        self.assertEqual(self.integration._get_changed_filter(other_dc), '(whenChanged>=20200101000000.0Z)')
+        partition = (self.integration.ad_search_base, SUBTREE, '(&(!(sAMAccountName>=m))' + search_filter + ')')
+        with patch.object(self.integration, '_connection', return_value=nullcontext(other_dc)), \
+                patch.object(self.integration, '_iter_ldap_pages', return_value=[]) as mock_pages:
+            self.integration._fetch_partition(partition, Mock(), threading.Event())
+        self.assertEqual(mock_pages.call_args[0][3], '(&(!(sAMAccountName>=m))(&(whenChanged>=20200101000000.0Z)' +
+                         constants.AD_SEARCH_FILTER + '))')
+
+    def test_full_resend_fetches_everything(self):
+        self.integration.full_resend = True
+        search_filter = self._get_search_filter({
+            constants.AD_INSTANCE_LAST_FETCH_TIME: '20200101000000.0Z',
+            constants.AD_INSTANCE_USN_WATERMARK: 1500,
+            constants.AD_INSTANCE_DC_SERVICE_NAME: 'CN=NTDS Settings,CN=DC1,DC=test',
+            constants.AD_INSTANCE_DC_INVOCATION_ID: 'invocation-1',
+        })
+        self.assertEqual(search_filter, constants.AD_SEARCH_FILTER)
+        self.assertTrue(self.integration.resent_everything)
+        # the watermark of the re-send is still stored for the next sync
+        event = self.integration._get_ad_last_fetch_time_event()
+        self.assertEqual(event['event_data']['data'][0][constants.AD_INSTANCE_USN_WATERMARK], 2000)
+
+    def test_restored_dc_fetches_everything(self):
+        search_filter = self._get_search_filter({
+            constants.AD_INSTANCE_LAST_FETCH_TIME: '20200101000000.0Z',
+            constants.AD_INSTANCE_USN_WATERMARK: 1500,
+            constants.AD_INSTANCE_DC_SERVICE_NAME: 'CN=NTDS Settings,CN=DC1,DC=test',
+            constants.AD_INSTANCE_DC_INVOCATION_ID: 'invocation-0',
+        })
+        self.assertEqual(search_filter, constants.AD_SEARCH_FILTER)
+
+    def test_without_watermark_uses_last_fetch_time(self):
+        search_filter = self._get_search_filter({constants.AD_INSTANCE_LAST_FETCH_TIME: '20200101000000.0Z'})
+        self.assertEqual(search_filter, '(&(whenChanged>=20200101000000.0Z)' + constants.AD_SEARCH_FILTER + ')')
+
+        self.conn.server.info.other = {}
+        self.assertEqual(self._get_search_filter({}), constants.AD_SEARCH_FILTER)
+        self.assertNotIn(constants.AD_INSTANCE_USN_WATERMARK,
+                         self.integration._get_ad_last_fetch_time_event()['event_data']['data'][0])
+
+
+class WarmUpTest(TestCase):
+    def test_secrets_are_read_on_first_use(self):
+        with tempfile.TemporaryDirectory() as tmp, patch.object(security, '_secrets', None), \
+                patch('ad_service.utils.security.os.getcwd', return_value=tmp):
+            with open(os.path.join(tmp, 'security_secrets.yaml'), 'w') as stream:
+                yaml.dump({'ENCRYPTION_KEY': 'key'}, stream)
+            self.assertEqual(security.encryption_key, 'key')
+            os.remove(os.path.join(tmp, 'security_secrets.yaml'))
+            self.assertEqual(security.get_encryption_key(), 'key')
+
+    def test_failing_step_does_not_stop_the_others(self):
+        steps = [Mock(side_effect=IOError('no secrets')), Mock()]
+        with patch.object(warmup, 'WARM_UP_STEPS', (('secrets', steps[0]), ('urlconf', steps[1]))):
+            timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['secrets', 'urlconf'])
+        steps[1].assert_called_once_with()
+
+    def test_warm_up_loads_the_integration(self):
+        with patch.object(jobs, 'ADIntegration', None):
+            warmup.warm_up()
+            self.assertIs(jobs.ADIntegration, ADIntegration)
+
+
+class LDAPConnectionManagerTest(TestCase):
+    def setUp(self):
+        patcher = patch('ad_service.utils.ldap.Connection', side_effect=self._connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connections = []
+        self.manager = LDAPConnectionManager(max_connections=2, max_idle=1, ttl=60, health_check_idle=10)
+
+    def _connect(self, server, user, password, auto_bind):
+        conn = Mock(server=server, user=user, closed=False, bound=True)
+        self.connections.append(conn)
+        return conn
+
+    def test_reuses_connection_of_same_user_and_password(self):
+        with self.manager.connection('ldap://test', 'admin', 'secret') as conn:
+            pass
+        with self.manager.connection('ldap://test', 'admin', 'secret') as reused:
+            self.assertIs(reused, conn)
+        with self.manager.connection('ldap://test', 'admin', 'changed') as other:
+            self.assertIsNot(other, conn)
+        self.assertEqual(len(self.connections), 2)
+        # both binds share the server, only the first one reads the schema
+        self.assertIs(other.server, conn.server)
+        self.assertEqual(conn.server.get_info, 'DSA')
+
+    def test_unbinds_connection_whose_user_raised(self):
+        with self.assertRaises(ValueError):
+            with self.manager.connection('ldap://test', 'admin', 'secret') as conn:
+                raise ValueError('half way through a paged search')
+        conn.unbind.assert_called_once_with()
+        with self.manager.connection('ldap://test', 'admin', 'secret') as other:
+            self.assertIsNot(other, conn)
+
+    def test_drops_expired_and_unhealthy_connections(self):
+        with patch('ad_service.utils.ldap.time.monotonic', return_value=0):
+            with self.manager.connection('ldap://test', 'admin', 'secret') as conn:
+                pass
+        conn.search.return_value = False
+        with patch('ad_service.utils.ldap.time.monotonic', return_value=30):
+            with self.manager.connection('ldap://test', 'admin', 'secret') as checked:
+                self.assertIsNot(checked, conn)
+        conn.unbind.assert_called_once_with()
+
+        with patch('ad_service.utils.ldap.time.monotonic', return_value=100):
+            with self.manager.connection('ldap://test', 'admin', 'secret') as expired:
+                self.assertIsNot(expired, checked)
+        checked.unbind.assert_called_once_with()
+
+    def test_bounds_connections_in_use_per_server(self):
+        with self.manager.connection('ldap://test', 'admin', 'secret'), \
+                self.manager.connection('ldap://test', 'other', 'secret'):
+            with self.assertRaises(LDAPPoolTimeout):
+                with self.manager.connection('ldap://test', 'admin', 'secret', timeout=0):
+                    pass
+            with self.manager.connection('ldap://other', 'admin', 'secret', timeout=0):
+                pass
+
+    def test_check_credentials_on_busy_server(self):
+        payload = {'ldap_url': 'ldap://test', 'ldap_username': 'admin', 'ldap_password': 'secret',
+                   'ldap_search_base': 'test', 'integration_id': 1, 'state': 'state'}
+        with patch('ad_service.utils.ldap.get_connection_manager', return_value=self.manager), \
+                patch.object(constants, 'LDAP_CHECK_CREDENTIALS_WAIT', 0):
+            with self.manager.connection('ldap://test', 'admin', 'secret'), \
+                    self.manager.connection('ldap://test', 'other', 'secret'):
+                response = self.client.post('/api/check_credentials', payload)
+            self.assertEqual(response.status_code, 503)
+
+            response = self.client.post('/api/check_credentials', payload)
+            self.assertEqual(response.status_code, 200)
+
+
+class PageSizeTest(TestCase):
+    def test_adapts_within_limits(self):
+        page_size = AdaptivePageSize(1000, minimum=100, maximum=1500, target_latency=2, target_bytes=1000000,
+                                     adaptive=True)
+        page_size.record(0.5, 1000, 100000)
+        self.assertEqual(page_size(), 1000 + constants.LDAP_PAGE_SIZE_STEP)
+        for _ in range(10):
+            page_size.record(0.5, page_size(), 100000)
+        self.assertEqual(page_size(), 1500)
+        # a short last page says nothing
+        page_size.record(0.1, 20, 2000)
+        self.assertEqual(page_size(), 1500)
+        page_size.record(3, 1500, 100000)
+        self.assertEqual(page_size(), 1125)
+        page_size.record(0.5, 1125, 2000000)
+        self.assertEqual(page_size(), 843)
+
+        fixed = AdaptivePageSize(1000, maximum=800, adaptive=False)
+        fixed.record(10, 800, 100)
+        self.assertEqual(fixed(), 800)
+
+    def test_reads_max_page_size_of_query_policy(self):
+        policies = {
+            'CN=NTDS Settings,CN=DC1': {'queryPolicyObject': 'CN=Small,CN=Query-Policies'},
+            'CN=Small,CN=Query-Policies': {'lDAPAdminLimits': ['MaxConnections=5000', 'MaxPageSize=250']},
+        }
+
+        class PolicyConnection:
+            server = Mock(info=Mock(other={'configurationNamingContext': ['CN=Configuration,DC=test'],
+                                           'dsServiceName': ['CN=NTDS Settings,CN=DC1']}))
+            response = []
+
+            def search(self, search_base, search_filter, search_scope, attributes):
+                self.response = [{'type': 'searchResEntry', 'attributes': policies.get(search_base, {})}]
+
+        self.assertEqual(read_max_page_size(PolicyConnection()), 250)
+        del policies['CN=NTDS Settings,CN=DC1']
+        policies['CN=Default Query Policy,CN=Query-Policies,CN=Directory Service,CN=Windows NT,CN=Services,'
+                 'CN=Configuration,DC=test'] = {'lDAPAdminLimits': ['MaxPageSize=2000']}
+        self.assertEqual(read_max_page_size(PolicyConnection()), 2000)
+        self.assertIsNone(read_max_page_size(Mock(server=Mock(info=None))))
+
+        manager = LDAPConnectionManager()
+        with patch('ad_service.utils.ldap.read_max_page_size', return_value=2000) as mock_read:
+            manager.get_max_page_size('ldap://test', None)
+            self.assertEqual(manager.get_max_page_size('ldap://test', None), 2000)
+        mock_read.assert_called_once_with(None)
+
+    def test_rate_limit(self):
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        rate_limit = RequestRateLimit(10, burst=2)
+        with patch('ad_service.utils.ldap.time.monotonic', side_effect=lambda: clock[0]), \
+                patch('ad_service.utils.ldap.time.sleep', side_effect=sleep):
+            rate_limit._updated_at = 0.0
+            self.assertEqual([rate_limit.acquire() for _ in range(4)], [0, 0, 0.1, 0.1])
+        self.assertAlmostEqual(clock[0], 0.2)
+
+        manager = LDAPConnectionManager()
+        self.assertIsNone(manager.get_rate_limit('ldap://test'))
+        with patch.object(constants, 'LDAP_MAX_REQUESTS_PER_SECOND_BY_URL', {'ldap://small': 5}):
+            self.assertEqual(manager.get_rate_limit('ldap://small').rate, 5)
+            self.assertIs(manager.get_rate_limit('ldap://small'), manager.get_rate_limit('ldap://small'))
+
+
+class OrgHierarchyTest(TestCase):
+    def setUp(self):
+        self.hierarchy = OrgHierarchy()
+        self.hierarchy.add('ceo@test.com', 'CN=CEO,DC=test', '')
+        self.hierarchy.add('vp@test.com', 'CN=VP,DC=test', 'cn=ceo, dc=test')
+        self.hierarchy.add('dev@test.com', 'CN=Dev,DC=test', 'CN=VP,DC=test')
+        self.hierarchy.add('ops@test.com', 'CN=Ops,DC=test', 'CN=VP,DC=test')
+        self.hierarchy.add('contractor@test.com', 'CN=Contractor,DC=test', 'CN=Agency,DC=other')
+
+    def test_depths_and_spans(self):
+        self.assertEqual(self.hierarchy.manager_of('vp@test.com'), 'ceo@test.com')
+        self.assertEqual(self.hierarchy.get_depths_and_spans(), {
+            'ceo@test.com': (0, 1),
+            'vp@test.com': (1, 2),
+            'dev@test.com': (2, 0),
+            'ops@test.com': (2, 0),
+            'contractor@test.com': (0, 0),
+        })
+        self.assertEqual(self.hierarchy.get_unresolved_manager_dns(), {'CN=Agency,DC=other'})
+
+    def test_manager_loop_is_cut(self):
+        self.hierarchy.add('ceo@test.com', 'CN=CEO,DC=test', 'CN=Dev,DC=test')
+        depths_and_spans = self.hierarchy.get_depths_and_spans()
+        self.assertEqual(sorted(depth for depth, _ in depths_and_spans.values()), [0, 0, 1, 1, 2])
+        self.assertEqual(depths_and_spans['dev@test.com'][1], 1)
+
+    def test_reporting_line_events(self):
+        with patch('ad_service.utils.graph.get_graph'):
+            integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1)
+        integration.hierarchy = self.hierarchy
+
+        events = list(integration._iter_reporting_line_events())
+        self.assertEqual([event['type'] for event in events], ['NODE', 'RELATIONSHIP'])
+        self.assertIn({constants.PERSON_PRIMARY_KEY: 'vp@test.com', constants.PERSON_REPORTING_DEPTH: 1,
+                       constants.PERSON_SPAN_OF_CONTROL: 2}, events[0]['event_data']['data'])
+        self.assertEqual(events[1]['event_data']['type'], constants.PERSON_MANAGER_RELATION)
+        self.assertEqual(len(events[1]['event_data']['data']), 3)
+
+        # an incremental sync resolves the managers it did not fetch in the graph and leaves depths alone
+        integration.incremental = True
+        with patch('ad_service.utils.graph.get_emails_by_distinguished_names',
+                   return_value={'CN=Agency,DC=other': 'agency@other.com'}) as mock_lookup:
+            events = list(integration._iter_reporting_line_events(['contractor@test.com']))
+        mock_lookup.assert_called_once_with(integration.graph, ['CN=Agency,DC=other'])
+        self.assertEqual([event['type'] for event in events], ['RELATIONSHIP'])
+        self.assertEqual(events[0]['event_data']['data'][0]['node_to_primary_key_value'], 'agency@other.com')
+
+    def test_changed_manager_removes_stale_reporting_line(self):
+        with patch('ad_service.utils.graph.get_graph'):
+            integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1)
+        integration.hierarchy = self.hierarchy
+        record = MemberRecord(**{constants.AD_PROFILE_PRIMARY_KEY: 'dev@test.com', 'manager': 'CN=VP,DC=test'})
+        integration.data_to_send.add('dev@test.com', 1, record)
+        # dev reported to the ceo when last published
+        previous = {constants.AD_PROFILE_PRIMARY_KEY: 'dev@test.com', 'manager': 'CN=CEO,DC=test', 'lastUpdateTime': 1}
+        previous.update({key: '' for key in integration.keys_to_track})
+        previous.update({key + 'UpdateTime': 1 for key in integration.keys_to_track})
+        with patch('ad_service.utils.graph.get_ad_profiles_by_emails', return_value=[previous]):
+            integration._set_last_update_time_of_changed_fields()
+        self.assertEqual(integration.previous_manager_dns, {'dev@test.com': 'CN=CEO,DC=test'})
+
+        events = list(integration._iter_reporting_line_events(['dev@test.com']))
+        self.assertEqual([event['type'] for event in events], ['RELATIONSHIP_DELETE', 'NODE', 'RELATIONSHIP'])
+        self.assertEqual(events[0]['event_data']['type'], constants.PERSON_MANAGER_RELATION)
+        self.assertEqual([(data['node_from_primary_key_value'], data['node_to_primary_key_value'])
+                          for data in events[0]['event_data']['data']], [('dev@test.com', 'ceo@test.com')])
+        self.assertEqual(events[2]['event_data']['data'][0]['node_to_primary_key_value'], 'vp@test.com')
+
+    def test_only_changed_depths_and_spans_are_sent(self):
+        with patch('ad_service.utils.graph.get_graph'):
+            integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1,
+                                        skip_unchanged=True, full_resend=False)
+        integration.hierarchy = self.hierarchy
+        with tempfile.TemporaryDirectory() as directory:
+            integration.fingerprints = FingerprintStore('ldap://test', 'queue_url', 1,
+                                                        path=os.path.join(directory, 'fp.sqlite3'))
+            list(integration._iter_reporting_line_events())
+            integration.fingerprints.commit()
+
+            # ops moves under the ceo: the spans of vp and ceo and the depth of ops change
+            self.hierarchy.add('ops@test.com', 'CN=Ops,DC=test', 'CN=CEO,DC=test')
+            events = list(integration._iter_reporting_line_events())
+            integration.fingerprints.close()
+        self.assertEqual([event['type'] for event in events], ['NODE', 'RELATIONSHIP'])
+        self.assertEqual({data[constants.PERSON_PRIMARY_KEY]: (data[constants.PERSON_REPORTING_DEPTH],
+                                                               data[constants.PERSON_SPAN_OF_CONTROL])
+                          for data in events[0]['event_data']['data']},
+                         {'ceo@test.com': (0, 2), 'vp@test.com': (1, 1), 'ops@test.com': (1, 0)})
+
+
+class NormalizeTest(TestCase):
+    def setUp(self):
+        with patch('ad_service.utils.graph.get_graph'):
+            self.integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1)
+        self.attributes = {
+            constants.AD_EMAIL: 'Test@Test.com',
+            constants.AD_FIRST_NAME: [],
+            constants.AD_LAST_NAME: 'surname ',
+            constants.AD_NAME: 'first last',
+            constants.AD_CITY: 'Dubai',
+            constants.AD_COUNTRY: 'UAE',
+            constants.AD_MANAGER: 'CN=Manager,DC=test',
+            constants.AD_DIRECT_REPORTS: ['CN=Report,DC=test'],
+            constants.AD_WHEN_CREATED: datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        }
+
+    def test_populate_page_reads_raw_response(self):
+        response = [
+            {'type': 'searchResEntry', 'dn': 'CN=Test,DC=test', 'attributes': self.attributes},
+            {'type': 'searchResEntry', 'dn': 'CN=Nobody,DC=test', 'attributes': {constants.AD_EMAIL: []}},
+            {'type': 'searchResRef', 'uri': ['ldap://other/DC=test']},
+        ]
+        with patch('ad_service.ad_integration.onboard_and_update.get_milliseconds_since_epoch',
+                   return_value=1000) as mock_clock:
+            self.integration._populate_page(response)
+        mock_clock.assert_called_once_with()
+        self.assertEqual((self.integration.done, self.integration.not_done), (1, 1))
+
+        record = self.integration.data_to_send['test@test.com']
+        self.assertEqual(record['first_name'], 'first')
+        self.assertEqual(record['last_name'], 'surname')
+        self.assertEqual(record['location'], 'Dubai, UAE')
+        self.assertEqual(record['direct_reports'], ['CN=Report,DC=test'])
+        self.assertEqual(record['division'], '')
+        self.assertEqual(record['created_at'], 1577836800000)
+        self.assertEqual(record['last_update_time'], 1000)
+        self.assertEqual(record['title_update_time'], 1000)
+
+    def test_entry_path_matches_raw_path(self):
+        entry = {key: ADValue(value[0] if isinstance(value, list) and len(value) == 1 else value or None)
+                 for key, value in self.attributes.items()}
+        self.integration._populate(entry)
+        entry_record = self.integration.data_to_send['test@test.com'].to_dict()
+
+        self.integration.data_to_send = MemberRecordStore()
+        self.integration._populate_page([{'type': 'searchResEntry', 'attributes': self.attributes}])
+        raw_record = self.integration.data_to_send['test@test.com'].to_dict()
+        for record in (entry_record, raw_record):
+            for key in [key for key in record if key.endswith('update_time')]:
+                del record[key]
+        self.assertEqual(entry_record, raw_record)
+
+
+class TransformPoolTest(TestCase):
+    def setUp(self):
+        def user(email, when_created, last_name='Last'):
+            return {'type': 'searchResEntry', 'attributes': {
+                constants.AD_EMAIL: [email],
+                constants.AD_LAST_NAME: [last_name],
+                constants.AD_NAME: ['First ' + last_name],
+                constants.AD_DISTINGUISHED_NAME: 'CN={0},DC=test'.format(email),
+                constants.AD_WHEN_CREATED: datetime.datetime(2020, 1, when_created, tzinfo=datetime.timezone.utc),
+            }}
+        self.pages = [
+            [user('a@test.com', 2), user('b@test.com', 1), user('digits@test.com', 1, last_name='L4st')],
+            [user('A@test.com', 1, last_name='Earlier'), {'type': 'searchResRef', 'uri': ['ldap://other/DC=test']}],
+            [user('b@test.com', 3, last_name='Later'), user('c@test.com', 1)],
+        ]
+
+    def populate(self, transform_processes, skip_unchanged=False):
+        with patch('ad_service.utils.graph.get_graph'):
+            integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1,
+                                        transform_processes=transform_processes, skip_unchanged=skip_unchanged)
+        with patch('ad_service.ad_integration.onboard_and_update.get_milliseconds_since_epoch', return_value=1000):
+            list(integration._populate_pages(iter(self.pages)))
+        return integration
+
+    def test_pool_matches_sync_thread(self):
+        inline = self.populate(0)
+        pooled = self.populate(2)
+        self.assertEqual((pooled.done, pooled.not_done), (inline.done, inline.not_done))
+        self.assertEqual([record.to_dict() for record in pooled.data_to_send],
+                         [record.to_dict() for record in inline.data_to_send])
+        # the earliest created record of an email wins across pages
+        self.assertEqual(pooled.data_to_send['a@test.com']['last_name'], 'Earlier')
+        self.assertEqual(pooled.data_to_send['b@test.com']['last_name'], 'Last')
+        self.assertEqual(pooled.hierarchy.resolve('cn=a@test.com,dc=test'), 'a@test.com')
+
+    def test_pool_is_not_forked(self):
+        self.assertEqual(ADIntegration._get_transform_context().get_start_method(), 'forkserver')
+        with patch.object(constants, 'TRANSFORM_START_METHOD', 'unknown'):
+            self.assertEqual(ADIntegration._get_transform_context().get_start_method(), 'spawn')
+
+    def test_pool_fingerprints_records(self):
+        self.assertEqual(self.populate(1).transformed_fingerprints, {})
+        pooled = self.populate(1, skip_unchanged=True)
+        with tempfile.TemporaryDirectory() as directory:
+            fingerprints = FingerprintStore('ldap://test', 'queue_url', 1, path=os.path.join(directory, 'fp.sqlite3'))
+            expected = {record['primaryEmail']: fingerprints.fingerprint(record) for record in pooled.data_to_send}
+            fingerprints.close()
+        self.assertEqual(pooled.transformed_fingerprints, expected)
+
+
+class GroupSyncTest(TestCase):
+    def setUp(self):
+        self.members = {
+            'CN=Eng,DC=test': ['CN=A,DC=test', 'CN=B,DC=test', 'cn=c, dc=test', 'CN=Ops,DC=test', 'CN=Gone,DC=test'],
+            'CN=Ops,DC=test': ['CN=C,DC=test'],
+        }
+        self.guids = {'CN=Eng,DC=test': 'g1', 'CN=Ops,DC=test': 'g2'}
+        with patch('ad_service.utils.graph.get_graph'):
+            self.integration = ADIntegration('ldap://test', 'test', 'test', 'test', 'graph_url', 'queue_url', 1,
+                                             sync_groups=True)
+        for email in ('a', 'b', 'c'):
+            self.integration.hierarchy.add(email + '@test.com', 'CN={0},DC=test'.format(email.upper()), '')
+
+    def ranged(self, dn, low, size):
+        # what AD answers a member;range=low-high request with, the last range ends with *
+        members = self.members[dn]
+        high = '*' if low + size >= len(members) else low + size - 1
+        return {'member;range={0}-{1}'.format(low, high): members[low:low + size]}
+
+    def connection(self):
+        test = self
+
+        class GroupConnection:
+            auto_range = True
+            response = []
+            result = {'controls': {PAGED_RESULTS_CONTROL: {'value': {'cookie': b''}}}}
+            searches = []
+
+            def search(self, search_base, search_filter, search_scope, attributes, paged_size=None,
+                       paged_cookie=None):
+                self.searches.append((search_base, search_filter, search_scope))
+                ranges = [attribute for attribute in attributes if attribute.startswith('member;range=')]
+                low, size = 0, 0
+                if ranges:
+                    low, high = map(int, ranges[0][len('member;range='):].split('-'))
+                    size = high - low + 1
+                dns = [search_base] if search_scope == BASE else list(test.members)
+                self.response = []
+                for dn in dns:
+                    attributes = {constants.AD_GUID: test.guids[dn], constants.AD_DISTINGUISHED_NAME: dn,
+                                  constants.AD_GROUP_NAME: dn[3:6]}
+                    if ranges:
+                        attributes.update(test.ranged(dn, low, size))
+                    self.response.append({'type': 'searchResEntry', 'dn': dn, 'raw_dn': dn.encode(),
+                                          'attributes': attributes, 'raw_attributes': {}})
+
+        conn = GroupConnection()
+
+        @contextmanager
+        def connection():
+            yield conn
+        return conn, connection
+
+    def test_member_range(self):
+        self.assertEqual(get_member_range({'member;range=0-1': ['a', 'b']}, 'member'), (['a', 'b'], 2))
+        self.assertEqual(get_member_range({'Member;range=2-*': ['c']}, 'member'), (['c'], None))
+        self.assertEqual(get_member_range({'member': ['a']}, 'member'), (['a'], None))
+        self.assertEqual(get_member_range({'cn': 'Eng'}, 'member'), ([], None))
+        self.assertEqual(get_range_attribute('member', 1500, 1500), 'member;range=1500-2999')
+
+    def test_resolver_caches_graph_lookups(self):
+        resolver = MemberResolver(self.integration.hierarchy)
+        resolver.add_group('CN=Ops,DC=test', 'g2')
+        lookup_people = Mock(return_value={'CN=D,DC=other': 'd@other.com'})
+        lookup_groups = Mock(return_value={})
+        dns = ['cn=a,dc=test', 'CN=Ops, DC=test', 'CN=D,DC=other', 'CN=Gone,DC=test']
+        expected = {'cn=a,dc=test': (PERSON, 'a@test.com'), 'CN=Ops, DC=test': (GROUP, 'g2'),
+                    'CN=D,DC=other': (PERSON, 'd@other.com')}
+        self.assertEqual(resolver.resolve_all(dns, lookup_people, lookup_groups), expected)
+        # found or not, a DN is looked up once
+        self.assertEqual(resolver.resolve_all(dns, lookup_people, lookup_groups), expected)
+        lookup_people.assert_called_once_with(['CN=D,DC=other', 'CN=Gone,DC=test'])
+        lookup_groups.assert_called_once_with(['CN=Gone,DC=test'])
+
+    def test_group_events_with_ranged_members(self):
+        conn, connection = self.connection()
+        manager = Mock(get_max_page_size=Mock(return_value=None), get_rate_limit=Mock(return_value=None))
+        with patch.object(self.integration, '_connection', connection), \
+                patch('ad_service.ad_integration.onboard_and_update.get_connection_manager', return_value=manager), \
+                patch.object(constants, 'AD_GROUP_MEMBER_RANGE_SIZE', 2):
+            nodes = list(self.integration._iter_group_node_events())
+            relations = list(self.integration._iter_group_membership_events())
+
+        self.assertEqual([group[constants.GROUP_PRIMARY_KEY] for group in nodes[0]['event_data']['data']],
+                         ['g1', 'g2'])
+        # Eng has 5 members: the first range comes with the page, two base searches read the rest
+        self.assertEqual([search[2] for search in conn.searches], [SUBTREE, SUBTREE, BASE, BASE])
+        self.assertTrue(conn.auto_range)
+        self.assertEqual([event['event_data']['type'] for event in relations],
+                         [constants.GROUP_COMPANY_RELATION, constants.GROUP_MEMBER_RELATION,
+                          constants.GROUP_MEMBER_RELATION])
+
+        def pairs(event):
+            return sorted((data['node_from_primary_key_value'], data['node_to_primary_key_value'])
+                          for data in event['event_data']['data'])
+        self.assertEqual(pairs(relations[0]), [('g1', 1), ('g2', 1)])
+        self.assertEqual(pairs(relations[1]), [('a@test.com', 'g1'), ('b@test.com', 'g1'), ('c@test.com', 'g1'),
+                                               ('c@test.com', 'g2')])
+        self.assertEqual(relations[2]['event_data']['from']['labels'], constants.GROUP_LABELS)
+        self.assertEqual(pairs(relations[2]), [('g2', 'g1')])
+
+    def test_incremental_sync_fetches_changed_groups(self):
+        conn = Mock()
+        self.assertEqual(self.integration._get_group_search_filter(conn), constants.AD_GROUP_SEARCH_FILTER)
+        self.integration.incremental = True
+        self.integration.changed_filter = self.integration.when_changed_filter = '(whenChanged>=20200101000000.0Z)'
+        self.assertEqual(self.integration._get_group_search_filter(conn),
+                         '(&(whenChanged>=20200101000000.0Z)' + constants.AD_GROUP_SEARCH_FILTER + ')')
+
+
+class GraphRegistryTest(TestCase):
+    def setUp(self):
+        patcher = patch.dict('ad_service.utils.graph._graphs', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shares_one_client_per_graph_url(self):
+        with patch('ad_service.utils.graph.Graph') as mock_graph:
+            graph = get_graph('http://graph', bolt=False)
+            self.assertIs(get_graph('http://graph', bolt=False), graph)
+            get_graph('http://graph', bolt=True)
+            get_graph('http://other', bolt=False)
+        self.assertEqual(mock_graph.call_count, 3)
+        _, bolt_settings = mock_graph.call_args_list[1]
+        self.assertEqual(bolt_settings['protocol'], 'bolt')
+        self.assertEqual(bolt_settings['port'], constants.GRAPH_BOLT_PORT)
+        self.assertEqual(bolt_settings['max_size'], constants.GRAPH_MAX_CONNECTIONS)
+
+    def test_unreachable_graph_is_not_kept(self):
+        with patch('ad_service.utils.graph.Graph', side_effect=[ConnectionRefusedError(), Mock()]) as mock_graph:
+            with self.assertRaises(ConnectionRefusedError):
+                get_graph('http://graph')
+            get_graph('http://graph')
+        self.assertEqual(mock_graph.call_count, 2)
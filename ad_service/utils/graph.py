@@ -1,18 +1,82 @@
+import threading
+
+from py2neo import Graph
+
 import ad_service.utils.config as constants
 
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def get_graph(graph_url, bolt=None):
+    """
+    Graph client of the graph url, shared by every sync of the process. Its pool keeps up to
+    config.GRAPH_MAX_CONNECTIONS connections open, so a sync does not connect to the graph again.
+    :param bolt: talk Bolt on config.GRAPH_BOLT_PORT instead of HTTP (defaults to config.GRAPH_BOLT)
+    """
+    bolt = constants.GRAPH_BOLT if bolt is None else bolt
+    key = (graph_url, bolt)
+    with _graphs_lock:
+        if key not in _graphs:
+            settings = {'max_size': constants.GRAPH_MAX_CONNECTIONS, 'max_age': constants.GRAPH_CONNECTION_MAX_AGE}
+            if bolt:
+                settings.update(protocol='bolt', port=constants.GRAPH_BOLT_PORT)
+            # connects right away, a graph that cannot be reached is not kept
+            _graphs[key] = Graph(graph_url, **settings)
+        return _graphs[key]
+
+
+def get_ad_profiles_by_emails(graph, emails, batch_size=None):
+    """
+    Look up the ADProfiles of the given emails through the primaryEmail index, in batches of batch_size.
+    The queries only differ in their parameters, so the graph plans them once.
+    :return: iterator over the ADProfile nodes, streamed from the query cursors
+    """
+    batch_size = batch_size or constants.GRAPH_LOOKUP_BATCH_SIZE
+    query = "unwind $emails as email match (n:{0} {{{1}: email}}) return n".format(constants.AD_PROFILE_LABELS[1],
+                                                                                 constants.AD_PROFILE_PRIMARY_KEY)
+    for i in range(0, len(emails), batch_size):
+        for record in graph.run(query, emails=emails[i:i + batch_size]):
+            yield record.get('n')
+
+
+def get_emails_by_distinguished_names(graph, distinguished_names, batch_size=None):
+    """
+    Look up the emails of the ADProfiles of the given distinguished names, in batches of batch_size
+    :return: {distinguished name: email}
+    """
+    batch_size = batch_size or constants.GRAPH_LOOKUP_BATCH_SIZE
+    query = "unwind $dns as dn match (n:{0} {{{1}: dn}}) return n.{1} as dn, n.{2} as email".format(
+        constants.AD_PROFILE_LABELS[1], constants.AD_PROFILE_DISTINGUISHED_NAME, constants.AD_PROFILE_PRIMARY_KEY)
+    emails = {}
+    for i in range(0, len(distinguished_names), batch_size):
+        for record in graph.run(query, dns=distinguished_names[i:i + batch_size]):
+            emails[record.get('dn')] = record.get('email')
+    return emails
+
 
-def get_ad_profiles(graph):
-    query = "match (n:ADProfile) return n"
-    users = []
-    for record in graph.run(query):
-        users.append(record.get('n'))
-    return users
+def get_group_guids_by_distinguished_names(graph, distinguished_names, batch_size=None):
+    """
+    Look up the guids of the ADGroups of the given distinguished names, in batches of batch_size
+    :return: {distinguished name: guid}
+    """
+    batch_size = batch_size or constants.GRAPH_LOOKUP_BATCH_SIZE
+    query = "unwind $dns as dn match (n:{0} {{{1}: dn}}) return n.{1} as dn, n.{2} as guid".format(
+        constants.GROUP_LABELS[0], constants.GROUP_DISTINGUISHED_NAME, constants.GROUP_PRIMARY_KEY)
+    guids = {}
+    for i in range(0, len(distinguished_names), batch_size):
+        for record in graph.run(query, dns=distinguished_names[i:i + batch_size]):
+            guids[record.get('dn')] = record.get('guid')
+    return guids
 
 
-def get_ldap_last_fetch_time(graph, ldap_url):
-    query = "match (n:{0} {{instanceUrl: \"{1}\"}}) return n.{2}".format(constants.AD_INSTANCE_LABELS[0], ldap_url,
-                                                                         constants.AD_INSTANCE_LAST_FETCH_TIME)
-    last_fetch_time = None
-    for record in graph.run(query):
-        last_fetch_time = record[0]
-    return last_fetch_time
+def get_ad_instance(graph, ldap_url):
+    """
+    :return: properties of the ADInstance node of the ldap url, empty if it was never synced
+    """
+    query = "match (n:{0} {{{1}: $ldap_url}}) return n".format(constants.AD_INSTANCE_LABELS[0],
+                                                             constants.AD_INSTANCE_PRIMARY_KEY)
+    ad_instance = {}
+    for record in graph.run(query, ldap_url=ldap_url):
+        ad_instance = dict(record.get('n'))
+    return ad_instance
@@ -0,0 +1,335 @@
+"""
+Bound ldap connections shared by the credential checks and the syncs of a process.
+Connections are pooled per (url, bind user, password hash) and reused until config.LDAP_CONNECTION_TTL, the
+Server of a url keeps the schema it downloaded with its first bind so later binds only read the root DSE.
+The paged searches of the syncs size their pages with AdaptivePageSize, within the MaxPageSize of the DC's query
+policy, and can be held to a request rate per url.
+"""
+import atexit
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
+from ldap3 import Server, Connection, ALL, DSA, BASE, NO_ATTRIBUTES
+from ldap3.core.exceptions import LDAPException
+
+from ad_service.utils import config
+
+logger = config.LOGGER
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class LDAPPoolTimeout(Exception):
+    pass
+
+
+# query policy of the DCs that have none of their own, under the configuration naming context
+_DEFAULT_QUERY_POLICY = 'CN=Default Query Policy,CN=Query-Policies,CN=Directory Service,CN=Windows NT,CN=Services,'
+
+
+def get_response_size(response):
+    """
+    Bytes of dn and attribute values in a search response, a close lower bound of the BER bytes on the wire
+    """
+    size = 0
+    for item in response:
+        if item.get('type') != 'searchResEntry':
+            continue
+        size += len(item['raw_dn'])
+        for name, values in item['raw_attributes'].items():
+            size += len(name) + sum(len(value) for value in values)
+    return size
+
+
+def read_max_page_size(conn):
+    """
+    MaxPageSize of the LDAP query policy of the DC the connection is bound to: the policy set on its NTDS settings,
+    else the default policy of the forest
+    :return: None when the server is no AD DC or the policy can not be read
+    """
+    root_dse = conn.server.info.other if conn.server.info is not None else {}
+    if not root_dse.get('configurationNamingContext'):
+        return None
+    policies = [_DEFAULT_QUERY_POLICY + root_dse['configurationNamingContext'][0]]
+    try:
+        if root_dse.get('dsServiceName'):
+            conn.search(root_dse['dsServiceName'][0], '(objectClass=*)', BASE, attributes=['queryPolicyObject'])
+            if conn.response and conn.response[0].get('attributes', {}).get('queryPolicyObject'):
+                policies.insert(0, conn.response[0]['attributes']['queryPolicyObject'])
+        for policy in policies:
+            conn.search(policy, '(objectClass=*)', BASE, attributes=['lDAPAdminLimits'])
+            limits = conn.response[0].get('attributes', {}).get('lDAPAdminLimits', []) if conn.response else []
+            for limit in limits:
+                name, _, value = limit.partition('=')
+                if name.lower() == 'maxpagesize' and value.strip().isdigit():
+                    return int(value)
+    except LDAPException as e:
+        logger.info('Reading the query policy of {0} failed {1}'.format(conn.server, repr(e)))
+    return None
+
+
+@contextmanager
+def manual_range(conn):
+    """
+    Ranged attributes (member;range=0-1499) of the searches in the block come back as the server sent them,
+    instead of ldap3 reading every remaining range into the same response
+    """
+    auto_range = conn.auto_range
+    conn.auto_range = False
+    try:
+        yield conn
+    finally:
+        conn.auto_range = auto_range
+
+
+class AdaptivePageSize:
+    """
+    Entries per page of the paged searches of one sync, adapted to how the DC copes: grows by
+    config.LDAP_PAGE_SIZE_STEP while pages come back within config.LDAP_PAGE_TARGET_LATENCY and
+    config.LDAP_PAGE_TARGET_BYTES, shrinks by a quarter when one is slower or larger. Call it for the current size.
+    """
+    def __init__(self, initial=None, minimum=None, maximum=None, target_latency=None, target_bytes=None,
+                 adaptive=None):
+        self.maximum = maximum or config.LDAP_MAX_PAGE_SIZE
+        self.minimum = min(minimum or config.LDAP_MIN_PAGE_SIZE, self.maximum)
+        self.size = max(self.minimum, min(self.maximum, initial or config.PAGINATION_SIZE))
+        self.target_latency = target_latency or config.LDAP_PAGE_TARGET_LATENCY
+        self.target_bytes = target_bytes or config.LDAP_PAGE_TARGET_BYTES
+        self.adaptive = config.LDAP_ADAPTIVE_PAGE_SIZE if adaptive is None else adaptive
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        return self.size
+
+    def record(self, latency, entries, size_bytes):
+        """
+        :param latency: seconds the search of a page took
+        :param entries: entries of the page, a short last page says nothing about the size
+        :param size_bytes: bytes of the page, see get_response_size
+        """
+        if not self.adaptive:
+            return
+        with self._lock:
+            if latency > self.target_latency or size_bytes > self.target_bytes:
+                size = self.size * 3 // 4
+            elif entries >= self.size:
+                size = self.size + config.LDAP_PAGE_SIZE_STEP
+            else:
+                return
+            self.size = max(self.minimum, min(self.maximum, size))
+
+
+class RequestRateLimit:
+    """
+    Token bucket of the ldap requests sent to one url, shared by the syncs of the process.
+    Up to `burst` requests go at once, then `rate` per second.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one when the bucket is empty
+        :return: seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class _PooledConnection:
+    __slots__ = ('conn', 'bound_at', 'used_at')
+
+    def __init__(self, conn, bound_at):
+        self.conn = conn
+        self.bound_at = bound_at
+        self.used_at = bound_at
+
+
+class LDAPConnectionManager:
+    """
+    At most config.LDAP_MAX_CONNECTIONS_PER_SERVER connections to one url are in use at any time, up to
+    config.LDAP_POOL_MAX_IDLE idle ones per bind user are kept for the next check or sync.
+    A connection that was idle longer than config.LDAP_HEALTH_CHECK_IDLE is checked with a root DSE read before it
+    is handed out again; one whose user raised is unbound instead of going back to the pool.
+    """
+    def __init__(self, max_connections=None, max_idle=None, ttl=None, health_check_idle=None, schema_ttl=None):
+        self.max_connections = max_connections or config.LDAP_MAX_CONNECTIONS_PER_SERVER
+        self.max_idle = config.LDAP_POOL_MAX_IDLE if max_idle is None else max_idle
+        self.ttl = ttl or config.LDAP_CONNECTION_TTL
+        self.health_check_idle = config.LDAP_HEALTH_CHECK_IDLE if health_check_idle is None else health_check_idle
+        self.schema_ttl = schema_ttl or config.LDAP_SCHEMA_TTL
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._servers = {}
+        self._idle = {}
+        self._max_page_sizes = {}
+        self._rate_limits = {}
+
+    @staticmethod
+    def _get_key(url, user, password):
+        # a changed password must not be served the connection bound with the old one
+        return url, user, hashlib.sha256(str(password).encode('utf-8')).hexdigest()
+
+    def _get_slots(self, url):
+        with self._lock:
+            if url not in self._slots:
+                self._slots[url] = threading.BoundedSemaphore(self.max_connections)
+            return self._slots[url]
+
+    def get_server(self, url):
+        """
+        Server of the url, shared by all its connections. The first bind reads the schema and the root DSE,
+        the later ones only the root DSE until the schema is config.LDAP_SCHEMA_TTL seconds old.
+        """
+        now = time.monotonic()
+        with self._lock:
+            server, created_at = self._servers.get(url, (None, None))
+            if server is None or now - created_at > self.schema_ttl:
+                server = Server(url, get_info=ALL)
+                self._servers[url] = server, now
+            return server
+
+    def _bind(self, url, user, password):
+        server = self.get_server(url)
+        conn = Connection(server, user, password, auto_bind=True)
+        # the schema is read by now, connections bound later refresh the root DSE only
+        server.get_info = DSA
+        return _PooledConnection(conn, time.monotonic())
+
+    def _is_usable(self, pooled, now):
+        if pooled.conn.closed or not pooled.conn.bound or now - pooled.bound_at > self.ttl:
+            return False
+        if now - pooled.used_at <= self.health_check_idle:
+            return True
+        try:
+            return pooled.conn.search('', '(objectClass=*)', BASE, attributes=NO_ATTRIBUTES)
+        except Exception as e:
+            logger.info('Dropping pooled ldap connection to {0}: {1}'.format(pooled.conn.server, repr(e)))
+            return False
+
+    @staticmethod
+    def _unbind(pooled):
+        try:
+            pooled.conn.unbind()
+        except Exception as e:
+            logger.info('Unbinding ldap connection to {0} failed {1}'.format(pooled.conn.server, repr(e)))
+
+    def _take(self, key):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                pooled = idle.pop()
+            if self._is_usable(pooled, time.monotonic()):
+                return pooled
+            self._unbind(pooled)
+
+    def _give_back(self, key, pooled):
+        pooled.used_at = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle and pooled.used_at - pooled.bound_at <= self.ttl:
+                idle.append(pooled)
+                return
+        self._unbind(pooled)
+
+    def _prune(self):
+        """
+        Unbind the idle connections past their TTL, of every bind user
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                expired.extend(pooled for pooled in idle if now - pooled.bound_at > self.ttl)
+                idle[:] = [pooled for pooled in idle if now - pooled.bound_at <= self.ttl]
+        for pooled in expired:
+            self._unbind(pooled)
+
+    @contextmanager
+    def connection(self, url, user, password, timeout=None):
+        """
+        Bound connection to the url, back to the pool when the block exits normally, unbound when it raised
+        :param timeout: seconds to wait for one of the url's connections to be free, None waits as long as it takes
+        :raises LDAPPoolTimeout: when no connection got free within timeout
+        """
+        slots = self._get_slots(url)
+        if not slots.acquire(timeout=timeout if timeout is not None else -1):
+            raise LDAPPoolTimeout('No free ldap connection to {0} within {1} sec'.format(url, timeout))
+        try:
+            self._prune()
+            key = self._get_key(url, user, password)
+            pooled = self._take(key) or self._bind(url, user, password)
+            try:
+                yield pooled.conn
+            except BaseException:
+                # a paged search may be left half way
+                self._unbind(pooled)
+                raise
+            self._give_back(key, pooled)
+        finally:
+            slots.release()
+
+    def get_max_page_size(self, url, conn):
+        """
+        MaxPageSize of the DC behind the url, read with the connection once per config.LDAP_SCHEMA_TTL
+        :return: None when it can not be read
+        """
+        now = time.monotonic()
+        with self._lock:
+            max_page_size, read_at = self._max_page_sizes.get(url, (None, None))
+            if read_at is not None and now - read_at <= self.schema_ttl:
+                return max_page_size
+        max_page_size = read_max_page_size(conn)
+        with self._lock:
+            self._max_page_sizes[url] = max_page_size, now
+        return max_page_size
+
+    def get_rate_limit(self, url):
+        """
+        :return: RequestRateLimit of the url, None when its requests are not limited
+            (config.LDAP_MAX_REQUESTS_PER_SECOND_BY_URL, else config.LDAP_MAX_REQUESTS_PER_SECOND)
+        """
+        rate = config.LDAP_MAX_REQUESTS_PER_SECOND_BY_URL.get(url, config.LDAP_MAX_REQUESTS_PER_SECOND)
+        if not rate:
+            return None
+        with self._lock:
+            rate_limit = self._rate_limits.get(url)
+            if rate_limit is None or rate_limit.rate != rate:
+                rate_limit = RequestRateLimit(rate, config.LDAP_REQUEST_BURST)
+                self._rate_limits[url] = rate_limit
+            return rate_limit
+
+    def close_all(self):
+        with self._lock:
+            pooled_connections = [pooled for idle in self._idle.values() for pooled in idle]
+            self._idle = {}
+        for pooled in pooled_connections:
+            self._unbind(pooled)
+
+
+def get_connection_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = LDAPConnectionManager()
+            atexit.register(_manager.close_all)
+        return _manager
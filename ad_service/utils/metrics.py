@@ -0,0 +1,62 @@
+"""
+Prometheus metrics of the syncs, exposed on /api/metrics.
+Under mod_wsgi every process keeps its own values; set PROMETHEUS_MULTIPROC_DIR to a directory shared by the
+processes (emptied on restart) to have /api/metrics report all of them.
+"""
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+
+from ad_service.utils import config
+
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+_BYTES_BUCKETS = tuple(2 ** exponent for exponent in range(10, 28, 2))
+_ENTRIES_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 2000, 5000)
+_RETRIES_BUCKETS = (0, 1, 2, 3, 5, 10)
+
+SYNC_STAGE_SECONDS = Histogram('ad_sync_stage_seconds', 'Wall time of the stages of a sync', ['stage'],
+                               buckets=_SECONDS_BUCKETS)
+SYNC_JOBS = Counter('ad_sync_jobs', 'Finished sync jobs', ['status'])
+SYNC_JOBS_RUNNING = Gauge('ad_sync_jobs_running', 'Syncs being run by a worker', multiprocess_mode='livesum')
+SYNC_JOBS_WAITING = Gauge('ad_sync_jobs_waiting', 'Accepted syncs waiting for a worker', multiprocess_mode='livesum')
+SYNC_JOBS_ATTACHED = Counter('ad_sync_jobs_attached', 'Sync requests attached to the running sync of their instance')
+SYNC_WORKERS = Gauge('ad_sync_workers', 'Sync workers available', multiprocess_mode='livesum')
+SYNC_WORKERS.set(config.SYNC_WORKERS)
+
+LDAP_PAGE_SECONDS = Histogram('ad_sync_ldap_page_seconds', 'Latency of one paged ldap search request',
+                              buckets=_SECONDS_BUCKETS)
+LDAP_PAGE_ENTRIES = Histogram('ad_sync_ldap_page_entries', 'Entries returned by one paged ldap search request',
+                              buckets=_ENTRIES_BUCKETS)
+LDAP_PAGE_SIZE = Histogram('ad_sync_ldap_page_size', 'Page size requested by one paged ldap search request',
+                           buckets=_ENTRIES_BUCKETS)
+LDAP_THROTTLED_SECONDS = Counter('ad_sync_ldap_throttled_seconds',
+                                 'Time ldap requests waited for the request rate limit of their url')
+LDAP_MEMBER_RANGES = Counter('ad_sync_ldap_member_ranges',
+                             'Follow-up ldap requests reading a further range of the members of a group')
+
+CHANGED_FIELDS_SECONDS = Histogram('ad_sync_changed_fields_seconds',
+                                   'Time to look up the previous profiles and set the update times of changed fields',
+                                   buckets=_SECONDS_BUCKETS)
+
+QUEUE_POST_SECONDS = Histogram('ad_sync_queue_post_seconds', 'Latency of one queue post', ['type'],
+                               buckets=_SECONDS_BUCKETS)
+QUEUE_POST_BYTES = Histogram('ad_sync_queue_post_bytes', 'Payload bytes of one queue event', ['type'],
+                             buckets=_BYTES_BUCKETS)
+QUEUE_POST_RETRIES = Histogram('ad_sync_queue_post_retries', 'Retries needed to deliver one queue event', ['type'],
+                               buckets=_RETRIES_BUCKETS)
+QUEUE_SPLITS = Counter('ad_sync_queue_splits', 'Queue events split in halves after failing', ['type'])
+QUEUE_POST_FAILURES = Counter('ad_sync_queue_post_failures', 'Failed queue posts (each one is retried or split)', ['type'])
+
+
+def get_registry():
+    if MULTIPROC_DIR_ENV in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render():
+    return generate_latest(get_registry())
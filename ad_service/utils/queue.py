@@ -1,9 +1,26 @@
+import json
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from retrying import retry
+from requests.adapters import HTTPAdapter
+from retrying import Retrying
 import ad_service.utils.config as constants
+from ad_service.utils import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = constants.LOGGER
 
+# keep-alive sessions shared by every sender to the same queue url
+_sessions = {}
+_sessions_lock = threading.Lock()
+
 
 def get_confirmation_dict(state, is_success, reason=None):
     confirmation_dict = {
@@ -59,6 +76,28 @@ def get_relation_update_dict(from_labels, from_primary_key_name, to_labels, to_p
     }
 
 
+def get_relation_delete_dict(to_primary_key_name, to_labels, from_labels, from_primary_key_name, relationship_type,
+                             data):
+    """
+    Removes the relationships of the given type between the nodes of the relation data dicts, if they exist
+    """
+    return {
+        "type": "RELATIONSHIP_DELETE",
+        "event_data": {
+            "from": {
+                "labels": from_labels,
+                "primary_key_name": from_primary_key_name
+            },
+            "to": {
+                "labels": to_labels,
+                "primary_key_name": to_primary_key_name
+            },
+            "type": relationship_type,
+            "data": data
+        }
+    }
+
+
 def get_node_dict(labels, primary_key_name, data):
     node_dict = {
         "type": "NODE",
@@ -93,14 +132,358 @@ def get_relation_dict(to_primary_key_name, to_labels, from_labels, from_primary_
     return relation_dict
 
 
-@retry(stop_max_attempt_number=constants.QUEUE_MAX_RETRIES, wait_fixed=constants.QUEUE_RETRY_TIME)
-def send_to_queue(data_to_send, queue_url):
-    if data_to_send['type'] not in ['INDEX', 'CONFIRM'] and len(data_to_send['event_data']['data']) == 0:
+def get_batch_dict(events):
+    batch_dict = {
+        "type": "BATCH",
+        "event_data": {
+            "events": events
+        }
+    }
+    return batch_dict
+
+
+def _is_empty(data_to_send):
+    if data_to_send['type'] == 'BATCH':
+        return all(_is_empty(event) for event in data_to_send['event_data']['events'])
+    return data_to_send['type'] not in ['INDEX', 'CONFIRM'] and len(data_to_send['event_data']['data']) == 0
+
+
+def get_session(queue_url):
+    with _sessions_lock:
+        session = _sessions.get(queue_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=constants.QUEUE_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[queue_url] = session
+        return session
+
+
+def _get_compressor(compression):
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd queue compression needs the zstandard package')
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError('Unknown queue compression: ' + compression)
+
+
+def _iter_json(value):
+    # same text as json.dumps, the records of data lists are each serialized in one go by the C encoder
+    if isinstance(value, dict):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            yield (', ' if i else '') + json.dumps(key) + ': '
+            yield from _iter_json(item)
+        yield '}'
+    elif isinstance(value, list):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ', '
+            if isinstance(item, dict) and 'event_data' in item:
+                yield from _iter_json(item)
+            else:
+                yield json.dumps(item)
+        yield ']'
+    else:
+        yield json.dumps(value)
+
+
+def iter_body(data_to_send, compression=None, block_size=None):
+    """
+    Serialize an event block by block, so that no more than about `block_size` bytes of it are in memory
+    :param compression: None, 'gzip' or 'zstd'
+    """
+    block_size = block_size or constants.QUEUE_BODY_BLOCK_SIZE
+    compressor = _get_compressor(compression)
+    pieces = []
+    size = 0
+    for piece in _iter_json(data_to_send):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= block_size:
+            block = ''.join(pieces).encode('utf-8')
+            pieces = []
+            size = 0
+            if compressor is not None:
+                block = compressor.compress(block)
+            # an empty block would end a chunked body
+            if block:
+                yield block
+    block = ''.join(pieces).encode('utf-8')
+    if compressor is not None:
+        block = compressor.compress(block) + compressor.flush()
+    if block:
+        yield block
+
+
+def get_body(data_to_send, compression=None):
+    body = json.dumps(data_to_send).encode('utf-8')
+    compressor = _get_compressor(compression)
+    if compressor is not None:
+        body = compressor.compress(body) + compressor.flush()
+    return body
+
+
+def get_body_headers(compression=None):
+    headers = {'Content-Type': 'application/json'}
+    if compression is not None:
+        headers['Content-Encoding'] = compression
+    return headers
+
+
+class _CountingBody:
+    """
+    Iterable request body (sent with chunked transfer encoding) that counts the bytes sent
+    """
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.size = 0
+
+    def __iter__(self):
+        for block in self.blocks:
+            self.size += len(block)
+            yield block
+
+
+class QueueRejected(RuntimeError):
+    def __init__(self, status_code):
+        super().__init__('Unable to populate into queue, status: {0}'.format(status_code))
+        self.status_code = status_code
+
+
+class QueueSplitError(RuntimeError):
+    """
+    Both halves of a split event failed, the queue rejects more than a few bad records
+    """
+
+
+def _is_transient(exception):
+    # worth sending the same body again: the queue is unreachable, overloaded or failing
+    if isinstance(exception, QueueRejected):
+        return exception.status_code >= 500 or exception.status_code in (408, 429)
+    return isinstance(exception, requests.ConnectionError)
+
+
+def _is_size_related(exception):
+    # a smaller body may go through right away
+    if isinstance(exception, QueueRejected):
+        return exception.status_code == 413
+    return isinstance(exception, requests.ReadTimeout)
+
+
+def split_event(data_to_send):
+    """
+    :return: two events with one half each of the records (or of the events of a BATCH), None if it can not be split
+    """
+    event_data = data_to_send['event_data']
+    if data_to_send['type'] == 'BATCH':
+        events = event_data['events']
+        if len(events) > 1:
+            middle = len(events) // 2
+            return get_batch_dict(events[:middle]), get_batch_dict(events[middle:])
+        halves = split_event(events[0]) if events else None
+        return None if halves is None else tuple(get_batch_dict([half]) for half in halves)
+    data = event_data.get('data')
+    if not isinstance(data, list) or len(data) < 2:
+        return None
+    middle = len(data) // 2
+    return tuple(dict(data_to_send, event_data=dict(event_data, data=part)) for part in (data[:middle], data[middle:]))
+
+
+def send_to_queue(data_to_send, queue_url, max_attempts=None):
+    """
+    Post an event, retrying transient failures with exponential backoff and jitter.
+    An event the queue keeps rejecting (or rejects as too large) is split in halves which are sent one after the
+    other, so that the records around a bad one still land; the failure is raised once both halves were tried.
+    :param max_attempts: attempts before splitting (defaults to config.QUEUE_MAX_RETRIES)
+    :return: failed posts (retried or split) on the way
+    """
+    if _is_empty(data_to_send):
         logger.info('Nothing to populate. Moving on..')
-        return
-    r = requests.post(queue_url, json=data_to_send)
+        return 0
+    event_type = data_to_send['type']
+    # a streamed body is serialized again on every attempt
+    body = None if constants.QUEUE_STREAM_BODY else get_body(data_to_send, constants.QUEUE_COMPRESSION)
+    attempts = []
+    retrying = Retrying(stop_max_attempt_number=max_attempts or constants.QUEUE_MAX_RETRIES,
+                        wait_exponential_multiplier=constants.QUEUE_RETRY_TIME,
+                        wait_exponential_max=constants.QUEUE_RETRY_MAX_TIME,
+                        wait_jitter_max=constants.QUEUE_RETRY_JITTER,
+                        retry_on_exception=_is_transient)
+    try:
+        body_size = retrying.call(_post_to_queue, data_to_send, body, queue_url, event_type, attempts)
+        metrics.QUEUE_POST_BYTES.labels(event_type).observe(body_size)
+        return len(attempts) - 1
+    except (QueueRejected, requests.RequestException) as e:
+        halves = split_event(data_to_send)
+        # an unreachable queue does not get better with smaller bodies
+        if halves is None or (isinstance(e, requests.ConnectionError) and not _is_size_related(e)):
+            raise
+        logger.info('Splitting {0} event after {1} failed posts: {2}'.format(event_type, len(attempts), repr(e)))
+        metrics.QUEUE_SPLITS.labels(event_type).inc()
+        return len(attempts) + _send_halves(halves, queue_url)
+    finally:
+        metrics.QUEUE_POST_RETRIES.labels(event_type).observe(len(attempts) - 1)
+
+
+def _send_halves(halves, queue_url):
+    failures = 0
+    errors = []
+    for half in halves:
+        try:
+            failures += send_to_queue(half, queue_url, constants.QUEUE_SPLIT_MAX_RETRIES)
+        except QueueSplitError:
+            # the queue rejects everything, no use trying the other half
+            raise
+        except Exception as e:
+            errors.append(e)
+    if len(errors) == len(halves):
+        raise QueueSplitError('Both halves of a split event failed') from errors[0]
+    if errors:
+        raise errors[0]
+    return failures
+
+
+def _post_to_queue(data_to_send, body, queue_url, event_type, attempts):
+    """
+    :return: bytes sent
+    """
+    attempts.append(None)
+    if body is None:
+        body = _CountingBody(iter_body(data_to_send, constants.QUEUE_COMPRESSION))
+    start = time.perf_counter()
+    try:
+        r = get_session(queue_url).post(queue_url, data=body, headers=get_body_headers(constants.QUEUE_COMPRESSION),
+                                        timeout=constants.QUEUE_TIMEOUT)
+    except Exception:
+        metrics.QUEUE_POST_FAILURES.labels(event_type).inc()
+        raise
+    metrics.QUEUE_POST_SECONDS.labels(event_type).observe(time.perf_counter() - start)
     if r.status_code != 200:
-        logger.info('Unable to populate into queue! Retrying after {0} sec'.format(constants.QUEUE_RETRY_TIME / 1000))
-        raise RuntimeError('Unable to populate into queue')
+        metrics.QUEUE_POST_FAILURES.labels(event_type).inc()
+        logger.info('Unable to populate into queue! status: {0} attempt: {1}'.format(r.status_code, len(attempts)))
+        raise QueueRejected(r.status_code)
     else:
         logger.info('Populate successful!')
+    return body.size if isinstance(body, _CountingBody) else len(body)
+
+
+class AdaptiveChunkSize:
+    """
+    Records per queue chunk of one sync, adapted to how the queue copes: grows by config.QUEUE_CHUNK_SIZE_STEP while
+    posts are acknowledged within config.QUEUE_TARGET_LATENCY, shrinks by a quarter when they are slower and by half
+    when they fail. Call it for the current size.
+    """
+    def __init__(self, initial=None, minimum=None, maximum=None, target_latency=None, adaptive=None):
+        self.size = initial or constants.QUEUE_CHUNK_SIZE
+        self.minimum = minimum or constants.QUEUE_MIN_CHUNK_SIZE
+        self.maximum = maximum or constants.QUEUE_MAX_CHUNK_SIZE
+        self.target_latency = target_latency or constants.QUEUE_TARGET_LATENCY
+        self.adaptive = constants.QUEUE_ADAPTIVE_CHUNK_SIZE if adaptive is None else adaptive
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        return self.size
+
+    def record(self, latency, failures):
+        """
+        :param latency: seconds until the post of a chunk event was acknowledged
+        :param failures: failed posts on the way (retries and splits)
+        """
+        if not self.adaptive:
+            return
+        with self._lock:
+            if failures:
+                size = self.size // 2
+            elif latency > self.target_latency:
+                size = self.size * 3 // 4
+            else:
+                size = self.size + constants.QUEUE_CHUNK_SIZE_STEP
+            self.size = max(self.minimum, min(self.maximum, size))
+
+
+class QueuePublisher:
+    """
+    Sends events to one queue with up to `max_in_flight` concurrent posts over the pooled session.
+    publish() blocks while that many posts are in flight. Events are not ordered among each other,
+    call flush() before publishing events that depend on the ones already published
+    (eg. relationships after their nodes).
+    """
+    def __init__(self, queue_url, max_in_flight=None, chunk_size=None):
+        """
+        :param chunk_size: AdaptiveChunkSize told about the latency and failures of every post
+        """
+        self.queue_url = queue_url
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight or constants.QUEUE_MAX_IN_FLIGHT
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='queue-publisher')
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._pending = []
+
+    def publish(self, data_to_send):
+        self._raise_failed()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._send, data_to_send)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+        return future
+
+    def _send(self, data_to_send):
+        start = time.perf_counter()
+        try:
+            failures = send_to_queue(data_to_send, self.queue_url)
+        except Exception:
+            if self.chunk_size is not None:
+                self.chunk_size.record(time.perf_counter() - start, 1)
+            raise
+        if self.chunk_size is not None:
+            self.chunk_size.record(time.perf_counter() - start, failures)
+        return failures
+
+    def _raise_failed(self):
+        pending = []
+        for future in self._pending:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self._pending = pending
+
+    def flush(self):
+        """
+        Wait until everything published so far is acknowledged by the queue
+        :raises: the first error a post failed with
+        """
+        pending, self._pending = self._pending, []
+        error = None
+        for future in pending:
+            if future.exception() is not None and error is None:
+                error = future.exception()
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._executor.shutdown(wait=True)
+            return False
+        self.close()
+        return False
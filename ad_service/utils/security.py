@@ -1,25 +1,58 @@
-from Crypto.Cipher import AES
-from Crypto import Random
 import codecs
-import yaml
 import os
+import threading
 
-with open(os.getcwd() + "/security_secrets.yaml", 'r') as stream:
-    secrets = yaml.load(stream)
-encryption_key = secrets['ENCRYPTION_KEY']
+_secrets = None
+_secrets_lock = threading.Lock()
+
+
+def get_secrets():
+    """
+    Secrets of security_secrets.yaml in the working directory, read on first use
+    """
+    global _secrets
+    if _secrets is None:
+        with _secrets_lock:
+            if _secrets is None:
+                import yaml
+                with open(os.getcwd() + "/security_secrets.yaml", 'r') as stream:
+                    _secrets = yaml.load(stream)
+    return _secrets
+
+
+def get_encryption_key():
+    return get_secrets()['ENCRYPTION_KEY']
+
+
+def __getattr__(name):
+    # module attributes of the secrets, kept for the code that reads them off the module
+    if name == 'secrets':
+        return get_secrets()
+    if name == 'encryption_key':
+        return get_encryption_key()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def _get_cipher_key():
+    # pycryptodome only takes bytes, the key of the secrets file is text
+    key = get_encryption_key()
+    return key.encode('utf-8') if isinstance(key, str) else key
 
 
 def encrypt(data):
+    from Crypto.Cipher import AES
+    from Crypto import Random
     iv = Random.new().read(AES.block_size)
-    cipher = AES.new(encryption_key, AES.MODE_CFB, iv)
-    msg = iv + cipher.encrypt(str(data))
+    cipher = AES.new(_get_cipher_key(), AES.MODE_CFB, iv)
+    msg = iv + cipher.encrypt(str(data).encode('utf-8'))
     msg = codecs.encode(msg, 'hex_codec')
     return msg
 
 
 def decrypt(data):
+    from Crypto.Cipher import AES
     iv = data[:32]
     iv = codecs.decode(iv, 'hex_codec')
-    cipher = AES.new(encryption_key, AES.MODE_CFB, iv)
+    cipher = AES.new(_get_cipher_key(), AES.MODE_CFB, iv)
     decrypted_data = cipher.decrypt(codecs.decode(data, 'hex_codec'))[len(iv):]
     return decrypted_data
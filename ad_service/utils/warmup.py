@@ -0,0 +1,54 @@
+"""
+Loads what the first requests and the first sync of a worker process would otherwise load while serving them.
+Run by wsgi.py with WSGI_WARM_UP; mod_wsgi runs wsgi.py when the process starts when the WSGIScriptAlias names
+both the process-group and the application-group (see apache-conf.conf).
+"""
+from time import perf_counter
+
+from ad_service.utils import config
+
+logger = config.LOGGER
+
+
+def _load_urlconf():
+    # imports the views and the rest_framework decorators
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+
+
+def _load_integration():
+    # py2neo and ldap3
+    from ad_service.ad_integration import jobs
+    jobs._get_integration_class()
+
+
+def _load_secrets():
+    from ad_service.utils import security
+    security.get_secrets()
+
+
+WARM_UP_STEPS = (
+    ('logger', config.LOGGER.load),
+    ('urlconf', _load_urlconf),
+    ('integration', _load_integration),
+    ('secrets', _load_secrets),
+)
+
+
+def warm_up():
+    """
+    Run every warm-up step. A failing step is logged and the others still run, the request or sync that needs it
+    will fail on its own as it did without the warm-up.
+    :return: {step: seconds taken}
+    """
+    timings = {}
+    for name, step in WARM_UP_STEPS:
+        start = perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.exception('Warm-up step {0} failed {1}'.format(name, repr(e)))
+        timings[name] = perf_counter() - start
+    logger.info('Checkpoint: Warmed up in {0:.3f} sec ({1})'.format(
+        sum(timings.values()), ', '.join('{0} {1:.3f}'.format(name, seconds) for name, seconds in timings.items())))
+    return timings
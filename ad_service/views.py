@@ -1,12 +1,13 @@
 import json
+from django.core.exceptions import ValidationError
 from django.http import HttpResponse
-from ldap3 import Server, Connection, ALL
-from ldap3.core.exceptions import LDAPBindError, LDAPSocketOpenError
+from django.views.decorators.http import require_GET
+from prometheus_client import CONTENT_TYPE_LATEST
 from rest_framework.decorators import api_view
-from ad_service.ad_integration.onboard_and_update import ADIntegration
-from ad_service.utils import config
-from ad_service.utils.queue import *
-from ad_service.utils.security import *
+from ad_service.ad_integration.jobs import JobQueueFull, submit_sync_job
+from ad_service.ad_integration.scheduler import register_integration
+from ad_service.models import SyncJob
+from ad_service.utils import config, metrics
 
 logger = config.LOGGER
 
@@ -15,18 +16,17 @@ def response_handler(*args, **kwargs):
     return HttpResponse(json.dumps(kwargs), status=args[0], content_type="application/json")
 
 
-def send_confirmation(queue_url, state, is_success, reason=None):
-    confirmation_dict = get_confirmation_dict(state, is_success, reason)
-    send_to_queue(confirmation_dict, queue_url)
-    logger.info('Checkpoint: Sent confirmation. state: {0} is_success: {1} reason: {2}'.format(state, is_success, reason))
-
-
 @api_view(['GET'])
 def health(request):
     logger.info("health check")
     return response_handler(200, text='v1')
 
 
+@require_GET
+def prometheus_metrics(request):
+    return HttpResponse(metrics.render(), content_type=CONTENT_TYPE_LATEST)
+
+
 @api_view(['POST'])
 def check_credentials(request):
     logger.info("got check credentials request")
@@ -42,13 +42,21 @@ def check_credentials(request):
         return response_handler(400, is_success= False, reason='Missing Fields!')
 
     logger.info("no keyerror")
+    from ldap3.core.exceptions import LDAPBindError, LDAPSocketOpenError
+    from ad_service.utils.ldap import LDAPPoolTimeout, get_connection_manager
     try:
         logger.info('Checking LDAP credentials')
-        server = Server(ad_url, get_info=ALL)
-        conn = Connection(server, ad_username, ad_password, auto_bind=True)
+        # the bound connection stays pooled for the on-boarding sync that usually follows
+        with get_connection_manager().connection(ad_url, ad_username, ad_password,
+                                                 timeout=config.LDAP_CHECK_CREDENTIALS_WAIT):
+            pass
     except (LDAPBindError, LDAPSocketOpenError) as e:
         logger.exception('Invalid LDAP credentials ' + ad_url + " " + repr(e))
         return response_handler(400, is_success = False, reason = 'Invalid LDAP credentials')
+    except LDAPPoolTimeout as e:
+        # every connection to the server is taken, eg. by a sync, the credentials were not checked
+        logger.warning(repr(e) + ' rejecting credentials check of AD_URL: ' + ad_url)
+        return response_handler(503, is_success = False, reason = 'Directory busy! Please try again!')
     except Exception as e:
         logger.exception("Exp: Invalid LDAP credentials " + repr(e))
         return response_handler(400, is_success = False, reason = 'Invalid LDAP credentials')
@@ -89,24 +97,38 @@ def ad_integration(request):
         logger.exception(repr(e))
         return response_handler(400, status='failure', reason='Missing Fields!')
 
+    sync_interval = request.data.get('sync_interval')
+    if sync_interval is not None:
+        try:
+            sync_interval = int(sync_interval)
+        except (TypeError, ValueError):
+            sync_interval = -1
+        if sync_interval < 0:
+            return response_handler(400, status='failure', reason='Invalid sync_interval!')
+
     logger.info('no keyerror')
     try:
-        logger.info('Checkpoint: Indexing labels ...')
-        for label in config.INDEX_LABEL_PROPERTY_MAP:
-            index_dict = get_index_dict(label=label, property=config.INDEX_LABEL_PROPERTY_MAP[label])
-            send_to_queue(index_dict, queue_url)
-        logger.info('Checkpoint: Indexed labels! Starting integration ...')
-        ADIntegration(ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id).run()
-    except (LDAPBindError, LDAPSocketOpenError):
-        logger.exception('Invalid LDAP credentials ' + ad_url)
-        send_confirmation(queue_url=queue_url, state=state, is_success=False, reason='Invalid LDAP credentials!')
-        return response_handler(400)
-    except Exception as e:
-        logger.exception('sent confirmation to queue success=False ' + repr(e))
-        send_confirmation(queue_url=queue_url, state=state, is_success=False,
-                          reason='Internal Server Error! Please try again!')
-        return response_handler(400)
-
-    send_confirmation(queue_url=queue_url, state=state, is_success=True)
-    logger.info('sent confirmation to queue success=True')
-    return response_handler(200)
+        job = submit_sync_job(ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id, state)
+    except JobQueueFull as e:
+        logger.warning(repr(e) + ' rejecting AD_URL: ' + ad_url)
+        return response_handler(503, status='failure', reason='Too many integrations in progress! Please try again!')
+
+    if sync_interval is not None:
+        # incremental syncs keep running every sync_interval seconds, 0 stops them
+        register_integration(ad_url, ad_username, ad_password, ad_search_base, graph_url, queue_url, group_id, state,
+                             sync_interval)
+
+    if job.attached_to_id:
+        return response_handler(202, status='queued', job_id=str(job.job_id),
+                                status_url='/api/jobs/{0}/'.format(job.job_id), attached_to=str(job.attached_to_id))
+    return response_handler(202, status='queued', job_id=str(job.job_id),
+                            status_url='/api/jobs/{0}/'.format(job.job_id))
+
+
+@api_view(['GET'])
+def job_status(request, job_id):
+    try:
+        job = SyncJob.objects.get(pk=job_id)
+    except (SyncJob.DoesNotExist, ValueError, ValidationError):
+        return response_handler(404, status='failure', reason='Job not found!')
+    return response_handler(200, **job.to_dict())
@@ -0,0 +1,58 @@
+"""
+Bytes-on-wire and page latency of the paged user search, requesting every attribute (`*`) vs
+the attributes derived from config.AD_SYNC_ATTRIBUTES.
+
+    python -m benchmarks.attribute_projection --users 10000
+"""
+import argparse
+import time
+
+from ldap3 import SUBTREE
+
+from ad_service.utils import config
+from ad_service.ad_integration.onboard_and_update import PAGED_RESULTS_CONTROL
+from ad_service.utils.ldap import get_response_size
+from benchmarks.mock_directory import build_mock_connection, MOCK_SEARCH_BASE, MOCK_SEARCH_FILTER
+
+
+def run_paged_search(conn, attributes, page_size):
+    page_times = []
+    total_bytes = 0
+    entries = 0
+    cookie = None
+    while True:
+        start = time.perf_counter()
+        conn.search(search_base=MOCK_SEARCH_BASE,
+                    search_filter=MOCK_SEARCH_FILTER,
+                    search_scope=SUBTREE,
+                    attributes=attributes,
+                    paged_size=page_size,
+                    paged_cookie=cookie)
+        page_times.append(time.perf_counter() - start)
+        total_bytes += get_response_size(conn.response)
+        entries += len(conn.response)
+        cookie = conn.result['controls'][PAGED_RESULTS_CONTROL]['value']['cookie']
+        if not cookie:
+            break
+    return entries, total_bytes, page_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=config.PAGINATION_SIZE)
+    args = parser.parse_args()
+
+    conn = build_mock_connection(args.users)
+    results = {}
+    for label, attributes in (('all (*)', ['*']), ('projected', config.AD_SYNC_ATTRIBUTES)):
+        entries, total_bytes, page_times = run_paged_search(conn, attributes, args.page_size)
+        results[label] = total_bytes
+        print('{0:<10} entries={1} bytes={2} bytes/entry={3:.0f} pages={4} mean page latency={5:.1f} ms'.format(
+            label, entries, total_bytes, total_bytes / max(entries, 1), len(page_times),
+            1000 * sum(page_times) / len(page_times)))
+    print('projection reduces transferred bytes {0:.1f}x'.format(results['all (*)'] / max(results['projected'], 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Synthetic Active-Directory served through ldap3's MOCK_SYNC strategy, used by the benchmarks
+"""
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2
+
+from ad_service.utils import config
+
+MOCK_SEARCH_BASE = 'DC=bench,DC=local'
+MOCK_ADMIN = 'CN=admin,' + MOCK_SEARCH_BASE
+MOCK_PASSWORD = 'bench'
+
+# MOCK_SYNC cannot evaluate the extensible match (disabled accounts bit) of config.AD_SEARCH_FILTER
+MOCK_SEARCH_FILTER = '(&(objectCategory=person)(objectClass=user))'
+
+THUMBNAIL_PHOTO = bytes(range(256)) * 32  # 8 KiB jpeg stand-in
+USER_CERTIFICATE = bytes(range(256)) * 6
+GROUPS_PER_USER = 30
+
+
+def user_dn(i, departments=10):
+    return 'CN=User {0},OU=Department {1},{2}'.format(i, i % departments, MOCK_SEARCH_BASE)
+
+
+def user_attributes(i, departments=10, heavy_attributes=True):
+    """
+    AD attributes of synthetic user `i`. Every user reports to the first user of its department.
+    :param heavy_attributes: also set the large multi-valued attributes real directories carry
+    """
+    attributes = {
+        'objectClass': ['top', 'person', 'organizationalPerson', 'user'],
+        'objectCategory': 'person',
+        config.AD_DISTINGUISHED_NAME: user_dn(i, departments),
+        config.AD_EMAIL: 'user{0}@bench.local'.format(i),
+        config.AD_FIRST_NAME: 'First',
+        config.AD_LAST_NAME: 'Last',
+        config.AD_NAME: 'First Last',
+        config.AD_TITLE: 'Title {0}'.format(i % 50),
+        config.AD_USERNAME: 'user{0}'.format(i),
+        config.AD_PRINCIPAL_NAME: 'user{0}@bench.local'.format(i),
+        config.AD_COMPANY: 'Bench',
+        config.AD_PHONE_NUMBER: '+1 555 {0:07d}'.format(i),
+        config.AD_COUNTRY: 'Ireland',
+        config.AD_DEPARTMENT: 'Department {0}'.format(i % departments),
+        config.AD_WHEN_CREATED: '2020{0:02d}{1:02d}120000.0Z'.format(1 + i % 12, 1 + i % 28),
+        'userAccountControl': 512,
+    }
+    if i >= departments:
+        attributes[config.AD_MANAGER] = user_dn(i % departments, departments)
+    if heavy_attributes:
+        attributes.update({
+            'thumbnailPhoto': THUMBNAIL_PHOTO,
+            'userCertificate': USER_CERTIFICATE,
+            config.AD_MEMBER_OF: ['CN=Group {0},OU=Groups,{1}'.format((i + g) % 500, MOCK_SEARCH_BASE)
+                                  for g in range(GROUPS_PER_USER)],
+            'proxyAddresses': ['smtp:user{0}@alias{1}.bench.local'.format(i, a) for a in range(5)],
+        })
+    return attributes
+
+
+def build_mock_connection(users, departments=10, heavy_attributes=True):
+    """
+    Bound MOCK_SYNC connection over a directory of `users` synthetic users
+    """
+    server = Server('mock_ad', get_info=OFFLINE_AD_2012_R2)
+    conn = Connection(server, user=MOCK_ADMIN, password=MOCK_PASSWORD, client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(MOCK_ADMIN, {'userPassword': MOCK_PASSWORD, 'sn': 'admin'})
+    for i in range(users):
+        conn.strategy.add_entry(user_dn(i, departments), user_attributes(i, departments, heavy_attributes))
+    conn.bind()
+    return conn
@@ -0,0 +1,90 @@
+"""
+Users/sec of the normalization of fetched ldap pages into member records: the ldap3 Entry path (conn.entries and
+_populate of every entry) vs the raw path (_populate_page of conn.response). The pages are fetched once up front,
+only the normalization is timed.
+
+    python -m benchmarks.normalize --users 10000 [--light] [--repeat 3]
+"""
+import argparse
+import logging
+import time
+from unittest.mock import patch
+
+from ldap3 import SUBTREE
+
+from ad_service.ad_integration.onboard_and_update import ADIntegration, PAGED_RESULTS_CONTROL
+from ad_service.utils import config
+from benchmarks.mock_directory import build_mock_connection, MOCK_ADMIN, MOCK_PASSWORD, MOCK_SEARCH_BASE, \
+    MOCK_SEARCH_FILTER
+from benchmarks.sync import GraphStub
+
+
+def fetch_pages(conn, page_size):
+    """
+    :return: [(response, request)] of every page of the user search
+    """
+    pages = []
+    cookie = None
+    while True:
+        conn.search(search_base=MOCK_SEARCH_BASE,
+                    search_filter=MOCK_SEARCH_FILTER,
+                    search_scope=SUBTREE,
+                    attributes=config.AD_SYNC_ATTRIBUTES,
+                    paged_size=page_size,
+                    paged_cookie=cookie)
+        pages.append((conn.response, conn.request))
+        cookie = conn.result['controls'][PAGED_RESULTS_CONTROL]['value']['cookie']
+        if not cookie:
+            return pages
+
+
+def new_integration(**kwargs):
+    with patch('ad_service.utils.graph.get_graph', return_value=GraphStub()):
+        return ADIntegration(MOCK_ADMIN, MOCK_ADMIN, MOCK_PASSWORD, MOCK_SEARCH_BASE, 'graph_stub', 'queue_stub', 1,
+                             **kwargs)
+
+
+def normalize_entries(conn, pages):
+    integration = new_integration()
+    for response, request in pages:
+        # what conn.entries builds for every page
+        for entry in conn._get_entries(response, request):
+            integration._populate(entry.__dict__)
+    return integration
+
+
+def normalize_responses(conn, pages):
+    integration = new_integration()
+    for response, _ in pages:
+        integration._populate_page(response)
+    return integration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=config.PAGINATION_SIZE)
+    parser.add_argument('--light', action='store_true', help='leave out photos, certificates and group lists')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each path, the best one is reported')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    conn = build_mock_connection(args.users, heavy_attributes=not args.light)
+    pages = fetch_pages(conn, args.page_size)
+
+    results = {}
+    for label, normalize in (('ldap3 Entry objects', normalize_entries), ('raw response', normalize_responses)):
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            integration = normalize(conn, pages)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[label] = best
+        print('{0:<20} {1:8.3f} s | {2:8.0f} users/sec | done {3} not done {4}'.format(
+            label, best, args.users / best, integration.done, integration.not_done))
+    print('raw response path is {0:.1f}x faster'.format(results['ldap3 Entry objects'] / results['raw response']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Serialization CPU and bytes sent per 10k profiles for the queue body encodings, and the spread of chunk
+sizes when chunking by record count vs by serialized bytes. The managers, listed first like a directory
+sorted by seniority, carry large direct_reports.
+
+    python -m benchmarks.queue_payloads --users 10000
+"""
+import argparse
+import time
+
+from ad_service.ad_integration.records import MemberRecord, MemberRecordStore
+from ad_service.utils import config
+from ad_service.utils.queue import get_body, get_node_dict, iter_body, zstandard
+from benchmarks.record_store import member_data, when_created
+
+
+def build_store(users, span_of_control):
+    store = MemberRecordStore()
+    managers = users // span_of_control
+    for i in range(users):
+        data = member_data(i)
+        if i < managers:
+            data['direct_reports'] = ['CN=User {0},OU=Department {1},DC=bench,DC=local'.format(report, report % 10)
+                                      for report in range(managers + i * span_of_control,
+                                                          managers + (i + 1) * span_of_control)]
+        store.add(data[config.AD_PROFILE_PRIMARY_KEY], when_created(i), MemberRecord(**data))
+    return store
+
+
+def node_events(store, size=None, max_bytes=None):
+    for chunk in store.chunks(size or config.QUEUE_CHUNK_SIZE, max_bytes):
+        yield get_node_dict(labels=config.AD_PROFILE_LABELS, primary_key_name=config.AD_PROFILE_PRIMARY_KEY,
+                            data=[record.to_dict() for record in chunk])
+
+
+def measure(events, encode):
+    sent = 0
+    start = time.process_time()
+    for event in events:
+        sent += encode(event)
+    return time.process_time() - start, sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--span-of-control', type=int, default=50, help='direct reports of every manager')
+    parser.add_argument('--chunk-size', type=int, default=config.QUEUE_CHUNK_SIZE)
+    parser.add_argument('--chunk-bytes', type=int, default=config.QUEUE_CHUNK_BYTES)
+    args = parser.parse_args()
+
+    store = build_store(args.users, args.span_of_control)
+    events = list(node_events(store, args.chunk_size))
+    per_10k = 10000 / args.users
+
+    encodings = [
+        ('json.dumps', lambda event: len(get_body(event))),
+        ('streamed', lambda event: sum(len(block) for block in iter_body(event))),
+        ('json.dumps + gzip', lambda event: len(get_body(event, 'gzip'))),
+        ('streamed + gzip', lambda event: sum(len(block) for block in iter_body(event, 'gzip'))),
+    ]
+    if zstandard is not None:
+        encodings += [
+            ('json.dumps + zstd', lambda event: len(get_body(event, 'zstd'))),
+            ('streamed + zstd', lambda event: sum(len(block) for block in iter_body(event, 'zstd'))),
+        ]
+    else:
+        print('zstandard is not installed, skipping zstd')
+
+    # warm up
+    measure(events, encodings[0][1])
+    print('per 10k profiles:')
+    for label, encode in encodings:
+        cpu, sent = measure(events, encode)
+        print('  {0:<20} cpu {1:7.1f} ms | sent {2:6.2f} MiB'.format(label, 1000 * cpu * per_10k,
+                                                                    sent * per_10k / 2 ** 20))
+
+    for label, max_bytes in (('by count', None), ('by bytes', args.chunk_bytes)):
+        sizes = [len(get_body(event)) for event in node_events(store, args.chunk_size, max_bytes)]
+        print('chunks {0:<9} {1:3} chunks | smallest {2:6.0f} KiB | largest {3:6.0f} KiB'.format(
+            label, len(sizes), min(sizes) / 1024, max(sizes) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Local HTTP stand-in of the queue
+"""
+import json
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class QueueStub(ThreadingHTTPServer):
+    """
+    Accepts every POST with a 200 and counts requests, body bytes as sent and json bytes once decompressed.
+    Bodies may be chunked and gzip or zstd encoded.
+    :param keep_events: keep the decoded events in `events`
+    """
+    daemon_threads = True
+
+    def __init__(self, keep_events=False):
+        super().__init__(('127.0.0.1', 0), _QueueStubHandler)
+        self.keep_events = keep_events
+        self.events = []
+        self.requests = 0
+        self.body_bytes = 0
+        self.json_bytes = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/queue'.format(self.server_address[1])
+
+    def record(self, body, encoding):
+        if encoding == 'gzip':
+            payload = zlib.decompress(body, wbits=16 + zlib.MAX_WBITS)
+        elif encoding == 'zstd':
+            payload = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        else:
+            payload = body
+        event = json.loads(payload) if self.keep_events else None
+        with self._lock:
+            self.requests += 1
+            self.body_bytes += len(body)
+            self.json_bytes += len(payload)
+            if self.keep_events:
+                self.events.append(event)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class _QueueStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = self._read_chunked()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.record(body, self.headers.get('Content-Encoding'))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def log_message(self, *args):
+        pass
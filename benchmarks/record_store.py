@@ -0,0 +1,84 @@
+"""
+Memory per user of the email-deduplicated member records: the former list of payload dicts plus
+email tracker dict vs MemberRecordStore with slotted MemberRecords.
+
+    python -m benchmarks.record_store --users 100000,1000000
+"""
+import argparse
+import datetime
+import gc
+import tracemalloc
+
+from ad_service.ad_integration.records import MemberRecord, MemberRecordStore, MEMBER_FIELDS
+from ad_service.utils import config
+
+
+def member_data(i):
+    data = {key: '' for key in MEMBER_FIELDS}
+    data.update({
+        'first_name': 'First{0}'.format(i),
+        'last_name': 'Last{0}'.format(i),
+        config.AD_PROFILE_PRIMARY_KEY: 'user{0}@bench.local'.format(i),
+        'ad_principle_name': 'user{0}@bench.local'.format(i),
+        'ad_username': 'user{0}'.format(i),
+        'title': 'Title {0}'.format(i % 50),
+        'ad_distinguished_name': 'CN=User {0},OU=Department {1},DC=bench,DC=local'.format(i, i % 10),
+        'phone': '+1 555 {0:07d}'.format(i),
+        'direct_reports': '',
+        'last_update_time': 1600000000000 + i,
+        'created_at': 1500000000000 + i,
+    })
+    return data
+
+
+def when_created(i):
+    return datetime.datetime(2020, 1 + i % 12, 1 + i % 28, tzinfo=datetime.timezone.utc)
+
+
+def fill_dicts(users):
+    data_to_send = []
+    unique_email_tracker = {}
+    for i in range(users):
+        data = member_data(i)
+        data_to_send.append(data)
+        unique_email_tracker[data[config.AD_PROFILE_PRIMARY_KEY]] = {
+            'created_at': when_created(i),
+            'entry_idx': len(data_to_send) - 1,
+        }
+    return data_to_send, unique_email_tracker
+
+
+def fill_store(users):
+    store = MemberRecordStore()
+    for i in range(users):
+        data = member_data(i)
+        store.add(data[config.AD_PROFILE_PRIMARY_KEY], when_created(i), MemberRecord(**data))
+    return store
+
+
+def measure(fill, users):
+    gc.collect()
+    tracemalloc.start()
+    held = fill(users)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    gc.collect()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', default='100000,1000000', help='comma separated user counts')
+    args = parser.parse_args()
+
+    for users in [int(count) for count in args.users.split(',')]:
+        dicts = measure(fill_dicts, users)
+        store = measure(fill_store, users)
+        print('{0:>8} users: dicts {1:.0f} B/user ({2:.0f} MiB) | record store {3:.0f} B/user ({4:.0f} MiB) | '
+              '{5:.1f}x smaller'.format(users, dicts / users, dicts / 2 ** 20, store / users, store / 2 ** 20,
+                                        dicts / store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Cold start of a WSGI worker process: time to load wsgi.py, to serve the first /api/health request and to load the
+sync code for the first job, with the RSS after each, with and without the WSGI_WARM_UP hook.
+Every worker is a fresh process, --processes of them start together like the mod_wsgi daemon processes.
+
+    python -m benchmarks.startup [--processes 4] [--warm-up | --no-warm-up]
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def rss():
+    # resident pages of this process
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run_worker(warm_up):
+    start = time.perf_counter()
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'workgraph_ad_service.settings')
+    from ad_service.utils import config
+    config.SCHEDULER_ENABLED = False
+    config.WSGI_WARM_UP = warm_up
+    from workgraph_ad_service.wsgi import application
+    loaded = time.perf_counter()
+    loaded_rss = rss()
+
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': '/api/health', 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8002', 'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+    }
+    statuses = []
+    b''.join(application(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+    requested = time.perf_counter()
+    requested_rss = rss()
+
+    from ad_service.ad_integration import jobs
+    jobs._get_integration_class()
+    synced = time.perf_counter()
+
+    print(json.dumps({
+        'load': loaded - start, 'load_rss': loaded_rss,
+        'request': requested - loaded, 'request_rss': requested_rss, 'status': statuses[0],
+        'sync_import': synced - requested, 'sync_rss': rss(),
+    }))
+
+
+def run_workers(processes, warm_up):
+    command = [sys.executable, '-m', 'benchmarks.startup', '--worker'] + (['--warm-up'] if warm_up else [])
+    start = time.perf_counter()
+    workers = [subprocess.Popen(command, stdout=subprocess.PIPE) for _ in range(processes)]
+    results = [json.loads(worker.communicate()[0].decode('utf-8').splitlines()[-1]) for worker in workers]
+    wall = time.perf_counter() - start
+
+    print('{0} workers {1} warm-up ({2:.2f} s until all of them served a request and loaded the sync)'.format(
+        processes, 'with' if warm_up else 'without', wall))
+    print('  {0:<6} {1:>12} {2:>10} {3:>15} {4:>10} {5:>12} {6:>10}'.format(
+        'worker', 'load wsgi s', 'RSS MiB', 'first request s', 'RSS MiB', 'load sync s', 'RSS MiB'))
+    for number, result in enumerate(results):
+        print('  {0:<6} {1:>12.3f} {2:>10.1f} {3:>15.3f} {4:>10.1f} {5:>12.3f} {6:>10.1f}{7}'.format(
+            number, result['load'], result['load_rss'] / 2 ** 20, result['request'], result['request_rss'] / 2 ** 20,
+            result['sync_import'], result['sync_rss'] / 2 ** 20,
+            '' if result['status'].startswith('200') else '  (' + result['status'] + ')'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4, help='worker processes started together')
+    warm_up = parser.add_mutually_exclusive_group()
+    warm_up.add_argument('--warm-up', action='store_true', help='only run the workers with WSGI_WARM_UP')
+    warm_up.add_argument('--no-warm-up', action='store_true', help='only run the workers without WSGI_WARM_UP')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.warm_up)
+        return
+    for warm in (False, True):
+        if (warm and args.no_warm_up) or (not warm and args.warm_up):
+            continue
+        run_workers(args.processes, warm)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+End to end ADIntegration.run() over a synthetic directory served by ldap3's MOCK_SYNC strategy, publishing to a
+local HTTP stand-in of the queue and reading an empty stand-in graph (an on-boarding sync).
+Reports entries/sec, wall time of every run() stage, peak RSS and the bytes POSTed to the queue.
+Every directory size runs in its own process so that peak RSS is not carried over.
+
+    python -m benchmarks.sync --users 10000,100000,1000000 [--streaming] [--partitioned] [--batch-envelope] [--light]
+"""
+import argparse
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from ldap3 import Connection, MOCK_SYNC
+
+from ad_service.utils import config
+from ad_service.ad_integration.onboard_and_update import ADIntegration
+from benchmarks.queue_stub import QueueStub
+from benchmarks.mock_directory import build_mock_connection, MOCK_ADMIN, MOCK_PASSWORD, MOCK_SEARCH_BASE, \
+    MOCK_SEARCH_FILTER
+
+
+class GraphStub:
+    """
+    Graph without ADProfiles and without a last fetch time of the AD instance
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def run(self, query, **parameters):
+        return iter([])
+
+
+class MockADIntegration(ADIntegration):
+    """
+    ADIntegration reading the MOCK_SYNC server of the synthetic directory
+    """
+    mock_server = None
+
+    @contextmanager
+    def _connection(self):
+        conn = Connection(self.mock_server, user=MOCK_ADMIN, password=MOCK_PASSWORD, client_strategy=MOCK_SYNC)
+        conn.bind()
+        try:
+            yield conn
+        finally:
+            conn.unbind()
+
+    def _get_search_filter(self, conn):
+        return MOCK_SEARCH_FILTER
+
+
+def peak_rss():
+    # KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_sync(users, streaming, partitioned, batch_envelope, heavy_attributes):
+    build_start = time.perf_counter()
+    MockADIntegration.mock_server = build_mock_connection(users, heavy_attributes=heavy_attributes).server
+    build_time = time.perf_counter() - build_start
+    directory_rss = peak_rss()
+
+    stages = []
+
+    def on_progress(stage, done, not_done):
+        if not stages or stages[-1][0] != stage:
+            stages.append((stage, time.perf_counter()))
+
+    with tempfile.TemporaryDirectory() as tmp, QueueStub() as queue, \
+            patch.object(config, 'FINGERPRINT_DB_PATH', os.path.join(tmp, 'fingerprints.sqlite3')), \
+            patch('ad_service.utils.graph.get_graph', return_value=GraphStub()):
+        integration = MockADIntegration(MOCK_ADMIN, MOCK_ADMIN, MOCK_PASSWORD, MOCK_SEARCH_BASE, 'graph_stub',
+                                        queue.url, 1, streaming=streaming, partitioned=partitioned,
+                                        batch_envelope=batch_envelope,
+                                        progress_callback=on_progress)
+        start = time.perf_counter()
+        integration.run()
+        end = time.perf_counter()
+
+    print('{0} users ({1}{2}{3}{4}; directory built in {5:.1f} s)'.format(
+        users, 'streaming' if streaming else 'batch', ', partitioned' if partitioned else '',
+        ', batch envelopes' if batch_envelope else '',
+        ', heavy attributes' if heavy_attributes else ', light attributes', build_time))
+    for (stage, stage_start), (_, stage_end) in zip(stages, stages[1:] + [(None, end)]):
+        print('  {0:<30} {1:8.2f} s'.format(stage, stage_end - stage_start))
+    total = end - start
+    print('  {0:<30} {1:8.2f} s | {2:.0f} entries/sec | done {3} not done {4}'.format(
+        'total', total, integration.done / total, integration.done, integration.not_done))
+    print('  peak RSS {0:.0f} MiB ({1:.0f} MiB above the mock directory) | {2} POSTs, {3:.1f} MiB POSTed '
+          '({4:.1f} MiB of json)'.format(peak_rss() / 2 ** 20, (peak_rss() - directory_rss) / 2 ** 20, queue.requests,
+                                       queue.body_bytes / 2 ** 20, queue.json_bytes / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', default='10000,100000', help='comma separated directory sizes')
+    parser.add_argument('--streaming', action='store_true', help='run the streaming sync')
+    parser.add_argument('--partitioned', action='store_true', help='fetch the directory in partitions')
+    parser.add_argument('--batch-envelope', action='store_true', help='send the events of a chunk in one envelope')
+    parser.add_argument('--light', action='store_true', help='leave out photos, certificates and group lists')
+    parser.add_argument('--verbose', action='store_true', help='keep the integration logs')
+    args = parser.parse_args()
+
+    sizes = [int(count) for count in args.users.split(',')]
+    if len(sizes) > 1:
+        for users in sizes:
+            flags = [flag for flag in ('streaming', 'partitioned', 'batch_envelope', 'light', 'verbose')
+                     if getattr(args, flag)]
+            subprocess.run([sys.executable, '-m', 'benchmarks.sync', '--users', str(users)] +
+                           ['--' + flag.replace('_', '-') for flag in flags], check=True)
+        return
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    run_sync(sizes[0], args.streaming, args.partitioned, args.batch_envelope, not args.light)
+
+
+if __name__ == '__main__':
+    main()
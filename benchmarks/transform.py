@@ -0,0 +1,59 @@
+"""
+Users/sec of the transform stage, normalization and fingerprinting of fetched ldap pages, on the sync thread vs in
+process pools of increasing size. The pages are fetched once up front, only the transform is timed; the pools are
+started within the timed run as they are by a sync.
+The speedup follows the cores of the host, on a single core the pools only add the cost of shipping the pages.
+
+    python -m benchmarks.transform --users 50000 [--processes 1,2,4] [--repeat 3]
+"""
+import argparse
+import logging
+import os
+import time
+
+from ad_service.ad_integration.fingerprints import get_fingerprint
+from ad_service.utils import config
+from benchmarks.mock_directory import build_mock_connection
+from benchmarks.normalize import fetch_pages, new_integration
+
+
+def transform(pages, processes):
+    integration = new_integration(transform_processes=processes)
+    for _ in integration._populate_pages(response for response, _ in pages):
+        pass
+    # what FingerprintStore.changed computes for the records the workers did not fingerprint
+    for record in integration.data_to_send:
+        email = record[config.AD_PROFILE_PRIMARY_KEY]
+        integration.transformed_fingerprints.get(email) or get_fingerprint(integration.group_id, record)
+    return integration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--page-size', type=int, default=config.PAGINATION_SIZE)
+    parser.add_argument('--processes', default='1,2,4', help='comma separated pool sizes to compare')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each setup, the best one is reported')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    conn = build_mock_connection(args.users, heavy_attributes=False)
+    pages = fetch_pages(conn, args.page_size)
+    print('{0} users in {1} pages, {2} cpus'.format(args.users, len(pages), os.cpu_count()))
+
+    inline = None
+    for processes in [0] + [int(value) for value in args.processes.split(',')]:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            integration = transform(pages, processes)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        inline = inline or best
+        label = '{0} processes'.format(processes) if processes else 'sync thread'
+        print('{0:<14} {1:8.3f} s | {2:8.0f} users/sec | {3:4.1f}x | done {4} not done {5}'.format(
+            label, best, args.users / best, inline / best, integration.done, integration.not_done))
+
+
+if __name__ == '__main__':
+    main()
@@ -86,6 +86,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # sync jobs of every mod_wsgi process write their progress here
+        'OPTIONS': {'timeout': 20},
     }
 }
 # from neomodel import config
@@ -20,6 +20,8 @@ from ad_service import views
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^api/health', views.health),
+    url(r'^api/metrics', views.prometheus_metrics),
     url(r'^api/check_credentials', views.check_credentials),
     url(r'^api/ad_integration', views.ad_integration),
+    url(r'^api/jobs/(?P<job_id>[0-9a-fA-F-]+)/?$', views.job_status),
 ]
@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "workgraph_ad_service.settings")
 
 application = get_wsgi_application()
+
+from ad_service.utils import config  # noqa: E402
+
+if config.WSGI_WARM_UP:
+    from ad_service.utils.warmup import warm_up  # noqa: E402
+    warm_up()
+
+if config.SCHEDULER_ENABLED:
+    from ad_service.ad_integration.scheduler import start_scheduler  # noqa: E402
+    start_scheduler()